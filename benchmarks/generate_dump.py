@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Generate a synthetic (gzip compressed) Discogs releases dump with the
+# same structure as the real dumps, for benchmarking discogs_xml_split.py.
+# The releases are generated from the release number (see mock_discogs.py),
+# so the same dump is generated every time. With a generation larger than 0
+# a fraction of the releases is changed, to simulate the next month's dump.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import gzip
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+import click
+
+from mock_discogs import make_release
+
+
+def element(name, text):
+    return f'<{name}>{escape(str(text))}</{name}>'
+
+
+def artists_xml(name, artists):
+    parts = [f'<{name}>']
+    for artist in artists:
+        parts.append('<artist>')
+        for field in ['id', 'name', 'anv', 'join', 'role', 'tracks']:
+            parts.append(element(field, artist[field]))
+        parts.append('</artist>')
+    parts.append(f'</{name}>')
+    return ''.join(parts)
+
+
+def release_xml(release):
+    '''Serialize a release (as generated by make_release()) in the format
+       of the Discogs dumps'''
+    parts = [f'<release id="{release["id"]}" status="{release["status"]}">']
+    parts.append('<images>')
+    for image in release['images']:
+        parts.append(f'<image height="{image["height"]}" type="{image["type"]}" uri="" '
+                     f'uri150="" width="{image["width"]}"/>')
+    parts.append('</images>')
+    parts.append(artists_xml('artists', release['artists']))
+    parts.append(element('title', release['title']))
+    parts.append('<labels>')
+    for label in release['labels']:
+        parts.append(f'<label name={quoteattr(label["name"])} catno={quoteattr(label["catno"])} '
+                     f'id="{label["id"]}"/>')
+    parts.append('</labels>')
+    parts.append(artists_xml('extraartists', release['extraartists']))
+    parts.append('<formats>')
+    for release_format in release['formats']:
+        parts.append(f'<format name={quoteattr(release_format["name"])} qty="{release_format["qty"]}" '
+                     'text=""><descriptions>')
+        parts.extend(element('description', description)
+                     for description in release_format['descriptions'])
+        parts.append('</descriptions></format>')
+    parts.append('</formats>')
+    parts.append('<genres>' + ''.join(element('genre', genre) for genre in release['genres']) + '</genres>')
+    parts.append('<styles>' + ''.join(element('style', style) for style in release['styles']) + '</styles>')
+    parts.append(element('country', release['country']))
+    parts.append(element('released', release['released']))
+    parts.append(element('notes', release['notes']))
+    parts.append(element('data_quality', release['data_quality']))
+    if 'master_id' in release:
+        parts.append(f'<master_id is_main_release="true">{release["master_id"]}</master_id>')
+    parts.append('<tracklist>')
+    for track in release['tracklist']:
+        parts.append('<track>')
+        for field in ['position', 'title', 'duration']:
+            parts.append(element(field, track[field]))
+        if 'artists' in track:
+            parts.append(artists_xml('artists', track['artists']))
+        if 'extraartists' in track:
+            parts.append(artists_xml('extraartists', track['extraartists']))
+        parts.append('</track>')
+    parts.append('</tracklist>')
+    parts.append('<identifiers>')
+    for identifier in release['identifiers']:
+        parts.append(f'<identifier type={quoteattr(identifier["type"])} '
+                     f'value={quoteattr(identifier["value"])}/>')
+    parts.append('</identifiers>')
+    parts.append('<videos>')
+    for video in release['videos']:
+        parts.append(f'<video src={quoteattr(video["uri"])} duration="{video["duration"]}" embed="true">'
+                     f'{element("title", video["title"])}{element("description", video["description"])}'
+                     '</video>')
+    parts.append('</videos>')
+    parts.append('<companies>')
+    for company in release['companies']:
+        parts.append('<company>')
+        for field in ['id', 'name', 'catno', 'entity_type', 'entity_type_name', 'resource_url']:
+            parts.append(element(field, company[field]))
+        parts.append('</company>')
+    parts.append('</companies>')
+    parts.append('</release>')
+    return ''.join(parts)
+
+
+def generate_dump(dump_file_name, count, start=1, gap_rate=0.1, generation=0, change_rate=0.1,
+                  separator=''):
+    '''Write a dump with count releases, starting at release number start.
+       A fraction (gap_rate) of the release numbers is not used. The
+       releases are separated by separator (for example a newline).'''
+    with gzip.open(dump_file_name, 'wt', encoding='utf-8', compresslevel=6) as dump_file:
+        dump_file.write('<releases>')
+        release_id = start
+        written = 0
+        batch = []
+        while written < count:
+            if random.Random(f'{release_id}-gap').random() >= gap_rate:
+                batch.append(release_xml(make_release(release_id, generation, change_rate)) + separator)
+                written += 1
+                if len(batch) == 1000:
+                    dump_file.write(''.join(batch))
+                    batch = []
+            release_id += 1
+        dump_file.write(''.join(batch))
+        dump_file.write('</releases>\n')
+
+
+@click.command(short_help='generate a synthetic Discogs releases dump')
+@click.option('--output', '-o', required=True, help='dump file to write (gzip compressed)',
+              type=click.Path())
+@click.option('--count', '-n', default=100000, help='number of releases (default: 100000)',
+              type=click.IntRange(min=1))
+@click.option('--start', default=1, help='first release number (default: 1)',
+              type=click.IntRange(min=1))
+@click.option('--gap-rate', default=0.1, help='fraction of unused release numbers (default: 0.1)',
+              type=click.FloatRange(min=0, max=0.99))
+@click.option('--generation', default=0, help='generation of the data (default: 0)',
+              type=click.IntRange(min=0))
+@click.option('--change-rate', default=0.1,
+              help='fraction of releases that change every generation (default: 0.1)',
+              type=click.FloatRange(min=0, max=1))
+@click.option('--newlines', is_flag=True, default=False,
+              help='put every release on a line of its own (default: False)')
+def main(output, count, start, gap_rate, generation, change_rate, newlines):
+    generate_dump(output, count, start, gap_rate, generation, change_rate,
+                  separator='\n' if newlines else '')
+
+
+if __name__ == "__main__":
+    main()
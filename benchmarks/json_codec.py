@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Check that the JSON codec (discogs_json.py) serializes releases to exactly
+# the same bytes as the standard library, and measure the time per release
+# for parsing and serializing with both.
+#
+# The corpus consists of synthetic releases (see mock_discogs.py), cases
+# that are difficult to get right (escapes, characters outside of the
+# Basic Multilingual Plane, empty containers, floats, large integers) and,
+# optionally, the stored releases in a directory (for example a Git
+# repository created by the crawler), which should be unchanged after
+# parsing and serializing them again.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import json
+import pathlib
+import sys
+import time
+
+import click
+import yaml
+
+from mock_discogs import make_release
+
+SOURCE_DIR = pathlib.Path(__file__).resolve().parent.parent / 'src'
+sys.path.insert(0, str(SOURCE_DIR))
+
+import discogs_fields
+import discogs_json
+
+EDGE_CASES = [
+    {},
+    [],
+    {'empty': {}, 'list': [], 'nested': [[], [{}], {'a': []}]},
+    {'control': ''.join(chr(c) for c in range(32)) + '\x7f', 'quote': '"\\/'},
+    {'spaces': 'a  b   c    ', 'nested': [{'  ': '  '}, ' ']},
+    {'latin': 'Östermalm Señor Café', 'cjk': '東京', 'cyrillic': 'Москва',
+     'astral': '\U0001f3b5\U0001d11e', 'separators': '  ', 'bom': '﻿'},
+    {'é': 1, 'e': 2, 'E': 3, '\U0001f3b5': 4, '￿': 5, '': 6},
+    {'integers': [0, -1, 2**63 - 1, -2**63, 2**64 - 1], 'booleans': [True, False, None]},
+    {'large': 2**70, 'negative': -2**70},
+    {'floats': [0.1, 1.0, -2.5, 1e16, 1e-05, 123456789.123456789, 5e-324]},
+    {'deep': [[[[[[[[[[{'a': [1]}]]]]]]]]]]},
+]
+
+
+def corpus(releases, directory):
+    '''Generator yielding (name, stored bytes or None, parsed JSON)'''
+    for idx, json_data in enumerate(EDGE_CASES):
+        yield f'edge case {idx}', None, json_data
+    for release_id in range(1, releases + 1):
+        yield f'release {release_id}', None, make_release(release_id)
+    if directory is not None:
+        for json_file in sorted(directory.rglob('*.json')):
+            if '.git' in json_file.parts:
+                continue
+            data = json_file.read_bytes()
+            yield str(json_file), data, json.loads(data)
+
+
+def measure(func, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            func(item)
+    return (time.perf_counter() - start) / (repeat * len(items)) * 1000000
+
+
+@click.command(short_help='check and benchmark the JSON codec')
+@click.option('--releases', '-n', default=2000, help='number of synthetic releases (default: 2000)',
+              type=click.IntRange(min=1))
+@click.option('--directory', '-d', help='directory with stored releases to check',
+              type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
+@click.option('--repeat', default=3, help='number of times the timing is repeated (default: 3)',
+              type=click.IntRange(min=1))
+def main(releases, directory, repeat):
+    if discogs_json.orjson is None:
+        print("orjson is not installed, only the standard library is used", file=sys.stderr)
+
+    # check that the output is identical
+    checked = 0
+    failed = 0
+    for name, stored, json_data in corpus(releases, directory):
+        expected = json.dumps(json_data, sort_keys=True, indent=4).encode()
+        data = discogs_json.dumps(json_data)
+        if data != expected or (stored is not None and data != stored):
+            print(f"Different output for {name}", file=sys.stderr)
+            failed += 1
+        if discogs_json.loads(expected) != json_data:
+            print(f"Different result of parsing {name}", file=sys.stderr)
+            failed += 1
+        checked += 1
+    print(f"checked {checked} items, {failed} differences")
+
+    # time parsing the synthetic releases, and serializing and comparing
+    # them after they have been cleaned up with the default configuration
+    responses = [json.dumps(make_release(release_id)).encode()
+                 for release_id in range(1, releases + 1)]
+    with open(SOURCE_DIR / 'config.yaml') as config_file:
+        removes = yaml.safe_load(config_file)['fields']['remove']
+    removes = discogs_fields.compile_removes(removes + discogs_fields.THUMBNAIL_FIELDS)
+    items = [json.loads(response) for response in responses]
+    for item in items:
+        discogs_fields.remove_fields(item, removes)
+    stored = [(json.dumps(item, sort_keys=True, indent=4).encode(), item) for item in items]
+    for operation, stdlib, codec, inputs in [
+            ('parse response', json.loads, discogs_json.loads, responses),
+            ('serialize', discogs_json.dumps_stdlib, discogs_json.dumps, items),
+            ('change check',
+             lambda pair: discogs_json.dumps_stdlib(pair[1]) and json.loads(pair[0]) == pair[1],
+             lambda pair: discogs_json.dumps(pair[1]) == pair[0], stored)]:
+        stdlib_time = measure(stdlib, inputs, repeat)
+        codec_time = measure(codec, inputs, repeat)
+        print(f"{operation:15} stdlib {stdlib_time:8.1f}us/release  codec {codec_time:8.1f}us/release"
+              f"  speedup {stdlib_time / codec_time:5.1f}x")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
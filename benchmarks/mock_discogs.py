@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Mock of the Discogs API (/releases/<id>), so the crawler can be
+# benchmarked offline. Releases are generated from the release number, so
+# every run returns the same data. The mock sends the rate limit headers
+# (and enforces the rate limit in a moving window of 60 seconds, like
+# Discogs does), and can inject 404 and 429 responses.
+#
+# With a generation larger than 0 a fraction of the releases (the change
+# rate) is different, which simulates the changes between two crawls.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import collections
+import http.server
+import json
+import random
+import re
+import threading
+import time
+
+import click
+
+RELEASE_PATH = re.compile(r'^/releases/(\d+)$')
+
+RATE_LIMIT_WINDOW = 60
+
+WORDS = ['love', 'night', 'dance', 'blue', 'dream', 'fire', 'city', 'heart', 'time', 'soul',
+         'electric', 'summer', 'moon', 'river', 'golden', 'shadow', 'sound', 'wild', 'rain',
+         'Östermalm', 'Señor', 'Café', 'Straße', 'Ångström', 'Noël', 'Ünïcödé', '東京', 'Москва']
+GENRES = ['Electronic', 'Rock', 'Jazz', 'Hip Hop', 'Pop', 'Funk / Soul', 'Classical', 'Reggae']
+STYLES = ['House', 'Techno', 'Punk', 'Ambient', 'Disco', 'Soul', 'Dub', 'Synth-pop']
+FORMATS = [('Vinyl', ['LP', 'Album']), ('Vinyl', ['12"', '33 ⅓ RPM']), ('CD', ['Album']),
+           ('Cassette', ['Single']), ('File', ['MP3', 'EP'])]
+COUNTRIES = ['US', 'UK', 'Germany', 'Netherlands', 'Japan', 'France', 'Sweden', 'Brazil']
+ROLES = ['Producer', 'Mixed By', 'Written-By', 'Mastered By', 'Vocals', 'Artwork']
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count)).title()
+
+
+def artist(rng, role=''):
+    artist_id = rng.randrange(1, 10000000)
+    return {'name': words(rng, rng.randint(1, 3)), 'anv': '', 'join': '', 'role': role,
+            'tracks': '', 'id': artist_id,
+            'resource_url': f'https://api.discogs.com/artists/{artist_id}',
+            'thumbnail_url': f'https://i.discogs.com/{rng.getrandbits(64):016x}/artist.jpeg'}
+
+
+def entity(rng, kind, entity_type_name=''):
+    entity_id = rng.randrange(1, 3000000)
+    return {'name': words(rng, rng.randint(1, 3)), 'catno': f'{rng.choice("ABCDEFGHKLMRS")}{rng.randrange(1000)}',
+            'entity_type': str(rng.randrange(1, 40)), 'entity_type_name': entity_type_name,
+            'id': entity_id, 'resource_url': f'https://api.discogs.com/{kind}/{entity_id}',
+            'thumbnail_url': f'https://i.discogs.com/{rng.getrandbits(64):016x}/label.jpeg'}
+
+
+def make_release(release_id, generation=0, change_rate=0.0):
+    '''Generate the data of a release, as returned by the Discogs API'''
+    rng = random.Random(release_id)
+    year = rng.randrange(1950, 2025)
+    artists = [artist(rng) for _ in range(rng.randint(1, 2))]
+    tracklist = []
+    for position in range(rng.randint(1, 14)):
+        track = {'position': f'{"AB"[position % 2]}{position // 2 + 1}', 'type_': 'track',
+                 'title': words(rng, rng.randint(1, 5)),
+                 'duration': f'{rng.randrange(1, 10)}:{rng.randrange(60):02d}'}
+        if rng.random() < 0.3:
+            track['artists'] = [artist(rng)]
+        if rng.random() < 0.3:
+            track['extraartists'] = [artist(rng, rng.choice(ROLES))]
+        tracklist.append(track)
+    format_name, descriptions = rng.choice(FORMATS)
+    release = {
+        'id': release_id,
+        'status': 'Accepted',
+        'year': year,
+        'resource_url': f'https://api.discogs.com/releases/{release_id}',
+        'uri': f'https://www.discogs.com/release/{release_id}',
+        'artists': artists,
+        'artists_sort': artists[0]['name'],
+        'labels': [entity(rng, 'labels') for _ in range(rng.randint(1, 2))],
+        'series': [],
+        'companies': [entity(rng, 'labels', rng.choice(['Pressed By', 'Recorded At', 'Lacquer Cut At']))
+                      for _ in range(rng.randint(0, 4))],
+        'formats': [{'name': format_name, 'qty': str(rng.randint(1, 2)), 'descriptions': descriptions}],
+        'data_quality': rng.choice(['Correct', 'Needs Vote', 'Complete and Correct']),
+        'community': {'have': rng.randrange(5000), 'want': rng.randrange(5000),
+                      'rating': {'count': rng.randrange(200), 'average': round(rng.uniform(1, 5), 2)},
+                      'submitter': {'username': words(rng, 1).lower(),
+                                    'resource_url': 'https://api.discogs.com/users/submitter'},
+                      'contributors': [{'username': words(rng, 1).lower(),
+                                        'resource_url': 'https://api.discogs.com/users/contributor'}
+                                       for _ in range(rng.randint(1, 5))],
+                      'data_quality': 'Needs Vote', 'status': 'Accepted'},
+        'format_quantity': 1,
+        'date_added': f'{year + 1}-01-01T00:00:00-08:00',
+        'date_changed': f'{year + 2}-01-01T00:00:00-08:00',
+        'num_for_sale': rng.randrange(100),
+        'lowest_price': round(rng.uniform(1, 100), 2),
+        'title': words(rng, rng.randint(1, 4)),
+        'country': rng.choice(COUNTRIES),
+        'released': str(year),
+        'notes': words(rng, rng.randint(0, 40)),
+        'released_formatted': str(year),
+        'identifiers': [{'type': 'Barcode', 'value': str(rng.randrange(10**12))}],
+        'videos': [{'uri': f'https://www.youtube.com/watch?v={rng.getrandbits(40):010x}',
+                    'title': words(rng, 3), 'description': words(rng, 8),
+                    'duration': rng.randrange(600), 'embed': True}
+                   for _ in range(rng.randint(0, 3))],
+        'genres': rng.sample(GENRES, rng.randint(1, 2)),
+        'styles': rng.sample(STYLES, rng.randint(1, 3)),
+        'tracklist': tracklist,
+        'extraartists': [artist(rng, rng.choice(ROLES)) for _ in range(rng.randint(0, 6))],
+        'images': [{'type': 'primary', 'uri': '', 'resource_url': '', 'uri150': '',
+                    'width': 600, 'height': 600}],
+        'thumb': '',
+        'estimated_weight': rng.randrange(80, 400),
+        'blocked_from_sale': False,
+    }
+    if rng.random() < 0.7:
+        release['master_id'] = rng.randrange(1, 3000000)
+        release['master_url'] = f"https://api.discogs.com/masters/{release['master_id']}"
+
+    # releases that were edited since the first generation
+    for edit in range(1, generation + 1):
+        if random.Random(f'{release_id}-{edit}').random() < change_rate:
+            release['notes'] += f' (edit {edit})'
+            release['date_changed'] = f'{2024 + edit}-01-01T00:00:00-08:00'
+    return release
+
+
+def is_removed(release_id, not_found_rate):
+    '''Releases that have been removed (and return 404)'''
+    return random.Random(f'{release_id}-removed').random() < not_found_rate
+
+
+class MockDiscogs(http.server.ThreadingHTTPServer):
+    '''HTTP server with the state of the mock'''
+    daemon_threads = True
+
+    def __init__(self, address, not_found_rate=0.0, rate_limited_rate=0.0, rate_limit=60,
+                 retry_after=1, generation=0, change_rate=0.0):
+        super().__init__(address, MockHandler)
+        self.not_found_rate = not_found_rate
+        self.rate_limited_rate = rate_limited_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.generation = generation
+        self.change_rate = change_rate
+        self.lock = threading.Lock()
+        self.requests = collections.deque()
+        self.rng = random.Random(0)
+
+    def take_request(self):
+        '''Record a request, returns the number of requests in the window
+           and whether this request is rate limited'''
+        with self.lock:
+            now = time.monotonic()
+            while self.requests and self.requests[0] < now - RATE_LIMIT_WINDOW:
+                self.requests.popleft()
+            if len(self.requests) >= self.rate_limit or self.rng.random() < self.rate_limited_rate:
+                return len(self.requests), True
+            self.requests.append(now)
+            return len(self.requests), False
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        match = RELEASE_PATH.match(self.path)
+        used, rate_limited = self.server.take_request()
+        headers = {'X-Discogs-Ratelimit': str(self.server.rate_limit),
+                   'X-Discogs-Ratelimit-Used': str(used),
+                   'X-Discogs-Ratelimit-Remaining': str(max(0, self.server.rate_limit - used))}
+        if rate_limited:
+            status, body = 429, {'message': "You are making requests too quickly."}
+            headers['Retry-After'] = str(self.server.retry_after)
+        elif match is None:
+            status, body = 404, {'message': "The requested resource was not found."}
+        else:
+            release_id = int(match.group(1))
+            if is_removed(release_id, self.server.not_found_rate):
+                status, body = 404, {'message': "Release not found."}
+            else:
+                status = 200
+                body = make_release(release_id, self.server.generation, self.server.change_rate)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@click.command(short_help='mock of the Discogs API for benchmarking')
+@click.option('--port', '-p', default=8080, help='port (default: 8080)', type=int)
+@click.option('--not-found-rate', default=0.05, help='fraction of releases that return 404 (default: 0.05)',
+              type=click.FloatRange(min=0, max=1))
+@click.option('--rate-limited-rate', default=0.01,
+              help='fraction of requests that return 429 (default: 0.01)',
+              type=click.FloatRange(min=0, max=1))
+@click.option('--rate-limit', default=60, help='requests per minute (default: 60)',
+              type=click.IntRange(min=1))
+@click.option('--retry-after', default=1, help='Retry-After for 429 responses (default: 1)',
+              type=click.IntRange(min=0))
+@click.option('--generation', default=0, help='generation of the data (default: 0)',
+              type=click.IntRange(min=0))
+@click.option('--change-rate', default=0.1,
+              help='fraction of releases that change every generation (default: 0.1)',
+              type=click.FloatRange(min=0, max=1))
+def main(port, not_found_rate, rate_limited_rate, rate_limit, retry_after, generation, change_rate):
+    server = MockDiscogs(('127.0.0.1', port), not_found_rate=not_found_rate,
+                         rate_limited_rate=rate_limited_rate, rate_limit=rate_limit,
+                         retry_after=retry_after, generation=generation, change_rate=change_rate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
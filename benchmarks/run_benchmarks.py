@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the pipeline: splitting a dump, seeding the queue and
+# crawling, all offline using a synthetic dump (generate_dump.py) and a
+# mock of the Discogs API (mock_discogs.py). Every scenario runs in a
+# separate process, so the peak memory usage of the scenarios can be
+# compared. For each scenario the throughput (releases per second), the
+# peak RSS and (for crawling) the latency of commits are reported, so the
+# effect of a change can be measured before it is used on the real data.
+#
+# With --check the split scenario also checks that the results do not
+# depend on the way the dump is processed: the dump then has whitespace
+# between the releases, and the results are compared with the results of
+# a different number of worker processes and of a single process that
+# records checkpoints.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import hashlib
+import json
+import os
+import pathlib
+import random
+import resource
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import click
+
+import generate_dump
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+SOURCE_DIR = BENCHMARK_DIR.parent / 'src'
+
+SCENARIOS = ['split', 'seed', 'crawl', 'recrawl']
+
+
+def peak_rss():
+    '''Peak RSS (in MiB) of this process and of the largest child process'''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_mock(port, options):
+    '''Start the mock of the Discogs API in a separate process and wait
+       until it accepts requests'''
+    process = subprocess.Popen([sys.executable, str(BENCHMARK_DIR / 'mock_discogs.py'),
+                                '--port', str(port)] + options)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1)
+        except urllib.error.HTTPError:
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("mock of the Discogs API did not start")
+
+
+def write_results(result_file_name, count, result_format, generation=0, change_rate=0.1):
+    '''Write a synthetic result file with count releases, of which a
+       fraction (change_rate) differs for every generation'''
+    import discogs_results
+    writer = discogs_results.open_writer(result_file_name, 'raw', result_format)
+    batch = []
+    for release_id in range(1, count + 1):
+        changed = sum(random.Random(f'{release_id}-{edit}').random() < change_rate
+                      for edit in range(1, generation + 1))
+        batch.append((release_id, hashlib.sha1(f'{release_id}-{changed}'.encode()).digest()))
+        if len(batch) == discogs_results.READ_RECORDS:
+            writer.write(batch)
+            batch = []
+    writer.write(batch)
+    writer.close()
+
+
+def split_dump(dump_file, result_file, jobs, hash_mode, result_format, options=()):
+    import discogs_xml_split
+    discogs_xml_split.main(['-d', str(dump_file), '-r', str(result_file), '-j', str(jobs),
+                            '--hash-mode', hash_mode, '-f', result_format] + list(options),
+                           standalone_mode=False)
+
+
+def check_split(work_dir, dump_file, jobs, hash_mode, result_format):
+    '''Compare the results of the split scenario with the results of a
+       different number of worker processes and with the results of a
+       single process with checkpoints (which cuts the dump into chunks
+       like the worker processes), raises ValueError if they differ'''
+    check_jobs = 2 if jobs == 1 else 1
+    checks = [(f"{check_jobs} processes", check_jobs, []),
+              ("checkpoints", 1, ['--checkpoint', str(work_dir / 'split-checkpoint'),
+                                  '--checkpoint-interval', '0'])]
+    for name, other_jobs, options in checks:
+        split_dump(dump_file, work_dir / 'split-check', other_jobs, hash_mode, result_format, options)
+        if (work_dir / 'split-results').read_bytes() != (work_dir / 'split-check').read_bytes():
+            raise ValueError(f"results with {jobs} processes and with {name} differ")
+
+
+def run_split(work_dir, releases, jobs, hash_mode, result_format, check=False):
+    if check:
+        # the releases in the real dumps can be separated by whitespace,
+        # which is part of the release when it is hashed in etree mode
+        dump_file = work_dir / f'releases-{releases}-newlines.xml.gz'
+    else:
+        dump_file = work_dir / f'releases-{releases}.xml.gz'
+    if not dump_file.exists():
+        generate_dump.generate_dump(dump_file, releases, separator='\n' if check else '')
+
+    start = time.perf_counter()
+    split_dump(dump_file, work_dir / 'split-results', jobs, hash_mode, result_format)
+    result = {'releases': releases, 'seconds': time.perf_counter() - start}
+    if check:
+        check_split(work_dir, dump_file, jobs, hash_mode, result_format)
+    return result
+
+
+def run_seed(work_dir, releases, change_rate, result_format):
+    import discogs_queue_seeder
+    old_file = work_dir / f'old-{releases}.{result_format}'
+    new_file = work_dir / f'new-{releases}-{change_rate}.{result_format}'
+    if not old_file.exists():
+        write_results(old_file, releases, result_format)
+    if not new_file.exists():
+        write_results(new_file, releases, result_format, generation=1, change_rate=change_rate)
+    queue_file = work_dir / 'seed-queue.sqlite'
+    queue_file.unlink(missing_ok=True)
+
+    start = time.perf_counter()
+    discogs_queue_seeder.main(['-n', str(new_file), '-o', str(old_file), '--queue', 'sqlite',
+                               '--queue-file', str(queue_file)], standalone_mode=False)
+    seconds = time.perf_counter() - start
+    with sqlite3.connect(queue_file) as connection:
+        queued = connection.execute('select count(*) from queue').fetchone()[0]
+    return {'releases': releases, 'seconds': seconds, 'queued': queued}
+
+
+def run_crawl(work_dir, releases, generation, change_rate, concurrency, batch_size, rate_limit):
+    '''Crawl releases from the mock into a Git repository. The first pass
+       (generation 0) starts with an empty repository, later passes reuse
+       the repository of the previous pass.'''
+    import dulwich.porcelain
+    import yaml
+
+    import crawler_for_discogs
+    import discogs_metrics
+    import discogs_queue
+
+    git_dir = work_dir / 'git'
+    if generation == 0:
+        if git_dir.exists():
+            subprocess.run(['rm', '-rf', str(git_dir)], check=True)
+        git_dir.mkdir()
+        dulwich.porcelain.init(str(git_dir))
+
+    queue_file = work_dir / 'crawl-queue.sqlite'
+    queue_file.unlink(missing_ok=True)
+    work_queue = discogs_queue.SQLiteQueue(queue_file)
+    work_queue.push('discogs-1M', range(1, releases + 1))
+    work_queue.close()
+
+    port = free_port()
+    config = {'git': {'batch_size': batch_size, 'batch_interval': 10},
+              'queue': {'backend': 'sqlite', 'file': str(queue_file)},
+              'metrics': {'interval': 0},
+              'api': {'url': f'http://127.0.0.1:{port}', 'concurrency': concurrency,
+                      'rate_limit_backoff': 1, 'rate_limit': {'store': 'local', 'burst': 10}}}
+    config_file = work_dir / 'crawl.yaml'
+    config_file.write_text(yaml.dump(config))
+
+    # stop the crawler once every release has been stored and committed
+    result = {'releases': releases}
+
+    def stop_when_done():
+        with sqlite3.connect(queue_file) as connection:
+            while True:
+                time.sleep(0.05)
+                # fetchall() finishes the statement, so no read transaction
+                # (with an old snapshot of the queue) is left open
+                remaining = connection.execute('select (select count(*) from queue) + '
+                                               '(select count(*) from inflight)').fetchall()
+                if remaining == [(0,)]:
+                    break
+        result['seconds'] = time.perf_counter() - start
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    mock = start_mock(port, ['--rate-limit', str(rate_limit), '--generation', str(generation),
+                             '--change-rate', str(change_rate)])
+    try:
+        start = time.perf_counter()
+        threading.Thread(target=stop_when_done, daemon=True).start()
+        crawler_for_discogs.main(['-c', str(config_file), '-u', 'benchmark', '-t', 'benchmark',
+                                  '-g', str(git_dir), '-l', '1'], standalone_mode=False)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    commit = discogs_metrics.REGISTRY.histograms.get('commit')
+    if commit is not None:
+        result['commits'] = commit.count
+        result['commit_ms'] = commit.sum / commit.count * 1000
+    for change in ['added', 'updated', 'unchanged']:
+        result[change] = discogs_metrics.REGISTRY.get('releases', change)
+    return result
+
+
+def run_scenario(scenario, work_dir, options):
+    '''Run a scenario in this process and return the results'''
+    sys.path.insert(0, str(SOURCE_DIR))
+    if scenario == 'split':
+        result = run_split(work_dir, options['split_releases'], options['jobs'],
+                           options['hash_mode'], options['result_format'], options['check'])
+    elif scenario == 'seed':
+        result = run_seed(work_dir, options['seed_releases'], options['change_rate'],
+                          options['result_format'])
+    else:
+        result = run_crawl(work_dir, options['crawl_releases'], 0 if scenario == 'crawl' else 1,
+                           options['change_rate'], options['concurrency'], options['batch_size'],
+                           options['rate_limit'])
+    result['rss_mb'], result['children_rss_mb'] = peak_rss()
+    return result
+
+
+def format_result(scenario, result):
+    line = [f"{scenario:8}", f"{result['releases']:>9} releases", f"{result['seconds']:8.2f}s",
+            f"{result['releases'] / result['seconds']:10.1f} releases/s",
+            f"peak RSS {result['rss_mb']:7.1f} MiB"]
+    if result['children_rss_mb']:
+        line.append(f"(children {result['children_rss_mb']:.1f} MiB)")
+    if 'queued' in result:
+        line.append(f"queued {result['queued']}")
+    if 'commit_ms' in result:
+        line.append(f"{result['commits']} commits, {result['commit_ms']:.1f}ms/commit")
+        line.append(f"added={result['added']} updated={result['updated']} "
+                    f"unchanged={result['unchanged']}")
+    return ' '.join(line)
+
+
+@click.command(short_help='run benchmarks with a synthetic dump and a mock of the Discogs API')
+@click.option('--scenario', '-s', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='scenario to run, can be repeated (default: all). recrawl needs crawl')
+@click.option('--work-dir', '-w', type=click.Path(file_okay=False, path_type=pathlib.Path),
+              help='directory for the generated data, which is reused (default: temporary directory)')
+@click.option('--split-releases', default=100000, type=click.IntRange(min=1),
+              help='releases in the dump for split (default: 100000)')
+@click.option('--seed-releases', default=1000000, type=click.IntRange(min=1),
+              help='releases in the result files for seed (default: 1000000)')
+@click.option('--crawl-releases', default=2000, type=click.IntRange(min=1, max=999999),
+              help='releases to crawl (default: 2000)')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+              help='worker processes for split (default: 1)')
+@click.option('--hash-mode', default='raw', type=click.Choice(['etree', 'raw']),
+              help='hash mode for split (default: raw)')
+@click.option('--format', '-f', 'result_format', default='text', type=click.Choice(['text', 'binary']),
+              help='format of the result files (default: text)')
+@click.option('--change-rate', default=0.1, type=click.FloatRange(min=0, max=1),
+              help='fraction of releases that changed for seed and recrawl (default: 0.1)')
+@click.option('--concurrency', '-n', default=4, type=click.IntRange(min=1),
+              help='concurrent requests when crawling (default: 4)')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1),
+              help='releases per commit when crawling (default: 100)')
+@click.option('--rate-limit', default=1000000, type=click.IntRange(min=1),
+              help='requests per minute allowed by the mock (default: 1000000)')
+@click.option('--check', is_flag=True, default=False,
+              help='check that split gives the same results with a different number of processes')
+@click.option('--json', 'json_file', type=click.File('w'), help='also write the results as JSON')
+@click.option('--run', 'run', hidden=True, type=click.Choice(SCENARIOS))
+def main(scenarios, work_dir, json_file, run, **options):
+    if run is not None:
+        # run a single scenario in this process (started by the main process)
+        print(json.dumps(run_scenario(run, work_dir, options)))
+        return
+
+    if not scenarios:
+        scenarios = SCENARIOS
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if work_dir is None:
+            work_dir = pathlib.Path(temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        results = {}
+        for scenario in scenarios:
+            args = [sys.executable, __file__, '--run', scenario, '--work-dir', str(work_dir)]
+            for param in click.get_current_context().command.params:
+                if param.name not in options:
+                    continue
+                if getattr(param, 'is_flag', False):
+                    if options[param.name]:
+                        args.append(param.opts[0])
+                else:
+                    args += [param.opts[0], str(options[param.name])]
+            process = subprocess.run(args, stdout=subprocess.PIPE, text=True)
+            if process.returncode != 0:
+                print(f"Scenario {scenario} failed, exiting", file=sys.stderr)
+                sys.exit(1)
+            results[scenario] = json.loads(process.stdout.splitlines()[-1])
+            print(format_result(scenario, results[scenario]))
+
+    if json_file is not None:
+        json.dump(results, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
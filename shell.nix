@@ -11,9 +11,12 @@ let
     dulwich
     defusedxml
     hiredis
+    indexed-gzip
+    orjson
     pyyaml
     redis
     requests
+    zstandard
   ]);
     
 in
@@ -6,16 +6,32 @@
 # Licensed under Apache 2.0, see LICENSE file for details
 # Copyright - Armijn Hemel
 
-import json
 import pathlib
+import queue
+import signal
+import sqlite3
 import sys
+import threading
 import time
 
 import click
 import dulwich
-import dulwich.porcelain
+import dulwich.errors
+import dulwich.repo
 import redis
 import requests
+import requests.adapters
+
+import discogs_archive
+import discogs_changes
+import discogs_fields
+import discogs_index
+import discogs_json
+import discogs_metrics
+import discogs_queue
+import discogs_rate_limit
+import discogs_storage
+import discogs_tombstones
 
 # import YAML module for the configuration
 from yaml import load
@@ -68,125 +84,442 @@ LISTS_READ = {1: 'discogs-1M', 2: 'discogs-2M', 3: 'discogs-3M',
               109: 'discogs-109M', 110: 'discogs-110M', 111: 'discogs-111M',
 }
 
-# lists with names of queues release numbers are written to after downloading
-LISTS_PROCESS = {1: 'process-1M', 2: 'process-2M', 3: 'process-3M',
-                 4: 'process-4M', 5: 'process-5M', 6: 'process-6M',
-                 7: 'process-7M', 8: 'process-8M', 9: 'process-9M',
-                 10: 'process-10M', 11: 'process-11M', 12: 'process-12M',
-                 13: 'process-13M', 14: 'process-14M', 15: 'process-15M',
-                 16: 'process-16M', 17: 'process-17M', 18: 'process-18M',
-                 19: 'process-19M', 20: 'process-20M', 21: 'process-21M',
-                 22: 'process-22M', 23: 'process-23M', 24: 'process-24M',
-                 25: 'process-25M', 26: 'process-26M', 27: 'process-27M',
-                 28: 'process-28M', 29: 'process-29M', 30: 'process-30M',
-                 31: 'process-31M', 32: 'process-32M', 33: 'process-33M',
-                 34: 'process-34M', 35: 'process-35M', 36: 'process-36M',
-                 37: 'process-37M', 38: 'process-38M', 39: 'process-39M',
-                 40: 'process-40M', 41: 'process-41M', 42: 'process-42M',
-                 43: 'process-43M', 44: 'process-44M', 45: 'process-45M',
-                 46: 'process-46M', 47: 'process-47M', 48: 'process-48M',
-                 49: 'process-49M', 50: 'process-50M', 51: 'process-51M',
-                 52: 'process-52M', 53: 'process-53M', 54: 'process-54M',
-                 55: 'process-55M', 56: 'process-56M', 57: 'process-57M',
-                 58: 'process-58M', 59: 'process-59M', 60: 'process-60M',
-                 61: 'process-61M', 62: 'process-62M', 63: 'process-63M',
-                 64: 'process-64M', 65: 'process-65M', 66: 'process-66M',
-                 67: 'process-67M', 68: 'process-68M', 69: 'process-69M',
-                 70: 'process-70M', 71: 'process-71M', 72: 'process-72M',
-                 73: 'process-73M', 74: 'process-74M', 75: 'process-75M',
-                 76: 'process-76M', 77: 'process-77M', 78: 'process-78M',
-                 79: 'process-79M', 80: 'process-80M', 81: 'process-81M',
-                 82: 'process-82M', 83: 'process-83M', 84: 'process-84M',
-                 85: 'process-85M', 86: 'process-86M', 87: 'process-87M',
-                 88: 'process-88M', 89: 'process-89M', 90: 'process-90M',
-                 91: 'process-91M', 92: 'process-92M', 93: 'process-93M',
-                 94: 'process-94M', 95: 'process-95M', 96: 'process-96M',
-                 97: 'process-97M', 98: 'process-98M', 99: 'process-99M',
-                 100: 'process-100M', 101: 'process-101M', 102: 'process-102M',
-                 103: 'process-103M', 104: 'process-104M', 105: 'process-105M',
-                 106: 'process-106M', 107: 'process-107M', 108: 'process-108M',
-                 109: 'process-109M', 110: 'process-110M', 111: 'process-111M',
-}
+# blocks of the lists release numbers are read from
+BLOCKS = {list_name: block for block, list_name in LISTS_READ.items()}
+
+# change logs that events for changed releases are published to
+# after they have been committed (see discogs_changes.py)
+LISTS_PROCESS = discogs_changes.LISTS_PROCESS
+
+# location of the Discogs API
+DISCOGS_API = 'https://api.discogs.com'
+
+# time to wait for release numbers when the queue is empty
+EMPTY_QUEUE_WAIT = 10
+
+# timeout for a single HTTP request
+REQUEST_TIMEOUT = 30
+
+
+class BlockStores:
+    '''The Git stores for the blocks that a crawler writes to, which are
+       opened when a block is first used. With a single repository all
+       blocks share a single store and index.'''
+    def __init__(self, git, repository_mode, batch_size=1, batch_interval=None,
+                 use_index=True, index_file=None):
+        self.git = git
+        self.repository_mode = repository_mode
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.use_index = use_index
+        self.index_file = index_file
+
+        # block -> (store, directory of the block, index)
+        self.blocks = {}
+
+        # repository path -> store, index path -> index
+        self.stores = {}
+        self.indexes = {}
+
+    def open(self, block):
+        '''Return the store, the directory and the index for a block'''
+        if block not in self.blocks:
+            repo, block_directory = discogs_storage.open_block_repository(self.git, block,
+                                                                         self.repository_mode)
+            index = None
+            if self.use_index:
+                # release numbers are unique, so an index
+                # can be shared by several repositories
+                index_file = self.index_file
+                if index_file is None:
+                    index_file = discogs_index.default_index_path(repo)
+                if index_file not in self.indexes:
+                    self.indexes[index_file] = discogs_index.ContentIndex(index_file)
+                index = self.indexes[index_file]
+            if repo.path not in self.stores:
+                # changes are committed per release, or in batches
+                self.stores[repo.path] = discogs_storage.GitStore(repo, AUTHOR,
+                                                                  batch_size=self.batch_size,
+                                                                  batch_interval=self.batch_interval,
+                                                                  index=index)
+            self.blocks[block] = (self.stores[repo.path], block_directory, index)
+        return self.blocks[block]
+
+    def flush_if_due(self):
+        for store in self.stores.values():
+            store.flush_if_due()
+
+    def close(self):
+        '''Commit all pending changes and close the indexes'''
+        for store in self.stores.values():
+            store.close()
+        for index in self.indexes.values():
+            index.close()
+
+
+def serialize_release(json_data):
+    '''Serialize a release the way it is stored in Git'''
+    return discogs_json.dumps(json_data)
+
+
+def store_release(release_id, data, git_directory, store, index=None, layout='flat', feed=None):
+    '''Compare a serialized release to the stored version and write it
+       and queue it for the next commit in case it is different. If a
+       change feed is given the changed top-level fields are recorded.
+       Returns True if the release was changed, False if it was unchanged.'''
+    json_path = discogs_storage.release_path(git_directory, release_id, layout)
+    new_file = True
+    stored_data = None
+
+    with discogs_metrics.timer('compare'):
+        # first check if the file has changed. If not, then don't add
+        # the file. If there is an index the hash of the data is
+        # compared to the hash of the stored file, otherwise the
+        # stored file is read and compared (the serialization is
+        # canonical, so the bytes can be compared). The index is only
+        # updated when changes are committed, so a release that already
+        # changed in the current batch is compared to the pending change.
+        if index is not None:
+            data_hash = discogs_index.content_hash(data)
+            if release_id in store.pending_releases:
+                stored_hash = store.pending_releases[release_id]
+                if stored_hash is None:
+                    # removed in the current batch, but still in HEAD
+                    new_file = index.get(release_id) is None
+            else:
+                stored_hash = index.get(release_id)
+            if stored_hash == data_hash:
+                discogs_metrics.increment('releases', 'unchanged')
+                return False
+            if stored_hash is not None:
+                new_file = False
+
+        if new_file and json_path.exists():
+            new_file = False
+            stored_data = json_path.read_bytes()
+            if stored_data == data:
+                if index is not None:
+                    index.update([(release_id, data_hash)])
+                discogs_metrics.increment('releases', 'unchanged')
+                return False
+
+    if feed is not None:
+        # only changed releases are compared field by field
+        if stored_data is None and not new_file and json_path.exists():
+            stored_data = json_path.read_bytes()
+        feed.record(release_id, discogs_changes.changed_fields(stored_data, data))
+
+    # write to a file in the correct Git directory and queue
+    # it for the next commit
+    store.add(json_path, data, release_id, new=new_file)
+    discogs_metrics.increment('releases', 'added' if new_file else 'updated')
+    return True
+
 
 # process json: cleanup, sort, compare to already stored version
 # and add or update in case it is different.
-def process_json(json_data, removes, git_directory, repo, remove_thumbnails=True):
+def process_json(json_data, removes, git_directory, store, index=None, layout='flat', feed=None):
     '''Helper function to cleanup and sort JSON obtained from Discogs,
-       write to a file and store in Git'''
-    for remove_item in removes:
+       write to a file and store in Git. removes is a tree of fields
+       to remove, compiled with discogs_fields.compile_removes().
+       Returns True if the release was changed and queued for the
+       next commit, False if it was unchanged.'''
+    with discogs_metrics.timer('cleanup'):
+        discogs_fields.remove_fields(json_data, removes)
+        data = serialize_release(json_data)
+    return store_release(json_data['id'], data, git_directory, store, index, layout, feed)
+
+
+def delete_release(release_id, git_directory, store, index=None, layout='flat'):
+    '''Remove a release that no longer exists from the working tree and
+       queue the removal for the next commit. Returns True if the release
+       was stored, False if there was nothing to remove.'''
+    json_path = discogs_storage.release_path(git_directory, release_id, layout)
+    if not json_path.exists() and (index is None or index.get(release_id) is None):
+        return False
+    store.remove(json_path, release_id)
+    discogs_metrics.increment('releases', 'deleted')
+    return True
+
+
+def fetch_releases(session, api_url, scheduler, store_queue, rate_limiter, stop, failed,
+                   archive=None, tombstones=None, remove_deleted=False):
+    '''Fetch thread: continuously grab an identifier from the queue, download
+       the release from Discogs and hand it to the storage thread. If an
+       archive is given the raw response is added to the archive. If a
+       tombstone store is given releases that are not found are recorded
+       in it. With remove_deleted releases that are not found are handed
+       to the storage thread as well, to remove them from Git.'''
+    while not stop.is_set():
         try:
-            if '/' in remove_item:
-                key1, key2 = remove_item.split('/', 1)
-                del json_data[key1][key2]
+            start = time.perf_counter()
+            claim = scheduler.get()
+            if claim is None:
+                # the queue stayed empty, try again
+                continue
+            discogs_metrics.observe('claim', time.perf_counter() - start)
+            list_name, identifier = claim
+        except ValueError as e:
+            print("Invalid data received from Redis server, exiting", e, file=sys.stderr)
+            failed.set()
+            stop.set()
+            return
+        except discogs_queue.QUEUE_ERRORS as e:
+            print("Cannot connect to queue", e, file=sys.stderr)
+            failed.set()
+            stop.set()
+            return
+
+        # try until the release has been downloaded or is known to be
+        # unavailable. Requests that are rate limited are retried.
+        while not stop.is_set():
+            rate_limiter.acquire()
+            try:
+                with discogs_metrics.timer('fetch'):
+                    request = session.get(f'{api_url}/releases/{identifier}',
+                                          timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                discogs_metrics.increment('errors', 'request')
+                print(f"Cannot download release {identifier}", e, file=sys.stderr)
+                stop.wait(rate_limiter.backoff)
+                continue
+
+            if request.status_code in (200, 404, 429):
+                discogs_metrics.increment('responses', str(request.status_code))
             else:
-                del json_data[remove_item]
-        except KeyError:
-            pass
+                discogs_metrics.increment('responses', 'other')
 
-    if remove_thumbnails:
-        for artist in json_data['artists']:
-            try:
-                del artist['thumbnail_url']
-            except KeyError:
-                pass
-        for artist in json_data['extraartists']:
-            try:
-                del artist['thumbnail_url']
-            except KeyError:
-                pass
-        for company in json_data['companies']:
-            try:
-                del company['thumbnail_url']
-            except KeyError:
-                pass
-        for label in json_data['labels']:
-            try:
-                del label['thumbnail_url']
-            except KeyError:
-                pass
-        for label in json_data['series']:
-            try:
-                del label['thumbnail_url']
-            except KeyError:
-                pass
-        for track in json_data['tracklist']:
-            if 'artists' in track:
-                for artist in track['artists']:
-                    try:
-                        del artist['thumbnail_url']
-                    except KeyError:
-                        pass
-            if 'extraartists' in track:
-                for artist in track['extraartists']:
+            if request.status_code == 401:
+                print("Denied by Discogs, exiting", file=sys.stderr)
+                scheduler.release(list_name, [identifier])
+                failed.set()
+                stop.set()
+                return
+            if request.status_code == 429:
+                rate_limiter.retry_after(request.headers)
+                continue
+
+            # in case there is no 429 response calibrate the rate limiter
+            rate_limiter.update(request.headers)
+
+            if request.status_code == 200:
+                try:
+                    with discogs_metrics.timer('decode'):
+                        json_data = discogs_json.loads(request.content)
+                except ValueError as e:
+                    discogs_metrics.increment('errors', 'invalid_json')
+                    print(f"Invalid JSON received for release {identifier}", e, file=sys.stderr)
+                else:
+                    if archive is not None:
+                        try:
+                            archive.add(identifier, request.content)
+                        except (OSError, sqlite3.Error) as e:
+                            discogs_metrics.increment('errors', 'archive')
+                            print(f"Cannot archive release {identifier}", e, file=sys.stderr)
+                    if tombstones is not None:
+                        # a release can be restored after it was removed
+                        try:
+                            tombstones.discard(identifier)
+                        except sqlite3.Error as e:
+                            discogs_metrics.increment('errors', 'tombstones')
+                            print(f"Cannot update tombstone of release {identifier}", e,
+                                  file=sys.stderr)
+                    store_queue.put((list_name, identifier, json_data))
+                    break
+            elif request.status_code == 404:
+                # record the release as removed, so it is not queued again
+                if tombstones is not None:
                     try:
-                        del artist['thumbnail_url']
-                    except KeyError:
-                        pass
+                        tombstones.add(identifier)
+                    except sqlite3.Error as e:
+                        discogs_metrics.increment('errors', 'tombstones')
+                        print(f"Cannot record tombstone of release {identifier}", e,
+                              file=sys.stderr)
+                if remove_deleted:
+                    # the storage thread acknowledges the release number
+                    # once the removal has been committed
+                    store_queue.put((list_name, identifier, None))
+                    break
+            else:
+                print(f"Unexpected status {request.status_code} for release {identifier}",
+                      file=sys.stderr)
+            scheduler.ack(list_name, [identifier])
+            break
+        else:
+            # stopped before the release was downloaded
+            scheduler.release(list_name, [identifier])
+
+
+def ack_releases(scheduler, releases):
+    '''Acknowledge a list of (list name, release number) tuples'''
+    per_list = {}
+    for list_name, identifier in releases:
+        per_list.setdefault(list_name, []).append(identifier)
+    for list_name, identifiers in per_list.items():
+        scheduler.ack(list_name, identifiers)
+
+
+def release_releases(scheduler, releases):
+    '''Return a list of (list name, release number) tuples to the queue'''
+    per_list = {}
+    for list_name, identifier in releases:
+        per_list.setdefault(list_name, []).append(identifier)
+    for list_name, identifiers in per_list.items():
+        scheduler.release(list_name, identifiers)
+
+
+def store_releases(store_queue, scheduler, removes, stores, layout, feed=None, archive=None):
+    '''Storage thread: clean up and store releases handed over by the
+       fetch threads. Git is only written to by this thread. Release
+       numbers are acknowledged once the release has been committed
+       (or turned out to be unchanged). Releases without JSON data no
+       longer exist and are removed. If a change feed is given the
+       events for the changed releases are published after every
+       commit, and the release numbers are only acknowledged once the
+       events have been published. Events that could not be published
+       are retried. When a block is first used the events of commits
+       that were not published (for example because the crawler was
+       stopped right after a commit) are published. Changes for blocks
+       of which the lease was lost are not committed, the release
+       numbers are returned to the queue instead. If an archive is given
+       the responses are written to it before the release numbers of
+       committed releases are acknowledged, and at least every flush
+       interval of the archive.'''
+    # (list name, release number) of changed releases
+    # that are not yet committed, per store
+    uncommitted = {}
+
+    # commit id -> (list name, release number) of the releases in
+    # commits of which the change events were not published yet
+    unpublished = {}
+
+    # lists of which the change log was checked for missing events
+    caught_up = set()
+
+    def flush_archive(flush):
+        try:
+            flush()
+        except (OSError, sqlite3.Error) as e:
+            discogs_metrics.increment('errors', 'archive')
+            print("Cannot write archive", e, file=sys.stderr)
 
-    json_filename = f"{json_data['id']}.json"
-    new_file = True
+    def publish_changes():
+        try:
+            for commit_id in feed.publish():
+                ack_releases(scheduler, unpublished.pop(commit_id))
+        except discogs_queue.QUEUE_ERRORS as e:
+            # the release numbers stay claimed, and the events are
+            # published by the next call (or after a restart)
+            discogs_metrics.increment('errors', 'changes')
+            print("Cannot publish changes", e, file=sys.stderr)
+
+    def open_block(list_name):
+        store, git_directory, index = stores.open(BLOCKS[list_name])
+        if store not in uncommitted:
+            uncommitted[store] = []
+
+            def ack_committed(commit_id, changes):
+                # the responses of committed releases are needed to
+                # rebuild the repository, so they are written first
+                if archive is not None:
+                    flush_archive(archive.flush)
+                if feed is None:
+                    ack_releases(scheduler, uncommitted[store])
+                else:
+                    feed.add(commit_id, changes)
+                    unpublished[commit_id] = list(uncommitted[store])
+                    publish_changes()
+                uncommitted[store].clear()
+
+            store.on_commit = ack_committed
+        if feed is not None and list_name not in caught_up:
+            published = feed.catch_up(LISTS_PROCESS[BLOCKS[list_name]], store.repo, git_directory)
+            if published:
+                print(f"Published {published} missing change events for {list_name}",
+                      file=sys.stderr)
+            caught_up.add(list_name)
+        return store, git_directory, index
+
+    def discard_lost():
+        # another crawler now writes to the blocks of which the lease
+        # was lost, so their changes are dropped and crawled again
+        for store, releases in uncommitted.items():
+            held = {list_name: scheduler.holds(list_name) for list_name, _ in releases}
+            lost = [release for release in releases if not held[release[0]]]
+            if not lost:
+                continue
+            store.discard([identifier for _, identifier in lost])
+            if feed is not None:
+                feed.discard([identifier for _, identifier in lost])
+            releases[:] = [release for release in releases if held[release[0]]]
+            release_releases(scheduler, lost)
 
-    # first check if the file has changed. If not, then don't add
-    # the file. Git has some intelligence built-in which prevents
-    # unchanged files to be committed again, which Dulwich
-    # doesn't seem to implement.
-    if (git_directory / json_filename).exists():
-        new_file = False
-        with open(git_directory / json_filename, 'r') as json_file:
-            existing_json = json.load(json_file)
-            if existing_json == json_data:
-                return
+    while True:
+        try:
+            item = store_queue.get(timeout=1)
+        except queue.Empty:
+            item = False
+        if item is None:
+            # commit anything that is still pending before exiting
+            try:
+                discard_lost()
+                stores.close()
+            except Exception as e:
+                discogs_metrics.increment('errors', 'store')
+                print("Cannot store releases", e, file=sys.stderr)
+            break
+        try:
+            discard_lost()
+            if feed is not None and unpublished:
+                publish_changes()
+            if item:
+                list_name, identifier, json_data = item
+                if not scheduler.holds(list_name):
+                    scheduler.release(list_name, [identifier])
+                else:
+                    store_item(item, open_block, uncommitted, scheduler, removes, layout, feed)
+
+            # commit the changes for blocks without any work left, so the
+            # release numbers are acknowledged and the block can be released.
+            # This is only done once all the remaining releases of the block
+            # were handed over, so they end up in a single commit.
+            for list_name in scheduler.draining():
+                store = open_block(list_name)[0]
+                waiting = sum(1 for name, _ in uncommitted[store] if name == list_name)
+                if waiting >= scheduler.inflight(list_name):
+                    store.flush()
+            stores.flush_if_due()
+            if archive is not None:
+                flush_archive(archive.flush_if_due)
+        except Exception as e:
+            discogs_metrics.increment('errors', 'store')
+            print("Cannot store release", e, file=sys.stderr)
 
-    # write to a file in the correct Git directory
-    with open(git_directory / json_filename, 'w') as json_file:
-        json.dump(json_data, json_file, sort_keys=True, indent=4)
 
-    # add the file and commit
-    dulwich.porcelain.add(repo, git_directory / json_filename)
-    if new_file:
-        dulwich.porcelain.commit(repo, f"Add {json_data['id']}", committer=AUTHOR, author=AUTHOR)
-    else:
-        dulwich.porcelain.commit(repo, f"Update {json_data['id']}", committer=AUTHOR, author=AUTHOR)
+def store_item(item, open_block, uncommitted, scheduler, removes, layout, feed):
+    '''Store a single release (or remove it, if there is no JSON data).
+       If that fails the release number is returned to the queue, unless
+       the change was queued for the next commit already (and only the
+       commit failed), so the release is crawled again.'''
+    list_name, identifier, json_data = item
+    store = None
+    try:
+        store, git_directory, index = open_block(list_name)
+        uncommitted[store].append((list_name, identifier))
+        if json_data is None:
+            changed = delete_release(identifier, git_directory, store, index, layout)
+        else:
+            changed = process_json(json_data, removes, git_directory, store, index, layout, feed)
+    except Exception:
+        if store is None or identifier not in store.pending_releases:
+            if store is not None and uncommitted[store][-1:] == [(list_name, identifier)]:
+                uncommitted[store].pop()
+            scheduler.release(list_name, [identifier])
+        raise
+    if not changed:
+        uncommitted[store].pop()
+        scheduler.ack(list_name, [identifier])
+
 
 @click.command(short_help='Continuously grab data from the Discogs API and store in Git')
 @click.option('--config-file', '-c', required=True, help='configuration file (YAML)',
@@ -197,25 +530,198 @@ def process_json(json_data, removes, git_directory, repo, remove_thumbnails=True
 @click.option('-u', '--user', help='User name (override config)')
 @click.option('-t', '--token', help='Token (override config)')
 @click.option('-l', '--list', 'redis_list_number', type=click.IntRange(min=1, max=90),
-              required=True, help='Redis list number (1-90)')
-def main(config_file, verbose, git, user, token, redis_list_number):
+              help='Redis list number (1-90), default: take work from all lists')
+@click.option('--queue', 'queue_backend', type=click.Choice(discogs_queue.BACKENDS),
+              help='Queue backend (override config)')
+@click.option('-n', '--concurrency', type=click.IntRange(min=1),
+              help='Number of requests in flight (override config)')
+@click.option('--batch-size', type=click.IntRange(min=1),
+              help='Number of changed releases per Git commit (override config)')
+@click.option('--batch-interval', type=click.FloatRange(min=0),
+              help='Maximum seconds before committing changes (override config)')
+@click.option('--metrics-port', type=click.IntRange(min=1, max=65535),
+              help='Port to serve metrics on (override config)')
+@click.option('--archive', 'archive_directory', type=click.Path(file_okay=False, path_type=pathlib.Path),
+              help='Directory to archive the raw responses in (override config)')
+@click.option('--publish-changes/--no-publish-changes', default=None,
+              help='Publish change events for committed releases (override config)')
+@click.option('--tombstones', 'tombstone_file', type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help='File to record removed releases in (override config)')
+def main(config_file, verbose, git, user, token, redis_list_number, queue_backend, concurrency,
+         batch_size, batch_interval, metrics_port, archive_directory, publish_changes,
+         tombstone_file):
     # read the configuration file. This is in YAML format
     removes = []
+    remove_thumbnails = True
 
     discogs_git = None
     discogs_user = None
     discogs_token = None
 
+    # location of the Discogs API (can be changed for testing)
+    discogs_api = DISCOGS_API
+
+    # number of concurrent requests to Discogs
+    discogs_concurrency = 1
+
+    # time to sleep when Discogs reports that no more requests are allowed
+    rate_limit_backoff = 5
+
+    # rate limiting: the store that is used to share the rate limit
+    # between crawlers, the fraction of the rate limit reported by
+    # Discogs that is used, and the number of requests that can be
+    # sent in a burst.
+    rate_limit_store = 'redis'
+    rate_limit_fill_ratio = 0.95
+    rate_limit_burst = 1
+
+    # maximum number of downloaded releases waiting to be stored
+    store_queue_size = 100
+
+    # queue backend (redis or sqlite), the location of the
+    # SQLite queue and the Redis server
+    queue_config_backend = 'redis'
+    queue_file = pathlib.Path(discogs_queue.DEFAULT_QUEUE_FILE)
+    redis_host = 'localhost'
+    redis_port = 6379
+
+    # number of release numbers claimed from the queue in one go and
+    # the time after which release numbers claimed by a crawler that
+    # stopped are returned to the queue
+    queue_batch_size = discogs_queue.DEFAULT_BATCH_SIZE
+    queue_visibility_timeout = discogs_queue.DEFAULT_VISIBILITY_TIMEOUT
+
+    # port to serve metrics on (none by default) and the interval (in
+    # seconds) for updating the queue depth and logging statistics
+    # (with --verbose)
+    metrics_config_port = None
+    metrics_interval = 60
+
+    # number of blocks a crawler works on at the same time
+    # when it is not configured to use a single list
+    queue_blocks = 1
+
+    # publish change events for committed releases to the change
+    # logs in the queue (see discogs_changes.py)
+    queue_publish_changes = False
+
+    # number of changed releases per commit and maximum
+    # time (in seconds) that a change is left uncommitted
+    git_batch_size = 1
+    git_batch_interval = None
+
+    # layout of the releases in the repository and whether
+    # to use a single repository or a repository per block
+    git_layout = 'flat'
+    git_repository_mode = 'single'
+
+    # keep an index of the hashes of the stored releases
+    use_index = True
+    index_file = None
+
+    # remove releases that no longer exist from Git
+    git_remove_deleted = False
+
+    # file to record removed releases in (none by default)
+    tombstone_config_file = None
+
+    # archive of the raw responses (none by default), the compression
+    # that is used and the size (in MiB) at which segments are rotated
+    archive_config_directory = None
+    archive_compression = 'gzip'
+    archive_segment_size = discogs_archive.DEFAULT_SEGMENT_SIZE // (1024 * 1024)
+
     try:
         config = load(config_file, Loader=Loader)
         if 'fields' in config:
             if 'remove' in config['fields']:
                 for remove_item in config['fields']['remove']:
                     removes.append(remove_item)
-    except (YAMLError, PermissionError, UnicodeDecodeError) as e:
+            if 'remove_thumbnails' in config['fields']:
+                remove_thumbnails = bool(config['fields']['remove_thumbnails'])
+        if 'git' in config:
+            if 'batch_size' in config['git']:
+                git_batch_size = int(config['git']['batch_size'])
+            if 'batch_interval' in config['git']:
+                git_batch_interval = float(config['git']['batch_interval'])
+            if 'layout' in config['git']:
+                git_layout = config['git']['layout']
+                if git_layout not in discogs_storage.LAYOUTS:
+                    raise ValueError(f"invalid layout {git_layout}")
+            if 'repository' in config['git']:
+                git_repository_mode = config['git']['repository']
+                if git_repository_mode not in discogs_storage.REPOSITORY_MODES:
+                    raise ValueError(f"invalid repository mode {git_repository_mode}")
+            if 'index' in config['git']:
+                use_index = bool(config['git']['index'])
+            if 'index_file' in config['git']:
+                index_file = pathlib.Path(config['git']['index_file'])
+            if 'remove_deleted' in config['git']:
+                git_remove_deleted = bool(config['git']['remove_deleted'])
+        if 'queue' in config:
+            if 'backend' in config['queue']:
+                queue_config_backend = config['queue']['backend']
+                if queue_config_backend not in discogs_queue.BACKENDS:
+                    raise ValueError(f"invalid queue backend {queue_config_backend}")
+            if 'file' in config['queue']:
+                queue_file = pathlib.Path(config['queue']['file'])
+            if 'batch_size' in config['queue']:
+                queue_batch_size = int(config['queue']['batch_size'])
+            if 'visibility_timeout' in config['queue']:
+                queue_visibility_timeout = int(config['queue']['visibility_timeout'])
+            if 'blocks' in config['queue']:
+                queue_blocks = int(config['queue']['blocks'])
+            if 'publish_changes' in config['queue']:
+                queue_publish_changes = bool(config['queue']['publish_changes'])
+            if 'tombstone_file' in config['queue']:
+                tombstone_config_file = pathlib.Path(config['queue']['tombstone_file'])
+        if 'archive' in config:
+            if 'directory' in config['archive']:
+                archive_config_directory = pathlib.Path(config['archive']['directory'])
+            if 'compression' in config['archive']:
+                archive_compression = config['archive']['compression']
+                discogs_archive.check_compression(archive_compression)
+            if 'segment_size' in config['archive']:
+                archive_segment_size = int(config['archive']['segment_size'])
+        if 'metrics' in config:
+            if 'port' in config['metrics']:
+                metrics_config_port = int(config['metrics']['port'])
+            if 'interval' in config['metrics']:
+                metrics_interval = float(config['metrics']['interval'])
+        if 'redis' in config:
+            if 'host' in config['redis']:
+                redis_host = config['redis']['host']
+            if 'port' in config['redis']:
+                redis_port = int(config['redis']['port'])
+        if 'api' in config:
+            if 'url' in config['api']:
+                discogs_api = config['api']['url'].rstrip('/')
+            if 'concurrency' in config['api']:
+                discogs_concurrency = int(config['api']['concurrency'])
+            if 'rate_limit_backoff' in config['api']:
+                rate_limit_backoff = int(config['api']['rate_limit_backoff'])
+            if 'store_queue_size' in config['api']:
+                store_queue_size = int(config['api']['store_queue_size'])
+            if 'rate_limit' in config['api']:
+                rate_limit_config = config['api']['rate_limit']
+                if 'store' in rate_limit_config:
+                    rate_limit_store = rate_limit_config['store']
+                    if rate_limit_store not in discogs_rate_limit.STORES:
+                        raise ValueError(f"invalid rate limit store {rate_limit_store}")
+                if 'fill_ratio' in rate_limit_config:
+                    rate_limit_fill_ratio = float(rate_limit_config['fill_ratio'])
+                if 'burst' in rate_limit_config:
+                    rate_limit_burst = int(rate_limit_config['burst'])
+    except (YAMLError, PermissionError, UnicodeDecodeError, ValueError) as e:
         print(f"Cannot open configuration file, exiting, {e}", file=sys.stderr)
         sys.exit(1)
 
+    # compile the fields to remove, so they can be
+    # removed in a single pass over each release
+    if remove_thumbnails:
+        removes += discogs_fields.THUMBNAIL_FIELDS
+    removes = discogs_fields.compile_removes(removes)
+
     # override the configuration using commandline options.
     if user is not None:
         discogs_user = user
@@ -226,6 +732,30 @@ def main(config_file, verbose, git, user, token, redis_list_number):
     if git is not None:
         discogs_git = git
 
+    if concurrency is not None:
+        discogs_concurrency = concurrency
+
+    if queue_backend is None:
+        queue_backend = queue_config_backend
+
+    if metrics_port is None:
+        metrics_port = metrics_config_port
+
+    if archive_directory is None:
+        archive_directory = archive_config_directory
+
+    if publish_changes is None:
+        publish_changes = queue_publish_changes
+
+    if tombstone_file is None:
+        tombstone_file = tombstone_config_file
+
+    if batch_size is not None:
+        git_batch_size = batch_size
+
+    if batch_interval is not None:
+        git_batch_interval = batch_interval
+
     if discogs_user is None:
         print("User name not supplied in either configuration or command line, exiting",
               file=sys.stderr)
@@ -241,25 +771,36 @@ def main(config_file, verbose, git, user, token, redis_list_number):
               file=sys.stderr)
         sys.exit(1)
 
-    # verify there is a valid Git repository
+    # verify there is a valid Git repository and open the repository
+    # and the directory that are used for the releases in the list.
+    # Without a list repositories are opened when a block is first used.
+    stores = BlockStores(discogs_git, git_repository_mode, batch_size=git_batch_size,
+                         batch_interval=git_batch_interval, use_index=use_index,
+                         index_file=index_file)
     try:
-        repo = dulwich.porcelain.open_repo(discogs_git)
+        if redis_list_number is not None:
+            stores.open(redis_list_number)
+        elif git_repository_mode == 'single':
+            dulwich.repo.Repo(discogs_git)
     except dulwich.errors.NotGitRepository:
         print(f"{git} is not a valid Git repository, exiting", file=sys.stderr)
         sys.exit(1)
 
-    redis_host = 'localhost'
-    redis_port = 6379
-
-    # first check if redis is running or not
-    try:
-        redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+    # Redis is only needed when it is used for the queue. Without Redis
+    # the rate limit is shared with the other crawlers using a file.
+    redis_client = None
+    if queue_backend == 'redis':
+        # first check if redis is running or not
+        try:
+            redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
 
-        # check if Redis is running
-        redis_client.ping()
-    except redis.exceptions.ConnectionError as e:
-        print("Cannot connect to Redis server", e, file=sys.stderr)
-        sys.exit(1)
+            # check if Redis is running
+            redis_client.ping()
+        except redis.exceptions.ConnectionError as e:
+            print("Cannot connect to Redis server", e, file=sys.stderr)
+            sys.exit(1)
+    elif rate_limit_store == 'redis':
+        rate_limit_store = 'file'
 
     # set the User Agent and Authorization header for each user request
     user_agent_string = f"DiscogsCrawlerForUser-{user}/0.1"
@@ -267,90 +808,138 @@ def main(config_file, verbose, git, user, token, redis_list_number):
                'Authorization': f'Discogs token={token}'
               }
 
-    # use a (somewhat) exponential backoff in case too many requests have been made
-    rate_limit_backoff = 5
-
-    redis_list = LISTS_READ[redis_list_number]
-
-    discogs_git_directory = discogs_git / str(redis_list_number)
-    if discogs_git_directory.exists():
-        pass
-    else:
-        discogs_git_directory.mkdir()
-
-    current_identifier = None
+    # share a pool of keep-alive connections between all fetch threads
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=discogs_concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    # requests are paced using a token bucket, which is shared
+    # between all crawlers that use the same token
+    rate_limiter = discogs_rate_limit.open_rate_limiter(rate_limit_store, discogs_token,
+                                                       redis_client=redis_client,
+                                                       fill_ratio=rate_limit_fill_ratio,
+                                                       burst=rate_limit_burst,
+                                                       backoff=rate_limit_backoff)
+
+    # release numbers are claimed in batches and only removed
+    # from the queue once they have been processed
+    try:
+        work_queue = discogs_queue.open_queue(queue_backend, redis_client=redis_client,
+                                              queue_file=queue_file,
+                                              visibility_timeout=queue_visibility_timeout)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot open queue", e, file=sys.stderr)
+        sys.exit(1)
 
-    # continuously grab an identifier from Redis
-    while True:
+    # raw responses are archived, so the repository can be rebuilt
+    # without downloading everything again
+    archive = None
+    if archive_directory is not None:
         try:
-            if current_identifier is None:
-                identifier = int(redis_client.lpop(redis_list))
-            else:
-                identifier = current_identifier
-        except ValueError as e:
-            print("Invalid data received from Redis server, exiting", e, file=sys.stderr)
+            archive = discogs_archive.ArchiveWriter(archive_directory, archive_compression,
+                                                    segment_size=archive_segment_size * 1024 * 1024)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Cannot open archive {archive_directory}, exiting", e, file=sys.stderr)
             sys.exit(1)
-        except IndexError as e:
-            print(f"End, exiting: {e}", file=sys.stderr)
+
+    # removed releases are recorded, so they are not queued again
+    tombstones = None
+    if tombstone_file is not None:
+        try:
+            tombstones = discogs_tombstones.TombstoneStore(tombstone_file)
+        except sqlite3.Error as e:
+            print(f"Cannot open tombstones {tombstone_file}, exiting", e, file=sys.stderr)
             sys.exit(1)
 
-        default_sleep = 60
+    stop = threading.Event()
+    failed = threading.Event()
 
+    # a crawler either takes work from a single list, or from the lists
+    # with the largest backlog. In both cases a lease is taken on a
+    # block, so only a single crawler writes to a block at a time.
+    if redis_list_number is not None:
+        scheduler = discogs_queue.Scheduler(work_queue, [LISTS_READ[redis_list_number]], leases=True,
+                                            batch_size=queue_batch_size, wait=EMPTY_QUEUE_WAIT,
+                                            stop=stop)
+    else:
+        scheduler = discogs_queue.Scheduler(work_queue, LISTS_READ.values(), leases=True,
+                                            max_blocks=queue_blocks, batch_size=queue_batch_size,
+                                            wait=EMPTY_QUEUE_WAIT, stop=stop)
+
+    # the leases and heartbeats are renewed in a separate thread, so
+    # they do not expire while all fetch threads are waiting
+    scheduler.start()
+
+    # downloaded releases are handed to a single storage thread
+    # using a bounded queue, so downloading does not have to wait
+    # for writing files and committing to Git.
+    store_queue = queue.Queue(maxsize=store_queue_size)
+
+    feed = None
+    if publish_changes:
+        feed = discogs_changes.ChangeFeed(work_queue)
+
+    storage_thread = threading.Thread(target=store_releases,
+                                      args=(store_queue, scheduler, removes, stores, git_layout,
+                                            feed, archive))
+    storage_thread.start()
+
+    # expose the metrics and periodically log statistics
+    if metrics_port is not None:
         try:
-            # grab stuff from Discogs
-            request = requests.get(f'https://api.discogs.com/releases/{identifier}',
-                                   headers=headers)
-
-            # now first check the headers to see if it is OK to do more requests
-            if request.status_code != 200:
-                if request.status_code == 401:
-                    print("Denied by Discogs, exiting", file=sys.stderr)
-                    sys.exit(1)
-                elif request.status_code == 404:
-                    # TODO: record discogs entries that have been removed
-                    pass
-                elif request.status_code == 429:
-                    if 'Retry-After' in request.headers:
-                        try:
-                            retry_after = int(request.headers['Retry-After'])
-                            print(f"Rate limiting, sleeping for {retry_after} seconds",
-                                  file=sys.stderr)
-                            time.sleep(retry_after)
-                            sys.stderr.flush()
-                        except:
-                            print(f"Rate limiting, sleeping for {default_sleep} seconds",
-                                  file=sys.stderr)
-                            time.sleep(default_sleep)
-                            sys.stderr.flush()
-                    else:
-                        print(f"Rate limiting, sleeping for {default_sleep} seconds",
-                              file=sys.stderr)
-                        time.sleep(default_sleep)
-                        sys.stderr.flush()
-
-                continue
+            discogs_metrics.serve(metrics_port)
+        except OSError as e:
+            print(f"Cannot serve metrics on port {metrics_port}", e, file=sys.stderr)
+    if metrics_interval > 0:
+        reporter = threading.Thread(target=discogs_metrics.report,
+                                    args=(stop, metrics_interval),
+                                    kwargs={'queue_depth': lambda: work_queue.lengths(scheduler.list_names),
+                                            'log': verbose},
+                                    daemon=True)
+        reporter.start()
+
+    # stop cleanly (committing pending changes) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    fetch_threads = []
+    for _ in range(discogs_concurrency):
+        fetch_thread = threading.Thread(target=fetch_releases,
+                                        args=(session, discogs_api, scheduler, store_queue,
+                                              rate_limiter, stop, failed, archive, tombstones,
+                                              git_remove_deleted),
+                                        daemon=True)
+        fetch_thread.start()
+        fetch_threads.append(fetch_thread)
 
-            # in case there is no 429 response check the headers
-            if 'X-Discogs-Ratelimit-Remaining' in request.headers:
-                rate_limit = int(request.headers['X-Discogs-Ratelimit-Remaining'])
-            if rate_limit == 0:
-                # no more requests are allowed, so sleep for some
-                # time, max 60 seconds
-                print(f"Rate limiting, sleeping for {rate_limit_backoff} seconds", file=sys.stderr)
-                sys.stderr.flush()
-                time.sleep(rate_limit_backoff)
-
-                if rate_limit_backoff < default_sleep:
-                    rate_limit_backoff = min(default_sleep, rate_limit_backoff * 2)
-            else:
-                rate_limit_backoff = 5
+    try:
+        for fetch_thread in fetch_threads:
+            fetch_thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for fetch_thread in fetch_threads:
+            fetch_thread.join()
+
+    # store everything that was already downloaded and return
+    # the release numbers that were not downloaded to the queue
+    store_queue.put(None)
+    storage_thread.join()
+    if archive is not None:
+        try:
+            archive.close()
+        except (OSError, sqlite3.Error) as e:
+            print("Cannot write archive", e, file=sys.stderr)
+    if tombstones is not None:
+        tombstones.close()
+    try:
+        scheduler.close()
+        work_queue.close()
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot connect to queue", e, file=sys.stderr)
 
-            json_data = request.json()
-            process_json(json_data, removes, discogs_git_directory, repo)
-            current_identifier = None
-        except Exception as e:
-            #print(e)
-            pass
+    if failed.is_set():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Archive of the raw responses of the Discogs API, so the Git repository
+# can be rebuilt (for example with different fields removed) without
+# crawling Discogs again, see discogs_replay.py.
+#
+# The archive is a directory with segments: compressed (gzip or zstd)
+# JSON Lines files with a line per response:
+#
+#   {"id": <release number>, "fetched": <timestamp>, "release": <response>}
+#
+# Responses are compressed in chunks, every chunk being a separate gzip
+# member or zstd frame, so a segment can be decompressed as a whole with
+# the standard tools, but a single chunk can also be read. Segments are
+# rotated once they reach the configured size.
+#
+# The location (segment, offset and length of the chunk) of every
+# response is recorded in an index (SQLite) in the archive directory.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import gzip
+import json
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+
+import discogs_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ['gzip', 'zstd']
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+INDEX_FILE = 'index.sqlite'
+
+# segments are rotated once they reach this size (in bytes)
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# responses are compressed in chunks of (at least) this size (in bytes,
+# before compression), unless the chunk is older than the flush interval
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 60
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def segment_compression(segment):
+    '''Compression of a segment, derived from its name'''
+    for compression, extension in EXTENSIONS.items():
+        if segment.endswith(extension):
+            return compression
+    raise ValueError(f"unknown archive segment {segment}")
+
+
+def check_compression(compression):
+    '''Raise ValueError if a compression is not supported'''
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"invalid compression {compression}")
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard module")
+
+
+def open_index(directory):
+    '''Open (and create if needed) the index of an archive'''
+    connection = sqlite3.connect(pathlib.Path(directory) / INDEX_FILE, timeout=60,
+                                 check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS records
+                          (release_id INTEGER NOT NULL, fetched REAL NOT NULL,
+                           segment TEXT NOT NULL, offset INTEGER NOT NULL,
+                           length INTEGER NOT NULL)''')
+    connection.execute('CREATE INDEX IF NOT EXISTS records_release ON records (release_id, fetched)')
+    connection.commit()
+    return connection
+
+
+class ArchiveWriter:
+    '''Append raw responses to the segments of an archive. Can be shared
+       by several threads. Several processes can write to the same archive,
+       as every process writes to its own segments.'''
+    def __init__(self, directory, compression='gzip', segment_size=DEFAULT_SEGMENT_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        check_compression(compression)
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.index = open_index(self.directory)
+
+        self.segment = None
+        self.segment_name = None
+        self.segments = 0
+
+        # lines and (release number, time fetched) of the current chunk
+        self.chunk = []
+        self.chunk_records = []
+        self.chunk_bytes = 0
+        self.chunk_since = None
+
+    def add(self, release_id, content, fetched=None):
+        '''Add the raw response (bytes) for a release'''
+        if fetched is None:
+            fetched = time.time()
+        if b'\n' in content or b'\r' in content:
+            # keep a single response on a single line
+            content = json.dumps(discogs_json.loads(content)).encode()
+        line = b'{"id": %d, "fetched": %.3f, "release": %s}\n' % (release_id, fetched, content)
+        with self.lock:
+            if not self.chunk:
+                self.chunk_since = time.monotonic()
+            self.chunk.append(line)
+            self.chunk_records.append((release_id, fetched))
+            self.chunk_bytes += len(line)
+            if self.chunk_bytes >= self.chunk_size or \
+               time.monotonic() - self.chunk_since >= self.flush_interval:
+                self._write_chunk()
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+        self.segments += 1
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+        self.segment_name = (f"releases-{time.strftime('%Y%m%d%H%M%S')}-{worker}-{self.segments:04d}"
+                             f"{EXTENSIONS[self.compression]}")
+        self.segment = open(self.directory / self.segment_name, 'ab')
+
+    def _write_chunk(self):
+        data = compress(b''.join(self.chunk), self.compression)
+        if self.segment is None or (self.segment.tell() and
+                                    self.segment.tell() + len(data) > self.segment_size):
+            self._open_segment()
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.segment.flush()
+
+        # the chunk is only recorded in the index once it has been written
+        with self.index:
+            self.index.executemany('''INSERT INTO records (release_id, fetched, segment, offset, length)
+                                      VALUES (?, ?, ?, ?, ?)''',
+                                   [(release_id, fetched, self.segment_name, offset, len(data))
+                                    for release_id, fetched in self.chunk_records])
+        self.chunk = []
+        self.chunk_records = []
+        self.chunk_bytes = 0
+        self.chunk_since = None
+
+    def flush_if_due(self):
+        '''Write the current chunk if it is older than the flush interval,
+           so responses are not kept in memory when no more are added'''
+        with self.lock:
+            if self.chunk and time.monotonic() - self.chunk_since >= self.flush_interval:
+                self._write_chunk()
+
+    def flush(self):
+        '''Write the current chunk'''
+        with self.lock:
+            if self.chunk:
+                self._write_chunk()
+
+    def close(self):
+        self.flush()
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+
+def read_chunk(directory, segment, offset, length):
+    '''Read a chunk from a segment, returns a list of records (dicts
+       with the release number, time fetched and response)'''
+    with open(pathlib.Path(directory) / segment, 'rb') as segment_file:
+        segment_file.seek(offset)
+        data = decompress(segment_file.read(length), segment_compression(segment))
+    return [discogs_json.loads(line) for line in data.splitlines()]
+
+
+def archive_blocks(index):
+    '''Return the blocks (of a million release numbers) of the releases
+       in an archive, in order'''
+    cursor = index.execute('SELECT DISTINCT (release_id + 999999) / 1000000 FROM records')
+    return sorted(block for block, in cursor)
+
+
+def latest_chunks(index):
+    '''Generator yielding (segment, offset, length, release numbers) for
+       every chunk that contains the latest response of a release, in the
+       order of the segments, so segments are read sequentially'''
+    cursor = index.execute('''SELECT segment, offset, length, release_id FROM records r
+                              WHERE NOT EXISTS (SELECT 1 FROM records n
+                                                WHERE n.release_id = r.release_id
+                                                AND n.fetched > r.fetched)
+                              ORDER BY segment, offset''')
+    chunk = None
+    release_ids = set()
+    for segment, offset, length, release_id in cursor:
+        if (segment, offset, length) != chunk:
+            if chunk is not None:
+                yield chunk + (release_ids,)
+            chunk = (segment, offset, length)
+            release_ids = set()
+        release_ids.add(release_id)
+    if chunk is not None:
+        yield chunk + (release_ids,)
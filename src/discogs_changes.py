@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+# Change feed: after every commit the crawler publishes an event for every
+# added, updated or deleted release to the change log (see discogs_queue.py)
+# of the block of the release ('process-1M', 'process-2M', ...), so
+# processing scripts do not have to find the changed releases with
+# 'git diff' on the complete repository. An event is a JSON object:
+#
+#   {"id": 1234, "type": "update", "commit": "<sha>", "fields": ["notes"]}
+#
+# with the top-level fields of the release that were added, changed or
+# removed (all fields for a new release, none for a deleted release).
+#
+# Every consumer of a change log has its own offset, which is stored with
+# the change log, and is updated after the events have been printed.
+#
+# With the events of a commit the commit is recorded as the last published
+# commit of the change log. If the crawler stopped after a commit, but
+# before the events were published, the events are published when the
+# block is used again, from the difference between the last published
+# commit and HEAD (with HEAD as the commit of the events).
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import collections
+import json
+import math
+import pathlib
+import sys
+import time
+
+import click
+import dulwich.diff_tree
+import dulwich.object_store
+import redis
+
+import discogs_index
+import discogs_json
+import discogs_queue
+
+# change logs for the blocks of 1M releases
+LISTS_PROCESS = {block: f'process-{block}M' for block in range(1, 112)}
+
+# change types in Git (see discogs_storage.GitStore) -> event types.
+# Moved releases did not change, so no events are published for them.
+EVENT_TYPES = {'Add': 'add', 'Update': 'update', 'Delete': 'delete'}
+
+# default number of events read in one go
+DEFAULT_READ_SIZE = 1000
+
+# time to sleep between checks of an empty change log when following it
+FOLLOW_INTERVAL = 5
+
+
+def process_list(release_id):
+    '''Name of the change log for the block of a release'''
+    return LISTS_PROCESS[math.ceil(release_id/1000000)]
+
+
+def changed_fields(old_data, new_data):
+    '''Top-level fields that differ between two serialized versions of
+       a release (bytes, old_data is None for a new release)'''
+    new_release = discogs_json.loads(new_data)
+    if old_data is None:
+        return sorted(new_release)
+    old_release = discogs_json.loads(old_data)
+    return sorted(field for field in old_release.keys() | new_release.keys()
+                  if field not in old_release or field not in new_release
+                  or old_release[field] != new_release[field])
+
+
+def make_event(release_id, change_type, commit_id, fields):
+    return json.dumps({'id': release_id, 'type': change_type, 'commit': commit_id,
+                       'fields': sorted(fields)})
+
+
+def block_changes(repo, directory, old_commit, new_commit):
+    '''Generator yielding (release number, old blob id, new blob id) for
+       the releases in a directory of a repository that differ between two
+       commits. The blob id is None if the release is not in the commit.
+       old_commit can be None (the empty repository).'''
+    object_store = repo.object_store
+    prefix = pathlib.Path(directory).resolve().relative_to(pathlib.Path(repo.path).resolve())
+    prefix = prefix.as_posix().encode()
+
+    def subtree(commit_id):
+        if commit_id is None:
+            return None
+        tree_id = object_store[commit_id].tree
+        if prefix == b'.':
+            return tree_id
+        try:
+            return dulwich.object_store.tree_lookup_path(object_store.__getitem__, tree_id, prefix)[1]
+        except KeyError:
+            return None
+
+    # release number -> [old blob id, new blob id]. Releases that moved
+    # (see discogs_migrate.py) are removed and added with the same blob.
+    blobs = {}
+    for change in dulwich.diff_tree.tree_changes(object_store, subtree(old_commit),
+                                                 subtree(new_commit)):
+        for position, entry in enumerate([change.old, change.new]):
+            if entry is None or entry.path is None:
+                continue
+            match = discogs_index.RELEASE_FILE.search(entry.path)
+            if match is not None:
+                blobs.setdefault(int(match.group(1)), [None, None])[position] = entry.sha
+    for release_id, (old_blob, new_blob) in sorted(blobs.items()):
+        if old_blob != new_blob:
+            yield release_id, old_blob, new_blob
+
+
+class ChangeFeed:
+    '''Publish change events for committed releases. The changed fields
+       are recorded when a release is stored, the events are published
+       once the release has been committed (see GitStore.on_commit).
+       Events that cannot be published are kept, and are published
+       (in order of the commits) by the next call to publish().'''
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+
+        # release number -> changed top-level fields, for uncommitted releases
+        self.fields = {}
+
+        # (commit id, change log -> events) for the commits of
+        # which the events were not published yet, in order
+        self.unpublished = collections.deque()
+
+    def record(self, release_id, fields):
+        '''Record the changed fields of a release that will be committed.
+           A release that is changed more than once before it is committed
+           gets the fields of all changes.'''
+        self.fields.setdefault(release_id, set()).update(fields)
+
+    def discard(self, release_ids):
+        '''Forget the changed fields of releases that will not be committed'''
+        for release_id in release_ids:
+            self.fields.pop(release_id, None)
+
+    def add(self, commit_id, changes):
+        '''Create the events for the changes (see GitStore.pending) in a
+           commit. The events are sent by publish().'''
+        events = {}
+        for release_id, change_type, _ in changes.values():
+            fields = self.fields.pop(release_id, set())
+            if change_type not in EVENT_TYPES:
+                continue
+            if change_type == 'Delete':
+                fields = set()
+            event = make_event(release_id, EVENT_TYPES[change_type], commit_id.decode(), fields)
+            events.setdefault(process_list(release_id), []).append(event)
+        self.unpublished.append((commit_id, events))
+
+    def publish(self):
+        '''Publish the events of the commits that were not published yet.
+           Returns the ids of the commits of which all events have been
+           published. Raises an error from the queue if the events of a
+           commit cannot be published, the events of this and later
+           commits are then kept.'''
+        published = []
+        while self.unpublished:
+            commit_id, events = self.unpublished[0]
+            for list_name in list(events):
+                self.work_queue.publish(list_name, events[list_name], commit_id.decode())
+                # not published again if another change log fails
+                del events[list_name]
+            self.unpublished.popleft()
+            published.append(commit_id)
+        return published
+
+    def catch_up(self, list_name, repo, directory):
+        '''Publish the events for the releases of a block (stored in a
+           directory of a repository) that were committed after the last
+           published commit of its change log. Returns the number of
+           published events.'''
+        try:
+            head = repo.refs[b'HEAD']
+        except KeyError:
+            head = None
+        last = self.work_queue.published(list_name)
+        if last is None:
+            # nothing was published for the block yet, so there is
+            # nothing to catch up with: start at the current HEAD
+            self.work_queue.init_published(list_name, '' if head is None else head.decode())
+            return 0
+        last = last.encode() or None
+        if last == head or head is None:
+            return 0
+        try:
+            changes = list(block_changes(repo, directory, last, head))
+        except KeyError:
+            print(f"Last published commit {last.decode()} of {list_name} not found", file=sys.stderr)
+            changes = []
+
+        events = []
+        for release_id, old_blob, new_blob in changes:
+            if new_blob is None:
+                events.append(make_event(release_id, 'delete', head.decode(), []))
+                continue
+            old_data = None if old_blob is None else repo.object_store[old_blob].as_raw_string()
+            new_data = repo.object_store[new_blob].as_raw_string()
+            events.append(make_event(release_id, 'update' if old_data is not None else 'add',
+                                     head.decode(), changed_fields(old_data, new_data)))
+        self.work_queue.publish(list_name, events, '' if head is None else head.decode())
+        return len(events)
+
+
+def open_work_queue(queue_backend, queue_file, redis_host, redis_port):
+    '''Open the queue with the change logs, exit if it cannot be opened'''
+    redis_client = None
+    try:
+        if queue_backend == 'redis':
+            redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+
+            # check if Redis is running
+            redis_client.ping()
+        return discogs_queue.open_queue(queue_backend, redis_client=redis_client,
+                                        queue_file=queue_file)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot open queue", e, file=sys.stderr)
+        sys.exit(1)
+
+
+def queue_options(func):
+    '''Options to select the queue and the change logs'''
+    options = [click.option('--queue', 'queue_backend', default='redis',
+                            help='queue backend (default: redis)',
+                            type=click.Choice(discogs_queue.BACKENDS)),
+               click.option('--queue-file', default=discogs_queue.DEFAULT_QUEUE_FILE,
+                            help=f'SQLite queue (default: {discogs_queue.DEFAULT_QUEUE_FILE})',
+                            type=click.Path(path_type=pathlib.Path)),
+               click.option('--redis-host', default='localhost', help='Redis host (default: localhost)'),
+               click.option('--redis-port', default=6379, help='Redis port (default: 6379)', type=int),
+               click.option('-l', '--list', 'list_numbers', type=click.IntRange(min=1, max=111),
+                            multiple=True, help='list number (1-111), default: all lists')]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+@click.group(short_help='read the change events published by the crawlers')
+def cli():
+    pass
+
+
+@cli.command(short_help='print new change events (JSON Lines) for a consumer')
+@queue_options
+@click.option('--consumer', required=True, help='name of the consumer')
+@click.option('--count', '-n', default=DEFAULT_READ_SIZE, type=click.IntRange(min=1),
+              help=f'number of events read in one go (default: {DEFAULT_READ_SIZE})')
+@click.option('--follow', '-f', is_flag=True, default=False, help='keep waiting for new events')
+def read(queue_backend, queue_file, redis_host, redis_port, list_numbers, consumer, count, follow):
+    work_queue = open_work_queue(queue_backend, queue_file, redis_host, redis_port)
+    list_names = [LISTS_PROCESS[number] for number in list_numbers or LISTS_PROCESS]
+    try:
+        while True:
+            read_events = 0
+            for list_name in list_names:
+                while True:
+                    events = work_queue.read_changes(list_name, consumer, count)
+                    if not events:
+                        break
+                    for _, event in events:
+                        print(event)
+                    sys.stdout.flush()
+
+                    # the offset is only updated once the events have been written
+                    work_queue.commit_changes(list_name, consumer, events[-1][0] + 1)
+                    read_events += len(events)
+            if not follow:
+                break
+            if not read_events:
+                time.sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot read change events", e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        work_queue.close()
+
+
+@cli.command(short_help='remove the change events read by all consumers')
+@queue_options
+def trim(queue_backend, queue_file, redis_host, redis_port, list_numbers):
+    work_queue = open_work_queue(queue_backend, queue_file, redis_host, redis_port)
+    list_names = [LISTS_PROCESS[number] for number in list_numbers or LISTS_PROCESS]
+    try:
+        trimmed = sum(work_queue.trim_changes(list_name) for list_name in list_names)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot trim change events", e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        work_queue.close()
+    print(f"Removed {trimmed} change events")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Removal of fields from the JSON data obtained from Discogs.
+#
+# The fields to remove are configured as paths, separated by '/', for
+# example 'community/have'. A '*' matches every element of a list (or
+# every value of an object), so 'tracklist/*/artists/*/thumbnail_url'
+# removes the thumbnail of every artist of every track.
+#
+# The paths are compiled once into a tree, which is then applied to each
+# release in a single traversal.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import json
+import sys
+import time
+
+import click
+
+# import YAML module for the configuration
+from yaml import load
+from yaml import YAMLError
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+WILDCARD = '*'
+
+# marker in the compiled tree for fields that should be removed
+REMOVE = None
+
+# thumbnails that are removed (unless disabled in the configuration)
+THUMBNAIL_FIELDS = ['artists/*/thumbnail_url',
+                    'extraartists/*/thumbnail_url',
+                    'companies/*/thumbnail_url',
+                    'labels/*/thumbnail_url',
+                    'series/*/thumbnail_url',
+                    'tracklist/*/artists/*/thumbnail_url',
+                    'tracklist/*/extraartists/*/thumbnail_url']
+
+
+def compile_removes(paths):
+    '''Compile a list of paths into a tree of nested dicts. A field
+       that should be removed maps to REMOVE.'''
+    tree = {}
+    for path in paths:
+        node = tree
+        components = path.strip('/').split('/')
+        for component in components[:-1]:
+            child = node.get(component, {})
+            if child is REMOVE:
+                # a parent is already removed completely
+                break
+            node[component] = child
+            node = child
+        else:
+            node[components[-1]] = REMOVE
+    return tree
+
+
+def remove_fields(data, tree):
+    '''Remove the fields in a compiled tree from data (in place)'''
+    if isinstance(data, dict):
+        for key, child in tree.items():
+            if key == WILDCARD:
+                if child is REMOVE:
+                    data.clear()
+                else:
+                    for value in data.values():
+                        remove_fields(value, child)
+            elif child is REMOVE:
+                data.pop(key, None)
+            elif key in data:
+                remove_fields(data[key], child)
+    elif isinstance(data, list):
+        child = tree.get(WILDCARD, {})
+        if child is REMOVE:
+            data.clear()
+        elif child:
+            for value in data:
+                remove_fields(value, child)
+
+
+@click.command(short_help='measure the time needed to remove fields from a release')
+@click.option('--config-file', '-c', required=True, help='configuration file (YAML)',
+              type=click.File('r'))
+@click.option('--release', '-r', 'release_file', required=True, help='release (JSON)',
+              type=click.File('r'))
+@click.option('--iterations', '-n', default=10000, help='number of iterations (default: 10000)',
+              type=click.IntRange(min=1))
+def main(config_file, release_file, iterations):
+    try:
+        config = load(config_file, Loader=Loader)
+    except (YAMLError, PermissionError, UnicodeDecodeError) as e:
+        print(f"Cannot open configuration file, exiting, {e}", file=sys.stderr)
+        sys.exit(1)
+
+    paths = list(config.get('fields', {}).get('remove', []))
+    if config.get('fields', {}).get('remove_thumbnails', True):
+        paths += THUMBNAIL_FIELDS
+
+    release = release_file.read()
+    tree = compile_removes(paths)
+
+    # the data is modified in place, so every iteration needs
+    # a fresh copy. The time needed for copying is subtracted.
+    start = time.perf_counter()
+    for _ in range(iterations):
+        json.loads(release)
+    parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        remove_fields(json.loads(release), tree)
+    total_time = time.perf_counter() - start
+
+    per_release = (total_time - parse_time) / iterations * 1000000
+    print(f"{len(paths)} paths, {per_release:.2f} microseconds per release")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Index mapping release numbers to the Git blob id of the (cleaned up)
+# JSON that is stored in the Git repository. This makes it possible to
+# see if a release has changed without reading and parsing the stored
+# file: serialize the release, hash it and compare it to the index.
+#
+# The index is stored in SQLite (by default in the .git directory of the
+# repository) and can be rebuilt from, and verified against, the Git tree.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import binascii
+import pathlib
+import re
+import sqlite3
+import sys
+
+import click
+import dulwich
+import dulwich.object_store
+import dulwich.porcelain
+from dulwich.objects import Blob
+
+INDEX_NAME = 'discogs-index.sqlite'
+
+# files in the repository containing a release
+RELEASE_FILE = re.compile(rb'(?:^|/)(\d+)\.json$')
+
+
+def content_hash(data):
+    '''Compute the Git blob id of data (bytes)'''
+    return Blob.from_string(data).id
+
+
+def default_index_path(repo):
+    '''Default location of the index: in the .git directory'''
+    return pathlib.Path(repo.controldir()) / INDEX_NAME
+
+
+def iter_tree_files(repo):
+    '''Generator yielding (path, release number, blob id) for all releases in HEAD'''
+    try:
+        tree_id = repo[repo.refs[b'HEAD']].tree
+    except KeyError:
+        return
+    for entry in dulwich.object_store.iter_tree_contents(repo.object_store, tree_id):
+        match = RELEASE_FILE.search(entry.path)
+        if match is not None:
+            yield entry.path.decode(), int(match.group(1)), entry.sha
+
+
+def iter_tree_releases(repo):
+    '''Generator yielding (release number, blob id) for all releases in HEAD'''
+    for _, release_id, blob_id in iter_tree_files(repo):
+        yield release_id, blob_id
+
+
+class ContentIndex:
+    '''Persistent mapping of release number to Git blob id'''
+    def __init__(self, path):
+        # the index is opened in the main thread of the crawler
+        # but only used by the storage thread
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS releases
+                                   (id INTEGER PRIMARY KEY, hash BLOB NOT NULL)''')
+        self.connection.commit()
+
+    def get(self, release_id):
+        '''Return the blob id for a release, or None if it is unknown'''
+        row = self.connection.execute('SELECT hash FROM releases WHERE id = ?',
+                                      (release_id,)).fetchone()
+        if row is None:
+            return None
+        return binascii.hexlify(row[0])
+
+    def update(self, changes):
+        '''Store (release number, blob id) tuples. A blob id of None
+           removes the release from the index.'''
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO releases (id, hash) VALUES (?, ?)',
+                                        [(release_id, binascii.unhexlify(blob_id))
+                                         for release_id, blob_id in changes
+                                         if blob_id is not None])
+            self.connection.executemany('DELETE FROM releases WHERE id = ?',
+                                        [(release_id,) for release_id, blob_id in changes
+                                         if blob_id is None])
+
+    def items(self):
+        '''Generator yielding (release number, blob id) for all releases'''
+        for release_id, release_hash in self.connection.execute('SELECT id, hash FROM releases'):
+            yield release_id, binascii.hexlify(release_hash)
+
+    def rebuild(self, repo):
+        '''Replace the contents of the index with the releases in HEAD.
+           Returns the number of releases.'''
+        with self.connection:
+            self.connection.execute('DELETE FROM releases')
+            self.connection.executemany('INSERT OR REPLACE INTO releases (id, hash) VALUES (?, ?)',
+                                        ((release_id, binascii.unhexlify(blob_id))
+                                         for release_id, blob_id in iter_tree_releases(repo)))
+        return self.connection.execute('SELECT COUNT(*) FROM releases').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+@click.group(short_help='maintain the index of releases stored in the Git repository')
+def cli():
+    pass
+
+
+def open_index(git, index_path):
+    '''Open the Git repository and the index, exit if the repository is invalid'''
+    try:
+        repo = dulwich.porcelain.open_repo(git)
+    except dulwich.errors.NotGitRepository:
+        print(f"{git} is not a valid Git repository, exiting", file=sys.stderr)
+        sys.exit(1)
+    if index_path is None:
+        index_path = default_index_path(repo)
+    return repo, ContentIndex(index_path)
+
+
+@cli.command(short_help='rebuild the index from the Git repository')
+@click.option('-g', '--git', required=True, help='Location of Git repository',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('-i', '--index', 'index_path', help='Location of index (default: in .git)',
+              type=click.Path(path_type=pathlib.Path))
+def rebuild(git, index_path):
+    repo, index = open_index(git, index_path)
+    count = index.rebuild(repo)
+    index.close()
+    print(f"Indexed {count} releases")
+
+
+@cli.command(short_help='verify the index against the Git repository')
+@click.option('-g', '--git', required=True, help='Location of Git repository',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('-i', '--index', 'index_path', help='Location of index (default: in .git)',
+              type=click.Path(path_type=pathlib.Path))
+@click.option('--verbose', '-v', help='print every difference', is_flag=True, default=False)
+def verify(git, index_path, verbose):
+    repo, index = open_index(git, index_path)
+    indexed = dict(index.items())
+    index.close()
+
+    missing = 0
+    changed = 0
+    for release_id, blob_id in iter_tree_releases(repo):
+        indexed_blob_id = indexed.pop(release_id, None)
+        if indexed_blob_id is None:
+            missing += 1
+            if verbose:
+                print(f"{release_id}: not in index")
+        elif indexed_blob_id != blob_id:
+            changed += 1
+            if verbose:
+                print(f"{release_id}: index has {indexed_blob_id.decode()}, Git has {blob_id.decode()}")
+    if verbose:
+        for release_id in sorted(indexed):
+            print(f"{release_id}: not in Git")
+
+    print(f"{missing} missing, {changed} different, {len(indexed)} not in Git")
+    if missing or changed or indexed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
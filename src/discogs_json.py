@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# JSON codec for releases. Releases are stored in the canonical format
+# of the standard library: json.dumps(release, sort_keys=True, indent=4),
+# which is slow as the standard library cannot use its C accelerator when
+# indenting. If orjson is installed it is used instead and its output is
+# converted to exactly the same bytes:
+#
+# * orjson only indents with 2 spaces, so the indentation is doubled. If no
+#   string contains two consecutive spaces every pair of spaces is part of
+#   the indentation, otherwise only the spaces at the start of every line
+#   are replaced (strings cannot contain newlines).
+# * orjson writes UTF-8, the standard library escapes everything outside
+#   of printable ASCII as \uXXXX (lowercase, with surrogate pairs)
+#
+# Floating point numbers are formatted differently by orjson, so releases
+# with floats (as well as anything else orjson cannot serialize, such as
+# integers larger than 64 bits) are serialized with the standard library.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import codecs
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+INDENT = re.compile(rb'^ +', re.MULTILINE)
+
+ESCAPE_ERRORS = 'discogs-json-escape'
+
+
+def loads(data):
+    '''Parse JSON (bytes or str)'''
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # for example very large integers, or NaN: let the
+            # standard library parse it (or raise the error)
+            pass
+    return json.loads(data)
+
+
+def has_float(json_data):
+    '''Check if parsed JSON contains a floating point number'''
+    stack = [json_data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, float):
+            return True
+    return False
+
+
+def _escape(error):
+    '''Encoding error handler escaping characters outside of ASCII
+       the way the standard library does'''
+    return encode_basestring_ascii(error.object[error.start:error.end])[1:-1], error.end
+
+
+codecs.register_error(ESCAPE_ERRORS, _escape)
+
+
+def dumps_stdlib(json_data):
+    '''Serialize in the canonical format using the standard library'''
+    return json.dumps(json_data, sort_keys=True, indent=4).encode()
+
+
+def dumps(json_data):
+    '''Serialize in the canonical format, returns bytes that are identical
+       to json.dumps(json_data, sort_keys=True, indent=4).encode()'''
+    if orjson is None or has_float(json_data):
+        return dumps_stdlib(json_data)
+    try:
+        # without indentation there are only spaces in strings
+        double_spaces = b'  ' in orjson.dumps(json_data)
+        data = orjson.dumps(json_data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    except orjson.JSONEncodeError:
+        return dumps_stdlib(json_data)
+    if double_spaces:
+        data = INDENT.sub(lambda match: match.group() * 2, data)
+    else:
+        data = data.replace(b'  ', b'    ')
+    if not data.isascii():
+        data = data.decode().encode('ascii', ESCAPE_ERRORS)
+    # DEL is ASCII, but escaped by the standard library
+    return data.replace(b'\x7f', b'\\u007f')
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Metrics for the crawler: latency histograms for the stages of the
+# crawl pipeline (claiming work, downloading, decoding, cleaning up,
+# change detection, writing files and committing to Git), counters for
+# responses, changes, errors and time spent sleeping for the rate limit,
+# and gauges for the queue depth per list.
+#
+# The metrics can be logged periodically and served over HTTP in the
+# Prometheus text format, so it can be seen whether a crawler is bound by
+# the Discogs API, the disk or Git.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import bisect
+import contextlib
+import http.server
+import sys
+import threading
+import time
+
+# upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+# stages of the crawl pipeline, in order
+STAGES = ['claim', 'fetch', 'decode', 'cleanup', 'compare', 'write', 'commit']
+
+PREFIX = 'discogs_'
+
+
+class Histogram:
+    '''Latency histogram with fixed buckets'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class Metrics:
+    '''Registry of counters, gauges and histograms, shared by all threads.
+       Metrics are identified by a name and an optional label.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def increment(self, name, label=None, value=1):
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + value
+
+    def set(self, name, label=None, value=0):
+        with self.lock:
+            self.gauges[(name, label)] = value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        '''Context manager recording the time spent in a stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def get(self, name, label=None):
+        with self.lock:
+            return self.counters.get((name, label), 0)
+
+    def render(self):
+        '''Return all metrics in the Prometheus text format. The names
+           of counters get the _total suffix.'''
+        lines = []
+        with self.lock:
+            for kind, suffix, values in [('counter', '_total', self.counters), ('gauge', '', self.gauges)]:
+                names = sorted({name for name, _ in values})
+                for name in names:
+                    lines.append(f'# TYPE {PREFIX}{name}{suffix} {kind}')
+                    for (metric_name, label), value in sorted(values.items(), key=str):
+                        if metric_name != name:
+                            continue
+                        if label is None:
+                            lines.append(f'{PREFIX}{name}{suffix} {value}')
+                        else:
+                            lines.append(f'{PREFIX}{name}{suffix}{{{label_name(name)}="{escape_label(label)}"}} '
+                                         f'{value}')
+
+            name = f'{PREFIX}stage_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''Return a single line with the most important numbers'''
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            releases = sum(value for (name, _), value in self.counters.items() if name == 'releases')
+            parts = [f"{releases / elapsed:.2f} releases/s"]
+            for name in ['responses', 'releases', 'errors']:
+                counts = [f"{label}={value}" for (counter, label), value
+                          in sorted(self.counters.items(), key=str) if counter == name]
+                if counts:
+                    parts.append(f"{name}: {' '.join(counts)}")
+            sleep = self.counters.get(('rate_limit_sleep_seconds', None), 0)
+            parts.append(f"rate limit sleep: {sleep:.1f}s")
+            stages = [f"{stage}={self.histograms[stage].sum / self.histograms[stage].count * 1000:.1f}ms"
+                      for stage in STAGES if stage in self.histograms]
+            if stages:
+                parts.append(f"mean: {' '.join(stages)}")
+            depth = sum(value for (name, _), value in self.gauges.items() if name == 'queue_depth')
+            parts.append(f"queued: {depth}")
+        return ', '.join(parts)
+
+
+def label_name(name):
+    '''Name of the label of a metric'''
+    return {'responses': 'status', 'releases': 'change', 'errors': 'type',
+            'queue_depth': 'list'}.get(name, 'label')
+
+
+def escape_label(value):
+    '''Escape a label value for the Prometheus text format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# registry used by the crawler and the modules it uses
+REGISTRY = Metrics()
+
+increment = REGISTRY.increment
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+
+
+def serve(port, registry=REGISTRY):
+    '''Serve the metrics over HTTP (in a separate thread)'''
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def report(stop, interval, queue_depth=None, log=False, registry=REGISTRY):
+    '''Periodically update the queue depth (using queue_depth(), which
+       returns a dict mapping list names to lengths) and log a summary to
+       stderr. Runs until stop is set.'''
+    while not stop.wait(interval):
+        if queue_depth is not None:
+            try:
+                for list_name, length in queue_depth().items():
+                    registry.set('queue_depth', list_name, length)
+            except Exception as e:
+                print("Cannot determine queue depth", e, file=sys.stderr)
+        if log:
+            print(registry.summary(), file=sys.stderr)
+            sys.stderr.flush()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Tool to convert existing Git repositories with Discogs data to another
+# layout (see discogs_storage.py), or to split a single repository into
+# a repository per block.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import pathlib
+import sys
+
+import click
+import dulwich
+import dulwich.errors
+from dulwich.repo import Repo
+
+import discogs_index
+import discogs_storage
+
+AUTHOR = "Discogs Crawler <armijn@tjaldur.nl>"
+
+
+def open_repositories(git, repository_mode):
+    '''Return a list of (repository, has block prefix) tuples. For a single
+       repository the block is the first directory in the path of a
+       release, for a repository per block the block is the repository.'''
+    try:
+        if repository_mode == 'single':
+            return [(Repo(git), True)]
+        return [(Repo(block_directory), False) for block_directory in sorted(git.iterdir())
+                if (block_directory / '.git').exists()]
+    except dulwich.errors.NotGitRepository:
+        print(f"{git} is not a valid Git repository, exiting", file=sys.stderr)
+        sys.exit(1)
+
+
+@click.group(short_help='convert Git repositories with Discogs data')
+def cli():
+    pass
+
+
+@cli.command(short_help='move releases to another layout')
+@click.option('-g', '--git', required=True, help='Location of Git repository',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('--layout', required=True, help='new layout',
+              type=click.Choice(discogs_storage.LAYOUTS))
+@click.option('--repository', 'repository_mode', default='single',
+              help='single repository or a repository per block (default: single)',
+              type=click.Choice(discogs_storage.REPOSITORY_MODES))
+@click.option('--batch-size', default=100000, type=click.IntRange(min=1),
+              help='number of releases moved per commit (default: 100000)')
+def layout(git, layout, repository_mode, batch_size):
+    for repo, has_block_prefix in open_repositories(git, repository_mode):
+        repo_path = pathlib.Path(repo.path)
+        store = discogs_storage.GitStore(repo, AUTHOR, batch_size=batch_size)
+        moved = 0
+        for path, release_id, blob_id in list(discogs_index.iter_tree_files(repo)):
+            if has_block_prefix:
+                block_directory = repo_path / path.split('/', 1)[0]
+            else:
+                block_directory = repo_path
+            new_path = discogs_storage.release_path(block_directory, release_id, layout)
+            if new_path == repo_path / path:
+                continue
+            store.rename(repo_path / path, new_path, release_id, blob_id)
+            moved += 1
+        store.close()
+        print(f"{repo_path}: moved {moved} releases")
+
+
+@cli.command(short_help='split a single repository into a repository per block')
+@click.option('-g', '--git', required=True, help='Location of Git repository',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('-o', '--output', required=True, help='directory for the new repositories',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('--layout', default='flat', help='layout in the new repositories (default: flat)',
+              type=click.Choice(discogs_storage.LAYOUTS))
+@click.option('--batch-size', default=10000, type=click.IntRange(min=1),
+              help='number of releases added per commit (default: 10000)')
+def split(git, output, layout, batch_size):
+    (repo, _), = open_repositories(git, 'single')
+
+    # releases are grouped per block, so a block can be
+    # written in one go
+    blocks = {}
+    for path, release_id, blob_id in discogs_index.iter_tree_files(repo):
+        if '/' not in path:
+            continue
+        blocks.setdefault(path.split('/', 1)[0], []).append((release_id, blob_id))
+
+    for block, releases in sorted(blocks.items()):
+        block_repo, block_directory = discogs_storage.open_block_repository(output, block, 'block')
+        index = discogs_index.ContentIndex(discogs_index.default_index_path(block_repo))
+        store = discogs_storage.GitStore(block_repo, AUTHOR, batch_size=batch_size, index=index)
+        for release_id, blob_id in sorted(releases):
+            store.add(discogs_storage.release_path(block_directory, release_id, layout),
+                      repo.object_store[blob_id].data, release_id)
+        store.close()
+        index.close()
+        print(f"{block_directory}: added {len(releases)} releases")
+
+
+if __name__ == "__main__":
+    cli()
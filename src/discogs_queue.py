@@ -0,0 +1,850 @@
+#!/usr/bin/env python3
+
+# Queue of release numbers that need to be crawled.
+#
+# Workers claim release numbers in batches. Claimed release numbers are
+# moved atomically to an in-flight list for the worker and are only
+# removed from that list (acknowledged) when the release has been stored.
+# Every worker regularly records a heartbeat. If a worker stops (for
+# example because it crashed) its in-flight release numbers are returned
+# to the queue by the other workers once its heartbeat is older than the
+# visibility timeout.
+#
+# There are two backends: Redis (the queues are Redis lists), and SQLite
+# (an embedded queue in a single file, which can be used by all workers on
+# the same host without running a server).
+#
+# Both backends also keep change logs: append-only lists of change events
+# (strings) that are read by consumers, each with their own offset, so
+# every consumer sees every event. Events that have been read by all
+# consumers can be trimmed. With the events the last commit of which the
+# events were published is recorded, in the same transaction.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import collections
+import os
+import random
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+import redis
+
+BACKENDS = ['redis', 'sqlite']
+
+# default location of the SQLite queue
+DEFAULT_QUEUE_FILE = 'discogs-queue.sqlite'
+
+# default number of release numbers claimed in one go
+DEFAULT_BATCH_SIZE = 10
+
+# default time (in seconds) after which release numbers claimed by
+# a worker without a heartbeat are returned to the queue
+DEFAULT_VISIBILITY_TIMEOUT = 900
+
+# number of release numbers sent to the queue in a single command
+PUSH_SIZE = 10000
+
+# time to sleep between checks of an empty SQLite queue
+POLL_INTERVAL = 0.5
+
+# errors raised when the queue cannot be reached
+QUEUE_ERRORS = (redis.exceptions.ConnectionError, sqlite3.OperationalError)
+
+# Lua script to read up to ARGV[2] events from a change log (KEYS[1])
+# starting at the offset of a consumer (ARGV[1], offsets in KEYS[2]). The
+# number of trimmed events is kept in KEYS[3]. Returns the position of the
+# first event followed by the events.
+REDIS_READ_CHANGES_SCRIPT = '''
+local trimmed = tonumber(redis.call('GET', KEYS[3]) or 0)
+local position = math.max(tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0), trimmed)
+local start = position - trimmed
+local events = redis.call('LRANGE', KEYS[1], start, start + tonumber(ARGV[2]) - 1)
+table.insert(events, 1, position)
+return events
+'''
+
+# Lua script to remove the events from a change log (KEYS[1]) that have
+# been read by all consumers (offsets in KEYS[2]), counting the number of
+# trimmed events in KEYS[3]. Returns the number of removed events.
+REDIS_TRIM_CHANGES_SCRIPT = '''
+local offsets = redis.call('HVALS', KEYS[2])
+if #offsets == 0 then
+    return 0
+end
+local lowest = nil
+for i = 1, #offsets do
+    local offset = tonumber(offsets[i])
+    if lowest == nil or offset < lowest then
+        lowest = offset
+    end
+end
+local trimmed = tonumber(redis.call('GET', KEYS[3]) or 0)
+if lowest <= trimmed then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], lowest - trimmed, -1)
+redis.call('SET', KEYS[3], lowest)
+return lowest - trimmed
+'''
+
+# Lua script to claim up to ARGV[1] release numbers from the queue
+# (KEYS[1]) and move them to the in-flight list of the worker (KEYS[2]),
+# recording the heartbeat of the worker (ARGV[2]) in KEYS[3].
+REDIS_CLAIM_SCRIPT = '''
+redis.call('HSET', KEYS[3], ARGV[2], redis.call('TIME')[1])
+local release_ids = {}
+for i = 1, tonumber(ARGV[1]) do
+    local release_id = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not release_id then
+        break
+    end
+    release_ids[#release_ids + 1] = release_id
+end
+return release_ids
+'''
+
+# Lua script to acknowledge release numbers (ARGV[2..]) by removing them
+# from the in-flight list of the worker (KEYS[1]), recording the heartbeat
+# of the worker (ARGV[1]) in KEYS[2].
+REDIS_ACK_SCRIPT = '''
+redis.call('HSET', KEYS[2], ARGV[1], redis.call('TIME')[1])
+for i = 2, #ARGV do
+    redis.call('LREM', KEYS[1], 1, ARGV[i])
+end
+return 1
+'''
+
+# Lua script to return claimed release numbers (ARGV) that were not
+# processed from the in-flight list of a worker (KEYS[2]) to the front
+# of the queue (KEYS[1]), in their original order.
+REDIS_RELEASE_SCRIPT = '''
+for i = #ARGV, 1, -1 do
+    if redis.call('LREM', KEYS[2], 1, ARGV[i]) > 0 then
+        redis.call('LPUSH', KEYS[1], ARGV[i])
+    end
+end
+return 1
+'''
+
+# Lua script to take or renew the lease on a block (KEYS[1]) for a
+# worker (ARGV[1]) for ARGV[2] seconds. Returns 1 if the worker holds
+# the lease, 0 if another worker holds it.
+REDIS_LEASE_SCRIPT = '''
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+'''
+
+# Lua script to give up the lease on a block (KEYS[1]) held by a worker (ARGV[1])
+REDIS_UNLEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+'''
+
+# Lua script to return the in-flight release numbers of workers (from
+# KEYS[2]) without a heartbeat in the last ARGV[1] seconds to the front
+# of the queue (KEYS[1]), in their original order. The in-flight list of
+# a worker is ARGV[2] followed by the name of the worker.
+REDIS_REQUEUE_SCRIPT = '''
+local now = tonumber(redis.call('TIME')[1])
+local workers = redis.call('HGETALL', KEYS[2])
+local requeued = 0
+for i = 1, #workers, 2 do
+    if now - tonumber(workers[i + 1]) > tonumber(ARGV[1]) then
+        local inflight = ARGV[2] .. workers[i]
+        while redis.call('LMOVE', inflight, KEYS[1], 'RIGHT', 'LEFT') do
+            requeued = requeued + 1
+        end
+        redis.call('HDEL', KEYS[2], workers[i])
+    end
+end
+return requeued
+'''
+
+
+def default_worker_name():
+    '''Name of this worker, unique for every process'''
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class RedisQueue:
+    '''Queue of release numbers, stored in Redis lists'''
+    def __init__(self, redis_client, worker=None, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        self.redis_client = redis_client
+        if worker is None:
+            worker = default_worker_name()
+        self.worker = worker
+        self.visibility_timeout = visibility_timeout
+        self.claim_script = redis_client.register_script(REDIS_CLAIM_SCRIPT)
+        self.ack_script = redis_client.register_script(REDIS_ACK_SCRIPT)
+        self.release_script = redis_client.register_script(REDIS_RELEASE_SCRIPT)
+        self.requeue_script = redis_client.register_script(REDIS_REQUEUE_SCRIPT)
+        self.lease_script = redis_client.register_script(REDIS_LEASE_SCRIPT)
+        self.unlease_script = redis_client.register_script(REDIS_UNLEASE_SCRIPT)
+        self.read_changes_script = redis_client.register_script(REDIS_READ_CHANGES_SCRIPT)
+        self.trim_changes_script = redis_client.register_script(REDIS_TRIM_CHANGES_SCRIPT)
+
+    def _inflight_prefix(self, list_name):
+        return f'{list_name}:inflight:'
+
+    def _inflight(self, list_name):
+        return f'{self._inflight_prefix(list_name)}{self.worker}'
+
+    def _workers(self, list_name):
+        return f'{list_name}:workers'
+
+    def push(self, list_name, release_ids):
+        '''Add release numbers to the end of the queue'''
+        release_ids = list(release_ids)
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for i in range(0, len(release_ids), PUSH_SIZE):
+                pipe.rpush(list_name, *release_ids[i:i+PUSH_SIZE])
+            pipe.execute()
+
+    def length(self, list_name):
+        '''Number of release numbers in the queue (excluding in-flight)'''
+        return self.redis_client.llen(list_name)
+
+    def lengths(self, list_names):
+        '''Number of release numbers in each of the queues'''
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for list_name in list_names:
+                pipe.llen(list_name)
+            return dict(zip(list_names, pipe.execute()))
+
+    def claim(self, list_name, count, timeout=0):
+        '''Claim up to count release numbers. If the queue is empty wait
+           at most timeout seconds for a release number to be added.
+           Returns a (possibly empty) list of release numbers.'''
+        keys = [list_name, self._inflight(list_name), self._workers(list_name)]
+        release_ids = self.claim_script(keys=keys, args=[count, self.worker])
+        if not release_ids and timeout > 0:
+            release_id = self.redis_client.blmove(list_name, self._inflight(list_name), timeout,
+                                                  src='LEFT', dest='RIGHT')
+            if release_id is None:
+                return []
+            release_ids = [release_id] + self.claim_script(keys=keys, args=[count - 1, self.worker])
+        return [int(release_id) for release_id in release_ids]
+
+    def ack(self, list_name, release_ids):
+        '''Acknowledge that release numbers have been processed'''
+        if not release_ids:
+            return
+        self.ack_script(keys=[self._inflight(list_name), self._workers(list_name)],
+                        args=[self.worker] + list(release_ids))
+
+    def release(self, list_name, release_ids):
+        '''Return claimed release numbers that were not processed to the queue'''
+        if not release_ids:
+            return
+        self.release_script(keys=[list_name, self._inflight(list_name)], args=list(release_ids))
+
+    def heartbeat(self, list_name):
+        '''Record that this worker is still alive'''
+        self.ack_script(keys=[self._inflight(list_name), self._workers(list_name)],
+                        args=[self.worker])
+
+    def requeue_stale(self, list_name):
+        '''Return release numbers claimed by workers that have not been
+           seen for the visibility timeout to the queue. Returns the
+           number of requeued release numbers.'''
+        return self.requeue_script(keys=[list_name, self._workers(list_name)],
+                                   args=[self.visibility_timeout, self._inflight_prefix(list_name)])
+
+    def acquire_lease(self, list_name):
+        '''Take (or renew) the lease on the block of a queue for the
+           visibility timeout. Returns True if this worker holds the lease.'''
+        return bool(self.lease_script(keys=[f'{list_name}:lease'],
+                                      args=[self.worker, self.visibility_timeout]))
+
+    def release_lease(self, list_name):
+        '''Give up the lease on the block of a queue'''
+        self.unlease_script(keys=[f'{list_name}:lease'], args=[self.worker])
+
+    def _change_keys(self, list_name):
+        return [list_name, f'{list_name}:offsets', f'{list_name}:trimmed']
+
+    def publish(self, list_name, events, commit_id=None):
+        '''Append events to the end of a change log. If commit_id is given
+           it is recorded as the last commit of which the events were
+           published, in the same transaction.'''
+        events = list(events)
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            for i in range(0, len(events), PUSH_SIZE):
+                pipe.rpush(list_name, *events[i:i+PUSH_SIZE])
+            if commit_id is not None:
+                pipe.set(f'{list_name}:published', commit_id)
+            pipe.execute()
+
+    def published(self, list_name):
+        '''Return the last commit of which the events were published to a
+           change log ('' for the empty repository), or None if unknown'''
+        return self.redis_client.get(f'{list_name}:published')
+
+    def init_published(self, list_name, commit_id):
+        '''Record the last published commit of a change log, unless it is
+           already known'''
+        self.redis_client.set(f'{list_name}:published', commit_id, nx=True)
+
+    def read_changes(self, list_name, consumer, count):
+        '''Read up to count events after the offset of a consumer. Returns
+           a list of (position, event) tuples.'''
+        result = self.read_changes_script(keys=self._change_keys(list_name), args=[consumer, count])
+        position = int(result[0])
+        return list(enumerate(result[1:], start=position))
+
+    def commit_changes(self, list_name, consumer, offset):
+        '''Set the offset of a consumer: the position of the next event to read'''
+        self.redis_client.hset(f'{list_name}:offsets', consumer, offset)
+
+    def trim_changes(self, list_name):
+        '''Remove the events that have been read by all consumers.
+           Returns the number of removed events.'''
+        return self.trim_changes_script(keys=self._change_keys(list_name))
+
+    def close(self):
+        self.redis_client.close()
+
+
+class SQLiteQueue:
+    '''Queue of release numbers, stored in a SQLite database (in WAL
+       mode) that can be shared by several processes on the same host.
+       Release numbers are kept in the order they were added, in-flight
+       release numbers are kept in a separate table together with their
+       original position, so they can be put back at the same place. The
+       length of every queue is kept up to date in a separate table, so
+       it does not have to be counted.'''
+    def __init__(self, path, worker=None, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+        if worker is None:
+            worker = default_worker_name()
+        self.worker = worker
+        self.visibility_timeout = visibility_timeout
+
+        # the connection is shared by the threads of a worker, transactions
+        # are managed explicitly and serialized using a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            has_lengths = self.connection.execute('''SELECT 1 FROM sqlite_master
+                                                     WHERE type = 'table' AND name = 'lengths' ''').fetchone()
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS queue
+                                       (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        list TEXT NOT NULL, release_id INTEGER NOT NULL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS queue_list ON queue (list, seq)')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS inflight
+                                       (seq INTEGER PRIMARY KEY, list TEXT NOT NULL,
+                                        worker TEXT NOT NULL, release_id INTEGER NOT NULL)''')
+            self.connection.execute('''CREATE INDEX IF NOT EXISTS inflight_worker
+                                       ON inflight (list, worker, release_id)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS workers
+                                       (list TEXT NOT NULL, worker TEXT NOT NULL, seen REAL NOT NULL,
+                                        PRIMARY KEY (list, worker))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS leases
+                                       (list TEXT PRIMARY KEY, worker TEXT NOT NULL,
+                                        expires REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS changes
+                                       (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        list TEXT NOT NULL, event TEXT NOT NULL)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS changes_list ON changes (list, seq)')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS consumers
+                                       (list TEXT NOT NULL, consumer TEXT NOT NULL,
+                                        offset INTEGER NOT NULL, PRIMARY KEY (list, consumer))''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS published
+                                       (list TEXT PRIMARY KEY, commit_id TEXT NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS lengths
+                                       (list TEXT PRIMARY KEY, length INTEGER NOT NULL)''')
+            if has_lengths is None:
+                # queues made before the lengths were kept
+                self.connection.execute('''INSERT INTO lengths (list, length)
+                                           SELECT list, COUNT(*) FROM queue GROUP BY list''')
+
+    def _transaction(self):
+        return _Transaction(self.connection, self.lock)
+
+    def _heartbeat(self, list_name):
+        self.connection.execute('INSERT OR REPLACE INTO workers (list, worker, seen) VALUES (?, ?, ?)',
+                                (list_name, self.worker, time.time()))
+
+    def _add_length(self, list_name, count):
+        if count:
+            self.connection.execute('''INSERT INTO lengths (list, length) VALUES (?, ?)
+                                       ON CONFLICT (list) DO UPDATE SET length = length + excluded.length''',
+                                    (list_name, count))
+
+    def push(self, list_name, release_ids):
+        '''Add release numbers to the end of the queue'''
+        with self._transaction():
+            cursor = self.connection.executemany('INSERT INTO queue (list, release_id) VALUES (?, ?)',
+                                                 ((list_name, release_id) for release_id in release_ids))
+            self._add_length(list_name, cursor.rowcount)
+
+    def length(self, list_name):
+        '''Number of release numbers in the queue (excluding in-flight)'''
+        with self.lock:
+            row = self.connection.execute('SELECT length FROM lengths WHERE list = ?',
+                                          (list_name,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def lengths(self, list_names):
+        '''Number of release numbers in each of the queues'''
+        with self.lock:
+            lengths = dict(self.connection.execute('SELECT list, length FROM lengths'))
+        return {list_name: lengths.get(list_name, 0) for list_name in list_names}
+
+    def _claim(self, list_name, count):
+        with self._transaction():
+            self._heartbeat(list_name)
+            rows = self.connection.execute('''SELECT seq, release_id FROM queue WHERE list = ?
+                                              ORDER BY seq LIMIT ?''', (list_name, count)).fetchall()
+            if rows:
+                deleted = self.connection.execute('DELETE FROM queue WHERE list = ? AND seq BETWEEN ? AND ?',
+                                                  (list_name, rows[0][0], rows[-1][0])).rowcount
+                self._add_length(list_name, -deleted)
+                self.connection.executemany('''INSERT INTO inflight (seq, list, worker, release_id)
+                                               VALUES (?, ?, ?, ?)''',
+                                            [(seq, list_name, self.worker, release_id)
+                                             for seq, release_id in rows])
+        return [release_id for _, release_id in rows]
+
+    def claim(self, list_name, count, timeout=0):
+        '''Claim up to count release numbers. If the queue is empty wait
+           at most timeout seconds for a release number to be added.
+           Returns a (possibly empty) list of release numbers.'''
+        deadline = time.monotonic() + timeout
+        while True:
+            release_ids = self._claim(list_name, count)
+            if release_ids or time.monotonic() >= deadline:
+                return release_ids
+            time.sleep(POLL_INTERVAL)
+
+    def ack(self, list_name, release_ids):
+        '''Acknowledge that release numbers have been processed'''
+        if not release_ids:
+            return
+        with self._transaction():
+            self._heartbeat(list_name)
+            self.connection.executemany('''DELETE FROM inflight WHERE list = ? AND worker = ?
+                                           AND release_id = ?''',
+                                        [(list_name, self.worker, release_id)
+                                         for release_id in release_ids])
+
+    def _requeue(self, list_name, where, parameters):
+        self.connection.execute(f'''INSERT INTO queue (seq, list, release_id)
+                                    SELECT seq, list, release_id FROM inflight WHERE {where}''',
+                                parameters)
+        requeued = self.connection.execute(f'DELETE FROM inflight WHERE {where}', parameters).rowcount
+        self._add_length(list_name, requeued)
+        return requeued
+
+    def release(self, list_name, release_ids):
+        '''Return claimed release numbers that were not processed to the queue'''
+        if not release_ids:
+            return
+        with self._transaction():
+            for release_id in release_ids:
+                self._requeue(list_name, 'list = ? AND worker = ? AND release_id = ?',
+                              (list_name, self.worker, release_id))
+
+    def heartbeat(self, list_name):
+        '''Record that this worker is still alive'''
+        with self._transaction():
+            self._heartbeat(list_name)
+
+    def requeue_stale(self, list_name):
+        '''Return release numbers claimed by workers that have not been
+           seen for the visibility timeout to the queue. Returns the
+           number of requeued release numbers.'''
+        requeued = 0
+        with self._transaction():
+            stale = self.connection.execute('SELECT worker FROM workers WHERE list = ? AND seen < ?',
+                                            (list_name, time.time() - self.visibility_timeout)).fetchall()
+            for worker, in stale:
+                requeued += self._requeue(list_name, 'list = ? AND worker = ?', (list_name, worker))
+                self.connection.execute('DELETE FROM workers WHERE list = ? AND worker = ?',
+                                        (list_name, worker))
+        return requeued
+
+    def acquire_lease(self, list_name):
+        '''Take (or renew) the lease on the block of a queue for the
+           visibility timeout. Returns True if this worker holds the lease.'''
+        now = time.time()
+        with self._transaction():
+            row = self.connection.execute('SELECT worker, expires FROM leases WHERE list = ?',
+                                          (list_name,)).fetchone()
+            if row is not None and row[0] != self.worker and row[1] > now:
+                return False
+            self.connection.execute('INSERT OR REPLACE INTO leases (list, worker, expires) VALUES (?, ?, ?)',
+                                    (list_name, self.worker, now + self.visibility_timeout))
+        return True
+
+    def release_lease(self, list_name):
+        '''Give up the lease on the block of a queue'''
+        with self._transaction():
+            self.connection.execute('DELETE FROM leases WHERE list = ? AND worker = ?',
+                                    (list_name, self.worker))
+
+    def publish(self, list_name, events, commit_id=None):
+        '''Append events to the end of a change log. If commit_id is given
+           it is recorded as the last commit of which the events were
+           published, in the same transaction.'''
+        with self._transaction():
+            self.connection.executemany('INSERT INTO changes (list, event) VALUES (?, ?)',
+                                        ((list_name, event) for event in events))
+            if commit_id is not None:
+                self.connection.execute('INSERT OR REPLACE INTO published (list, commit_id) VALUES (?, ?)',
+                                        (list_name, commit_id))
+
+    def published(self, list_name):
+        '''Return the last commit of which the events were published to a
+           change log ('' for the empty repository), or None if unknown'''
+        with self.lock:
+            row = self.connection.execute('SELECT commit_id FROM published WHERE list = ?',
+                                          (list_name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def init_published(self, list_name, commit_id):
+        '''Record the last published commit of a change log, unless it is
+           already known'''
+        with self._transaction():
+            self.connection.execute('INSERT OR IGNORE INTO published (list, commit_id) VALUES (?, ?)',
+                                    (list_name, commit_id))
+
+    def read_changes(self, list_name, consumer, count):
+        '''Read up to count events after the offset of a consumer. Returns
+           a list of (position, event) tuples.'''
+        with self.lock:
+            row = self.connection.execute('SELECT offset FROM consumers WHERE list = ? AND consumer = ?',
+                                          (list_name, consumer)).fetchone()
+            offset = 0 if row is None else row[0]
+            return self.connection.execute('''SELECT seq, event FROM changes WHERE list = ? AND seq >= ?
+                                              ORDER BY seq LIMIT ?''',
+                                           (list_name, offset, count)).fetchall()
+
+    def commit_changes(self, list_name, consumer, offset):
+        '''Set the offset of a consumer: the position of the next event to read'''
+        with self._transaction():
+            self.connection.execute('''INSERT OR REPLACE INTO consumers (list, consumer, offset)
+                                       VALUES (?, ?, ?)''', (list_name, consumer, offset))
+
+    def trim_changes(self, list_name):
+        '''Remove the events that have been read by all consumers.
+           Returns the number of removed events.'''
+        with self._transaction():
+            offset = self.connection.execute('SELECT MIN(offset) FROM consumers WHERE list = ?',
+                                             (list_name,)).fetchone()[0]
+            if offset is None:
+                return 0
+            return self.connection.execute('DELETE FROM changes WHERE list = ? AND seq < ?',
+                                           (list_name, offset)).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+class _Transaction:
+    '''Context manager for a write transaction on a shared connection.
+       BEGIN IMMEDIATE takes the write lock right away, so concurrent
+       claims by other processes wait instead of failing.'''
+    def __init__(self, connection, lock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.execute('COMMIT')
+            else:
+                self.connection.execute('ROLLBACK')
+        finally:
+            self.lock.release()
+
+
+def open_queue(backend, redis_client=None, queue_file=DEFAULT_QUEUE_FILE, worker=None,
+               visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT):
+    '''Open the queue using the configured backend'''
+    if backend == 'sqlite':
+        return SQLiteQueue(queue_file, worker, visibility_timeout)
+    return RedisQueue(redis_client, worker, visibility_timeout)
+
+
+class ClaimBuffer:
+    '''Local buffer of claimed release numbers for a single queue, shared
+       by all fetch threads of a worker. Release numbers are claimed from
+       the queue in batches, which saves a round trip per release. The
+       number of claimed release numbers that have not been acknowledged
+       (or returned) yet is kept, so it is known when all work taken from
+       the queue has been finished.'''
+    def __init__(self, work_queue, list_name, batch_size=DEFAULT_BATCH_SIZE, wait=10):
+        self.work_queue = work_queue
+        self.list_name = list_name
+        self.batch_size = batch_size
+        self.wait = wait
+        self.buffer = collections.deque()
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.empty = False
+
+    def get(self, wait=None):
+        '''Return the next release number, or None if the queue stayed
+           empty while waiting (by default for the wait of the buffer)'''
+        if wait is None:
+            wait = self.wait
+        with self.lock:
+            if self.buffer:
+                return self.buffer.popleft()
+
+        # wait for the queue without holding the lock, so release
+        # numbers can be acknowledged in the meantime
+        release_ids = self.work_queue.claim(self.list_name, self.batch_size, timeout=wait)
+        with self.lock:
+            self.buffer.extend(release_ids)
+            self.inflight += len(release_ids)
+            self.empty = not self.buffer
+            if not self.buffer:
+                return None
+            return self.buffer.popleft()
+
+    def ack(self, release_ids):
+        '''Acknowledge that release numbers have been processed'''
+        self.work_queue.ack(self.list_name, release_ids)
+        with self.lock:
+            self.inflight -= len(release_ids)
+
+    def release(self, release_ids=()):
+        '''Return release numbers that were not processed, as well as
+           all release numbers that are still buffered, to the queue'''
+        with self.lock:
+            release_ids = list(release_ids) + list(self.buffer)
+            self.buffer.clear()
+            self.inflight -= len(release_ids)
+        self.work_queue.release(self.list_name, release_ids)
+
+    def drained(self):
+        '''True if the queue was found empty and all claimed release
+           numbers have been acknowledged'''
+        with self.lock:
+            return self.empty and not self.buffer and self.inflight <= 0
+
+    def draining(self):
+        '''True if the queue was found empty, but some of the claimed
+           release numbers have not been acknowledged yet'''
+        with self.lock:
+            return self.empty and not self.buffer and self.inflight > 0
+
+
+class Scheduler:
+    '''Hand out release numbers from one or more queues to the fetch
+       threads of a worker.
+
+       Without leases release numbers are taken from all the queues.
+
+       With leases a worker only takes release numbers from the queues of
+       blocks for which it holds the lease, so the Git directory of a block
+       is only written to by a single worker at a time. When there is no
+       work left in these queues the worker takes the lease on another
+       block, picked at random with a weight of the number of queued
+       release numbers, so workers move to the blocks with the largest
+       backlog. The lease on a block is given up once its queue is empty
+       and all release numbers claimed from it have been acknowledged.
+
+       The leases and the heartbeats are renewed by a separate thread
+       (see start()), so they do not expire while the fetch threads are
+       waiting, for example for the rate limit. If a lease is lost anyway
+       (for example because the queue could not be reached for too long)
+       no more release numbers are taken from that queue and holds()
+       returns False for it, so the storage thread knows the changes for
+       the block must not be committed.'''
+    def __init__(self, work_queue, list_names, leases=False, max_blocks=1,
+                 batch_size=DEFAULT_BATCH_SIZE, wait=10, stop=None):
+        self.work_queue = work_queue
+        self.list_names = list(list_names)
+        self.leases = leases
+        self.max_blocks = max_blocks
+        self.batch_size = batch_size
+        self.wait = wait
+        if stop is None:
+            stop = threading.Event()
+        self.stop = stop
+        self.lock = threading.Lock()
+        self.keep_alive_thread = None
+
+        # claim buffers of the queues that are used: all
+        # queues, or the queues for which the lease is held
+        self.claims = {}
+        if not leases:
+            for list_name in self.list_names:
+                self.claims[list_name] = ClaimBuffer(work_queue, list_name, batch_size, wait)
+
+        # claim buffers of the queues for which the lease was lost, with
+        # release numbers that are still being processed. These can only
+        # be acknowledged or returned to the queue.
+        self.lost = {}
+
+    def start(self):
+        '''Start the thread that renews the leases and the heartbeats
+           until stop is set'''
+        self.keep_alive_thread = threading.Thread(target=self._run_keep_alive, daemon=True)
+        self.keep_alive_thread.start()
+
+    def _run_keep_alive(self):
+        while True:
+            try:
+                with self.lock:
+                    self._keep_alive()
+            except QUEUE_ERRORS as e:
+                print("Cannot renew leases", e, file=sys.stderr)
+            if self.stop.wait(self.work_queue.visibility_timeout / 4):
+                return
+
+    def _keep_alive(self):
+        '''Renew the leases and the heartbeats and return the work of
+           workers that died to the queues'''
+        if self.leases:
+            for list_name, claims in list(self.claims.items()):
+                if not self.work_queue.acquire_lease(list_name):
+                    # the lease expired and was taken by another worker:
+                    # stop working on the block and return the release
+                    # numbers that were not handed out yet
+                    print(f"Lost lease on {list_name}", file=sys.stderr)
+                    del self.claims[list_name]
+                    claims.release()
+                    self.lost[list_name] = claims
+        for list_name, claims in list(self.lost.items()):
+            if claims.inflight <= 0:
+                del self.lost[list_name]
+        # in-flight release numbers of lost blocks are also kept alive,
+        # until they have been acknowledged or returned to the queue
+        for claims in list(self.claims.values()) + list(self.lost.values()):
+            self.work_queue.heartbeat(claims.list_name)
+        # stale work can also be in queues that nobody holds a lease on
+        for list_name in self.list_names:
+            self.work_queue.requeue_stale(list_name)
+
+    def _reschedule(self):
+        '''Give up the leases on blocks without work and take the leases
+           on blocks with a backlog'''
+        for list_name, claims in list(self.claims.items()):
+            if claims.drained():
+                self.work_queue.release_lease(list_name)
+                del self.claims[list_name]
+        if len(self.claims) >= self.max_blocks:
+            return
+        lengths = {list_name: length for list_name, length
+                   in self.work_queue.lengths(self.list_names).items()
+                   if length and list_name not in self.claims}
+        while lengths and len(self.claims) < self.max_blocks:
+            list_name, = random.choices(list(lengths), weights=list(lengths.values()))
+            del lengths[list_name]
+            if list_name in self.lost:
+                # release numbers claimed before the lease was lost
+                # are still being processed
+                continue
+            if self.work_queue.acquire_lease(list_name):
+                self.claims[list_name] = ClaimBuffer(self.work_queue, list_name,
+                                                     self.batch_size, self.wait)
+
+    def get(self):
+        '''Return (list name, release number) of the next release to
+           download, or None if there was no work while waiting'''
+        with self.lock:
+            for list_name, claims in self.claims.items():
+                release_id = claims.get(wait=0)
+                if release_id is not None:
+                    return list_name, release_id
+            if self.leases:
+                self._reschedule()
+                for list_name, claims in self.claims.items():
+                    release_id = claims.get(wait=0)
+                    if release_id is not None:
+                        return list_name, release_id
+            waiting = None
+            if not self.leases and len(self.claims) == 1:
+                (waiting, claims), = self.claims.items()
+
+        if waiting is not None:
+            # wait for the queue to be filled (outside of the lock,
+            # so the other threads can use the scheduler meanwhile)
+            release_id = claims.get()
+            if release_id is not None:
+                return waiting, release_id
+            return None
+        self.stop.wait(self.wait)
+        return None
+
+    def _claims(self, list_name):
+        with self.lock:
+            if list_name in self.claims:
+                return self.claims[list_name]
+            return self.lost[list_name]
+
+    def holds(self, list_name):
+        '''True if changes for the block of a queue can be committed:
+           leases are not used, or the lease on the block is held'''
+        with self.lock:
+            return not self.leases or list_name in self.claims
+
+    def ack(self, list_name, release_ids):
+        '''Acknowledge that release numbers have been processed'''
+        self._claims(list_name).ack(release_ids)
+
+    def release(self, list_name, release_ids):
+        '''Return release numbers that were not processed to the queue'''
+        self._claims(list_name).release(release_ids)
+
+    def draining(self):
+        '''Names of the queues that are empty, but with release numbers
+           that have not been acknowledged yet'''
+        with self.lock:
+            return [list_name for list_name, claims in self.claims.items() if claims.draining()]
+
+    def inflight(self, list_name):
+        '''Number of release numbers claimed from a queue that have not
+           been acknowledged (or returned) yet'''
+        with self.lock:
+            claims = self.claims.get(list_name, self.lost.get(list_name))
+            if claims is None:
+                return 0
+            with claims.lock:
+                return claims.inflight
+
+    def close(self):
+        '''Stop renewing the leases, return all buffered release numbers
+           to the queues and give up the leases'''
+        if self.keep_alive_thread is not None:
+            self.stop.set()
+            self.keep_alive_thread.join()
+        with self.lock:
+            for list_name, claims in self.claims.items():
+                claims.release()
+                if self.leases:
+                    self.work_queue.release_lease(list_name)
+            for claims in self.lost.values():
+                claims.release()
+            self.claims = {}
+            self.lost = {}
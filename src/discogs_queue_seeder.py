@@ -4,12 +4,20 @@
 #
 # Copyright - Armijn Hemel
 
+import array
 import math
+import pathlib
+import sqlite3
 import sys
+import time
 
 import click
 import redis
 
+import discogs_queue
+import discogs_results
+import discogs_tombstones
+
 REDIS_LISTS = {1: 'discogs-1M', 2: 'discogs-2M', 3: 'discogs-3M',
                4: 'discogs-4M', 5: 'discogs-5M', 6: 'discogs-6M',
                7: 'discogs-7M', 8: 'discogs-8M', 9: 'discogs-9M',
@@ -50,50 +58,165 @@ REDIS_LISTS = {1: 'discogs-1M', 2: 'discogs-2M', 3: 'discogs-3M',
 }
 
 
-@click.command(short_help='Queue release numbers from the Discogs XML into redis as tasks')
+# number of release numbers of a list that are sent to the queue in one go
+QUEUE_BATCH = 100000
+
+
+class ReleaseQueuer:
+    '''Send release numbers to the queue, grouped by the list for their
+       block. Release numbers are sent in batches of QUEUE_BATCH per list
+       while they are added, so at most one batch per list is kept in
+       memory.'''
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.lists = {}
+        self.count = 0
+
+    def add(self, release_ids):
+        '''Add release numbers (an iterable) to the queue'''
+        for release_id in release_ids:
+            list_name = REDIS_LISTS[math.ceil(release_id/1000000)]
+            if list_name not in self.lists:
+                self.lists[list_name] = array.array('I')
+            self.lists[list_name].append(release_id)
+            if len(self.lists[list_name]) == QUEUE_BATCH:
+                self.work_queue.push(list_name, self.lists.pop(list_name))
+            self.count += 1
+
+    def flush(self):
+        '''Send the remaining release numbers to the queue'''
+        for list_name, release_ids in self.lists.items():
+            self.work_queue.push(list_name, release_ids)
+        self.lists = {}
+
+
+def skip_tombstones(release_ids, tombstones, skipped):
+    '''Generator passing through release numbers that are not in a
+       bitmap of removed releases, counting the skipped releases'''
+    for release_id in release_ids:
+        if release_id in tombstones:
+            skipped[0] += 1
+            continue
+        yield release_id
+
+
+@click.command(short_help='Queue release numbers from the Discogs XML as tasks')
 @click.option('--new-result-file', '-n', 'new_result_file', required=True,
               help='new results file', type=click.Path(exists=True))
 @click.option('--old-result-file', '-o', 'old_result_file', help='old results file',
               type=click.Path(exists=True))
+@click.option('--queue', 'queue_backend', default='redis', help='queue backend (default: redis)',
+              type=click.Choice(discogs_queue.BACKENDS))
+@click.option('--queue-file', default=discogs_queue.DEFAULT_QUEUE_FILE,
+              help=f'SQLite queue (default: {discogs_queue.DEFAULT_QUEUE_FILE})',
+              type=click.Path(path_type=pathlib.Path))
+@click.option('--redis-host', default='localhost', help='Redis host (default: localhost)')
+@click.option('--redis-port', default=6379, help='Redis port (default: 6379)', type=int)
+@click.option('--tombstones', 'tombstone_file', help='skip releases recorded as removed by the crawlers',
+              type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path))
+@click.option('--recheck-after', type=click.FloatRange(min=0),
+              help='queue removed releases again when they were last checked this number of days ago (default: never)')
 @click.option('--verbose', '-v', help='verbose (default: False)', is_flag=True, default=False)
-def main(new_result_file, old_result_file, verbose):
-    # first check if redis is running or not
-    try:
-        redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
+def main(new_result_file, old_result_file, queue_backend, queue_file, redis_host, redis_port,
+         tombstone_file, recheck_after, verbose):
+    redis_client = None
+    if queue_backend == 'redis':
+        # first check if redis is running or not
+        try:
+            redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+
+            # check if Redis is running
+            redis_client.ping()
+        except redis.exceptions.ConnectionError as e:
+            print("Cannot connect to Redis server", e, file=sys.stderr)
+            sys.exit(1)
 
-        # check if Redis is running
-        redis_client.ping()
-    except redis.exceptions.ConnectionError as e:
-        print("Cannot connect to Redis server", e, file=sys.stderr)
+    try:
+        work_queue = discogs_queue.open_queue(queue_backend, redis_client=redis_client,
+                                              queue_file=queue_file)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot open queue", e, file=sys.stderr)
         sys.exit(1)
 
-    old_releases = set()
+    # releases that the crawlers found to be removed are not queued
+    # (unless they were last checked too long ago and should be checked again)
+    tombstones = None
+    skipped = [0]
+    if tombstone_file is not None:
+        since = None
+        if recheck_after is not None:
+            since = time.time() - recheck_after * 86400
+        try:
+            tombstone_store = discogs_tombstones.TombstoneStore(tombstone_file)
+            tombstones = tombstone_store.bitmap(since)
+            tombstone_store.close()
+        except sqlite3.Error as e:
+            print(f"Cannot read tombstones {tombstone_file}", e, file=sys.stderr)
+            sys.exit(1)
 
     try:
         if old_result_file is not None:
-            with open(old_result_file, 'r') as result_file:
-                for line in result_file:
-                    release_id, release_hash = line.strip().split()
-                    release_id = int(release_id)
-                    old_releases.add((release_id, release_hash))
+            # hashes computed in different ways cannot be compared
+            new_hash_mode = discogs_results.read_hash_mode(new_result_file)
+            old_hash_mode = discogs_results.read_hash_mode(old_result_file)
+            if new_hash_mode != old_hash_mode:
+                print(f"Hash modes differ (new: {new_hash_mode}, old: {old_hash_mode}), exiting",
+                      file=sys.stderr)
+                sys.exit(1)
+
+        # release numbers are sent to the queue in batches per list
+        # while the result files are read
+        def filter_releases(release_ids):
+            if tombstones is None:
+                return release_ids
+            return skip_tombstones(release_ids, tombstones, skipped)
+
+        queuer = ReleaseQueuer(work_queue)
+        if old_result_file is None:
+            queuer.add(filter_releases(release_id for release_id, _ in
+                                       discogs_results.read_digests(new_result_file)))
+        else:
+            # both files are normally sorted by release number, so they
+            # can be compared by reading them in lockstep. Release numbers
+            # are queued during the comparison, which cannot be undone if
+            # it fails halfway, so it is checked first that they are sorted.
+            try:
+                discogs_results.check_result_file(new_result_file)
+                discogs_results.check_result_file(old_result_file)
+                is_sorted = True
+            except discogs_results.UnsortedResults as e:
+                if verbose:
+                    print(f"Results are not sorted ({e}), comparing with a sorted copy")
+                is_sorted = False
 
+            if is_sorted:
+                queuer.add(filter_releases(discogs_results.diff_sorted(
+                                           discogs_results.read_digests(new_result_file),
+                                           discogs_results.read_digests(old_result_file))))
+            else:
+                # use a sorted copy of the old results, or a memory mapped
+                # binary result file (which is always sorted)
+                if discogs_results.is_binary(old_result_file):
+                    old_releases = discogs_results.BinaryResults(old_result_file)
+                else:
+                    old_releases = discogs_results.SortedResults(
+                                   discogs_results.read_digests(old_result_file),
+                                   pathlib.Path(old_result_file).resolve().parent)
+                try:
+                    if verbose:
+                        print(f"Found {len(old_releases)} old releases")
+                    queuer.add(filter_releases(release_id for release_id, release_hash in
+                                               discogs_results.read_digests(new_result_file)
+                                               if (release_id, release_hash) not in old_releases))
+                finally:
+                    old_releases.close()
+        queuer.flush()
+        new_releases = queuer.count
+        work_queue.close()
         if verbose:
-            print(f"Found {len(old_releases)} old releases")
-
-        new_releases = 0
-        with redis_client.pipeline(transaction=False) as pipe:
-            with open(new_result_file, 'r') as result_file:
-                for line in result_file:
-                    release_id, release_hash = line.strip().split()
-                    release_id = int(release_id)
-                    if (release_id, release_hash) in old_releases:
-                        continue
-                    list_nr = math.ceil(release_id/1000000)
-                    pipe.rpush(REDIS_LISTS[list_nr], release_id)
-                    new_releases += 1
-            pipe.execute()
-            if verbose:
-                print(f"Queuing {new_releases} new/changed releases")
+            if tombstones is not None:
+                print(f"Skipping {skipped[0]} removed releases")
+            print(f"Queuing {new_releases} new/changed releases")
 
     except Exception as e:
         print("Cannot process dump file", e, file=sys.stderr)
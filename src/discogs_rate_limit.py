@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# Token bucket rate limiter for the Discogs API, calibrated using the
+# rate limit headers that Discogs sends with every response.
+#
+# Discogs uses a moving window of 60 seconds: a token is allowed to make
+# a fixed number of requests (reported in X-Discogs-Ratelimit) in any
+# 60 second window. Instead of sending requests as fast as possible until
+# the limit is hit and then sleeping, requests are paced so that they are
+# spread evenly over the window.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import redis
+
+import discogs_metrics
+
+# rate limit for authenticated requests, used until Discogs reports
+# the actual rate limit
+DEFAULT_RATE_LIMIT = 60
+
+# length of the window used by Discogs, in seconds
+RATE_LIMIT_WINDOW = 60
+
+# time to sleep after a 429 response without a (valid) Retry-After header
+DEFAULT_SLEEP = 60
+
+STORES = ['local', 'file', 'redis']
+
+# errors raised when a shared bucket cannot be read or updated. While
+# they occur the bucket of the process is used instead.
+STORE_ERRORS = (OSError, redis.exceptions.RedisError)
+
+# Lua script to take a token from a bucket stored in Redis. The time
+# of the Redis server is used, so the clocks of the crawlers do not
+# matter. Returns the number of seconds to wait before trying again
+# (as a string, as Redis truncates numbers returned by Lua).
+REDIS_TAKE_SCRIPT = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'pause_until')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local pause_until = tonumber(state[3]) or 0
+if now < pause_until then
+    return tostring(pause_until - now)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+'''
+
+# Lua script to empty a bucket and optionally stop handing out
+# tokens for a number of seconds.
+REDIS_PAUSE_SCRIPT = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local pause_until = math.max(tonumber(redis.call('HGET', KEYS[1], 'pause_until')) or 0,
+                             now + tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'tokens', '0', 'ts', tostring(now),
+           'pause_until', tostring(pause_until))
+redis.call('EXPIRE', KEYS[1], 3600)
+return 1
+'''
+
+
+def take_token(state, now, rate, capacity):
+    '''Take a token from a bucket (a dict with 'tokens', 'ts' and
+       'pause_until'). Returns the number of seconds to wait before
+       trying again, or 0 if a token was taken.'''
+    if now < state.get('pause_until', 0):
+        return state['pause_until'] - now
+    tokens = state.get('tokens', capacity)
+    ts = state.get('ts', now)
+    tokens = min(capacity, tokens + max(0, now - ts) * rate)
+    wait = 0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        wait = (1 - tokens) / rate
+    state['tokens'] = tokens
+    state['ts'] = now
+    return wait
+
+
+def pause_bucket(state, now, seconds):
+    '''Empty a bucket and stop handing out tokens for a number of seconds'''
+    state['tokens'] = 0
+    state['ts'] = now
+    state['pause_until'] = max(state.get('pause_until', 0), now + seconds)
+
+
+class TokenBucket:
+    '''Token bucket shared by all threads in a process. This is also the
+       fallback of the shared buckets (see _shared()).'''
+    def __init__(self, fill_ratio=0.95, burst=1, backoff=5):
+        self.fill_ratio = fill_ratio
+        self.burst = burst
+        self.backoff = backoff
+        self.rate = DEFAULT_RATE_LIMIT * fill_ratio / RATE_LIMIT_WINDOW
+        self.state = {}
+        self.lock = threading.Lock()
+        self.store_failed = False
+
+    def _take(self, rate, capacity):
+        with self.lock:
+            return take_token(self.state, time.monotonic(), rate, capacity)
+
+    def _pause(self, seconds):
+        with self.lock:
+            pause_bucket(self.state, time.monotonic(), seconds)
+
+    def _shared(self, method, *args):
+        '''Call _take() or _pause(). If a shared bucket cannot be reached
+           the bucket of this process is used, so a crawler keeps going
+           (at the rate of a single crawler) until it can be reached
+           again.'''
+        try:
+            result = getattr(self, method)(*args)
+        except STORE_ERRORS as e:
+            discogs_metrics.increment('errors', 'rate_limit')
+            if not self.store_failed:
+                print("Cannot reach the shared rate limit, using the rate limit of this process", e,
+                      file=sys.stderr)
+                self.store_failed = True
+            return getattr(TokenBucket, method)(self, *args)
+        if self.store_failed:
+            print("Using the shared rate limit again", file=sys.stderr)
+            self.store_failed = False
+        return result
+
+    def acquire(self):
+        '''Block until a request is allowed'''
+        while True:
+            wait = self._shared('_take', self.rate, self.burst)
+            if wait <= 0:
+                return
+            discogs_metrics.increment('rate_limit_sleep_seconds', value=wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''Stop all requests for a number of seconds'''
+        print(f"Rate limiting, sleeping for {seconds} seconds", file=sys.stderr)
+        sys.stderr.flush()
+        discogs_metrics.increment('rate_limit_pauses')
+        self._shared('_pause', seconds)
+
+    def retry_after(self, headers):
+        '''Pause after a 429 response'''
+        try:
+            self.pause(int(headers['Retry-After']))
+        except (KeyError, ValueError):
+            self.pause(DEFAULT_SLEEP)
+
+    def update(self, headers):
+        '''Calibrate the bucket using the rate limit headers'''
+        try:
+            if 'X-Discogs-Ratelimit' in headers:
+                limit = int(headers['X-Discogs-Ratelimit'])
+                if limit > 0:
+                    self.rate = limit * self.fill_ratio / RATE_LIMIT_WINDOW
+            if 'X-Discogs-Ratelimit-Remaining' in headers:
+                remaining = int(headers['X-Discogs-Ratelimit-Remaining'])
+                if remaining == 0:
+                    # requests from outside this bucket (for example a
+                    # client using the same token) have used up the
+                    # window, so wait for it to move.
+                    self.pause(self.backoff)
+        except ValueError:
+            pass
+
+
+class FileTokenBucket(TokenBucket):
+    '''Token bucket shared by all processes on the same host that use
+       the same Discogs token, stored in a file protected by a lock'''
+    def __init__(self, token, fill_ratio=0.95, burst=1, backoff=5, directory=None):
+        super().__init__(fill_ratio, burst, backoff)
+        if directory is None:
+            directory = tempfile.gettempdir()
+        token_hash = hashlib.sha256(token.encode()).hexdigest()[:16]
+        self.path = os.path.join(directory, f'discogs-ratelimit-{token_hash}.json')
+
+    def _update_state(self, func):
+        with open(self.path, 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read())
+                except ValueError:
+                    state = {}
+                # the wall clock is used as it is shared between processes
+                result = func(state, time.time())
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+        return result
+
+    def _take(self, rate, capacity):
+        return self._update_state(lambda state, now: take_token(state, now, rate, capacity))
+
+    def _pause(self, seconds):
+        self._update_state(lambda state, now: pause_bucket(state, now, seconds))
+
+
+class RedisTokenBucket(TokenBucket):
+    '''Token bucket shared by all crawlers that use the same Discogs
+       token and Redis server'''
+    def __init__(self, redis_client, token, fill_ratio=0.95, burst=1, backoff=5):
+        super().__init__(fill_ratio, burst, backoff)
+        token_hash = hashlib.sha256(token.encode()).hexdigest()[:16]
+        self.key = f'discogs-ratelimit:{token_hash}'
+        self.take_script = redis_client.register_script(REDIS_TAKE_SCRIPT)
+        self.pause_script = redis_client.register_script(REDIS_PAUSE_SCRIPT)
+
+    def _take(self, rate, capacity):
+        return float(self.take_script(keys=[self.key], args=[rate, capacity]))
+
+    def _pause(self, seconds):
+        self.pause_script(keys=[self.key], args=[seconds])
+
+
+def open_rate_limiter(store, token, redis_client=None, fill_ratio=0.95, burst=1, backoff=5):
+    '''Create a rate limiter using the configured store'''
+    if store == 'redis':
+        return RedisTokenBucket(redis_client, token, fill_ratio, burst, backoff)
+    if store == 'file':
+        return FileTokenBucket(token, fill_ratio, burst, backoff)
+    return TokenBucket(fill_ratio, burst, backoff)
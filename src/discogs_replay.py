@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Rebuild (or clean up again) the Git repository with the releases from
+# an archive of raw responses (see discogs_archive.py) instead of
+# downloading them from Discogs, for example after changing the fields
+# that are removed. For every release the latest response in the archive
+# is used.
+#
+# Reading and cleaning up the releases is done by several processes, the
+# releases are compared and written to Git by the main process only.
+#
+# Like the crawler the script takes the lease on a block (see
+# discogs_queue.py) before writing to it, so it does not write to a block
+# at the same time as a crawler. The leases on all blocks in the archive
+# are taken before anything is written. The queue is configured in the
+# same way as for the crawler.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import math
+import multiprocessing
+import pathlib
+import sqlite3
+import sys
+import time
+
+import click
+import dulwich.errors
+import redis
+
+import crawler_for_discogs
+import discogs_archive
+import discogs_fields
+import discogs_metrics
+import discogs_queue
+import discogs_storage
+
+# import YAML module for the configuration
+from yaml import load
+from yaml import YAMLError
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+# fields to remove, set in every worker process
+REMOVES = None
+
+
+def init_worker(removes):
+    global REMOVES
+    REMOVES = removes
+
+
+class LeaseError(Exception):
+    pass
+
+
+class LeaseLost(LeaseError):
+    pass
+
+
+class BlockLeases:
+    '''Leases on the blocks that are written to. The leases are taken
+       before anything is written and renewed every quarter of the
+       visibility timeout of the queue.'''
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.held = set()
+        self.renewed = time.monotonic()
+
+    def acquire(self, blocks):
+        '''Take the leases on blocks, raise LeaseError if one of them is
+           held by another worker'''
+        for block in blocks:
+            list_name = crawler_for_discogs.LISTS_READ[block]
+            if not self.work_queue.acquire_lease(list_name):
+                raise LeaseError(f"block {block} is being crawled")
+            self.held.add(list_name)
+        self.renewed = time.monotonic()
+
+    def renew(self):
+        '''Renew the leases if they are due, raise LeaseLost if a lease
+           could not be renewed'''
+        if time.monotonic() - self.renewed > self.work_queue.visibility_timeout / 4:
+            for held in self.held:
+                try:
+                    renewed = self.work_queue.acquire_lease(held)
+                except discogs_queue.QUEUE_ERRORS as e:
+                    raise LeaseLost(f"cannot renew lease on {held}: {e}") from e
+                if not renewed:
+                    raise LeaseLost(f"lost lease on {held}")
+            self.renewed = time.monotonic()
+
+    def release(self):
+        for list_name in self.held:
+            self.work_queue.release_lease(list_name)
+        self.held = set()
+
+
+def clean_chunk(task):
+    '''Read a chunk from the archive and clean up the latest responses
+       of the given releases. Returns a list of (release number,
+       serialized release) tuples.'''
+    directory, segment, offset, length, release_ids = task
+    releases = {}
+    for record in discogs_archive.read_chunk(directory, segment, offset, length):
+        # a release can be in a chunk more than once, the last one is the latest
+        if record['id'] in release_ids:
+            releases[record['id']] = record['release']
+    results = []
+    for release_id, json_data in sorted(releases.items()):
+        discogs_fields.remove_fields(json_data, REMOVES)
+        results.append((release_id, crawler_for_discogs.serialize_release(json_data)))
+    return results
+
+
+@click.command(short_help='rebuild the Git repository from an archive of raw responses')
+@click.option('--config-file', '-c', required=True, help='configuration file (YAML)',
+              type=click.File('r'))
+@click.option('--archive', '-a', 'archive_directory', help='archive directory (override config)',
+              type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path))
+@click.option('-g', '--git', help='Location of Git repository (override config)',
+              type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option('--jobs', '-j', 'jobs', default=1, help='number of worker processes (default: 1)',
+              type=click.IntRange(min=1))
+@click.option('--queue', 'queue_backend', type=click.Choice(discogs_queue.BACKENDS),
+              help='Queue backend used for the leases on blocks (override config)')
+@click.option('--batch-size', type=click.IntRange(min=1), default=10000,
+              help='Number of changed releases per Git commit (default: 10000)')
+@click.option('--verbose', '-v', help='verbose (default: False)', is_flag=True, default=False)
+def main(config_file, archive_directory, git, jobs, queue_backend, batch_size, verbose):
+    removes = []
+    remove_thumbnails = True
+    discogs_git = None
+    archive_config_directory = None
+    git_layout = 'flat'
+    git_repository_mode = 'single'
+    use_index = True
+    index_file = None
+    queue_config_backend = 'redis'
+    queue_file = pathlib.Path(discogs_queue.DEFAULT_QUEUE_FILE)
+    queue_visibility_timeout = discogs_queue.DEFAULT_VISIBILITY_TIMEOUT
+    redis_host = 'localhost'
+    redis_port = 6379
+
+    try:
+        config = load(config_file, Loader=Loader)
+        if 'fields' in config:
+            if 'remove' in config['fields']:
+                for remove_item in config['fields']['remove']:
+                    removes.append(remove_item)
+            if 'remove_thumbnails' in config['fields']:
+                remove_thumbnails = bool(config['fields']['remove_thumbnails'])
+        if 'git' in config:
+            if 'layout' in config['git']:
+                git_layout = config['git']['layout']
+                if git_layout not in discogs_storage.LAYOUTS:
+                    raise ValueError(f"invalid layout {git_layout}")
+            if 'repository' in config['git']:
+                git_repository_mode = config['git']['repository']
+                if git_repository_mode not in discogs_storage.REPOSITORY_MODES:
+                    raise ValueError(f"invalid repository mode {git_repository_mode}")
+            if 'index' in config['git']:
+                use_index = bool(config['git']['index'])
+            if 'index_file' in config['git']:
+                index_file = pathlib.Path(config['git']['index_file'])
+        if 'archive' in config:
+            if 'directory' in config['archive']:
+                archive_config_directory = pathlib.Path(config['archive']['directory'])
+        if 'queue' in config:
+            if 'backend' in config['queue']:
+                queue_config_backend = config['queue']['backend']
+                if queue_config_backend not in discogs_queue.BACKENDS:
+                    raise ValueError(f"invalid queue backend {queue_config_backend}")
+            if 'file' in config['queue']:
+                queue_file = pathlib.Path(config['queue']['file'])
+            if 'visibility_timeout' in config['queue']:
+                queue_visibility_timeout = int(config['queue']['visibility_timeout'])
+        if 'redis' in config:
+            if 'host' in config['redis']:
+                redis_host = config['redis']['host']
+            if 'port' in config['redis']:
+                redis_port = int(config['redis']['port'])
+    except (YAMLError, PermissionError, UnicodeDecodeError, ValueError) as e:
+        print(f"Cannot open configuration file, exiting, {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if remove_thumbnails:
+        removes += discogs_fields.THUMBNAIL_FIELDS
+    removes = discogs_fields.compile_removes(removes)
+
+    if git is not None:
+        discogs_git = git
+
+    if archive_directory is None:
+        archive_directory = archive_config_directory
+
+    if queue_backend is None:
+        queue_backend = queue_config_backend
+
+    if discogs_git is None:
+        print("Git repository not supplied in either configuration or command line, exiting",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if archive_directory is None or not (archive_directory / discogs_archive.INDEX_FILE).exists():
+        print("Archive not supplied in either configuration or command line, or has no index, exiting",
+              file=sys.stderr)
+        sys.exit(1)
+
+    redis_client = None
+    try:
+        if queue_backend == 'redis':
+            redis_client = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+
+            # check if Redis is running
+            redis_client.ping()
+        work_queue = discogs_queue.open_queue(queue_backend, redis_client=redis_client,
+                                              queue_file=queue_file,
+                                              visibility_timeout=queue_visibility_timeout)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot open queue", e, file=sys.stderr)
+        sys.exit(1)
+    leases = BlockLeases(work_queue)
+
+    stores = crawler_for_discogs.BlockStores(discogs_git, git_repository_mode, batch_size=batch_size,
+                                             use_index=use_index, index_file=index_file)
+
+    index = discogs_archive.open_index(archive_directory)
+    tasks = ((archive_directory,) + chunk for chunk in discogs_archive.latest_chunks(index))
+
+    try:
+        leases.acquire(discogs_archive.archive_blocks(index))
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(removes,)) as pool:
+            for results in pool.imap(clean_chunk, tasks):
+                for release_id, data in results:
+                    leases.renew()
+                    block = math.ceil(release_id/1000000)
+                    store, git_directory, content_index = stores.open(block)
+                    crawler_for_discogs.store_release(release_id, data, git_directory, store,
+                                                      content_index, git_layout)
+        stores.close()
+    except LeaseLost as e:
+        # the releases that were written are committed, so the
+        # working tree and the Git index match HEAD again
+        print(f"Cannot renew lease, {e}, committing and exiting", file=sys.stderr)
+        try:
+            stores.close()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print("Cannot commit releases", e, file=sys.stderr)
+        sys.exit(1)
+    except LeaseError as e:
+        # the leases are taken before anything is written,
+        # so the Git repository has not been changed
+        print(f"Cannot take lease, {e}, exiting", file=sys.stderr)
+        sys.exit(1)
+    except dulwich.errors.NotGitRepository:
+        print(f"{discogs_git} is not a valid Git repository, exiting", file=sys.stderr)
+        sys.exit(1)
+    except discogs_queue.QUEUE_ERRORS as e:
+        print("Cannot connect to queue", e, file=sys.stderr)
+        sys.exit(1)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print("Cannot replay archive", e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        index.close()
+        try:
+            leases.release()
+            work_queue.close()
+        except discogs_queue.QUEUE_ERRORS as e:
+            print("Cannot connect to queue", e, file=sys.stderr)
+
+    if verbose:
+        print(discogs_metrics.REGISTRY.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
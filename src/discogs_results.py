@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+# Helper functions to read and write the result files with release
+# numbers and hashes that are created by discogs_xml_split.py and
+# used by discogs_queue_seeder.py
+#
+# There are two formats:
+#
+# * text: a line per release with the release number and the hexadecimal
+#   SHA1, separated by a tab, preceded by a header line recording the
+#   hash mode if it is not the default
+# * binary: a fixed size header followed by fixed size records, sorted by
+#   release number, each with a little endian release number and a 20 byte
+#   binary SHA1. The file can be memory mapped and searched using a binary
+#   search.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import bisect
+import heapq
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import tempfile
+
+import click
+
+# Hash modes:
+#
+# * etree: hash the XML as serialized by ElementTree's tostring()
+# * raw: hash the original bytes of the release in the dump
+HASH_MODES = ['etree', 'raw']
+
+# result files without a header were created before the hash
+# mode was recorded and always use the ElementTree serialization
+DEFAULT_HASH_MODE = 'etree'
+
+HEADER_PREFIX = '#hash-mode\t'
+
+FORMATS = ['text', 'binary']
+
+# size of a binary SHA1 digest
+DIGEST_SIZE = 20
+
+# binary format: magic, version, hash mode (index in HASH_MODES),
+# padding and the number of records
+BINARY_MAGIC = b'DSCGHASH'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sBB6xQ')
+BINARY_RECORD = struct.Struct('<I20s')
+
+# number of records read from a binary file in one go
+READ_RECORDS = 65536
+
+# number of records that are sorted in memory at a time when sorting a
+# binary file, the sorted runs are merged from temporary files
+SORT_RECORDS = 262144
+
+
+class UnsortedResults(Exception):
+    '''Raised when a result file is not sorted by release number'''
+
+
+def is_binary(result_file_name):
+    '''Check if a result file uses the binary format'''
+    with open(result_file_name, 'rb') as result_file:
+        return result_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read_binary_header(result_file):
+    '''Read the header of a binary result file, returns the hash
+       mode and the number of records'''
+    magic, version, hash_mode, count = BINARY_HEADER.unpack(result_file.read(BINARY_HEADER.size))
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("unsupported binary result file")
+    return HASH_MODES[hash_mode], count
+
+
+def write_header(result_file, hash_mode):
+    '''Record the hash mode in a (text) result file. The default mode is
+       not recorded, so the file is the same as one made by older versions
+       of the scripts.'''
+    if hash_mode != DEFAULT_HASH_MODE:
+        result_file.write(f"{HEADER_PREFIX}{hash_mode}\n")
+
+
+def read_hash_mode(result_file_name):
+    '''Return the hash mode that was used to create a result file'''
+    if is_binary(result_file_name):
+        with open(result_file_name, 'rb') as result_file:
+            return read_binary_header(result_file)[0]
+
+    with open(result_file_name, 'r') as result_file:
+        line = result_file.readline()
+    if line.startswith(HEADER_PREFIX):
+        return line[len(HEADER_PREFIX):].strip()
+    return DEFAULT_HASH_MODE
+
+
+def read_digests(result_file_name):
+    '''Generator yielding (release number, binary digest) tuples from a
+       result file in either format'''
+    if is_binary(result_file_name):
+        with open(result_file_name, 'rb') as result_file:
+            _, count = read_binary_header(result_file)
+            while count:
+                records = min(count, READ_RECORDS)
+                yield from BINARY_RECORD.iter_unpack(result_file.read(records * BINARY_RECORD.size))
+                count -= records
+        return
+
+    with open(result_file_name, 'r') as result_file:
+        for line in result_file:
+            if line.startswith('#'):
+                continue
+            release_id, release_hash = line.strip().split()
+            yield int(release_id), bytes.fromhex(release_hash)
+
+
+def read_results(result_file_name):
+    '''Generator yielding (release number, hash) tuples from a result
+       file in either format, with the hash in hexadecimal'''
+    for release_id, digest in read_digests(result_file_name):
+        yield release_id, digest.hex()
+
+
+class TextResultWriter:
+    '''Write results in the text format. If length is given the results
+       in an existing file are kept up to length (in bytes) and new
+       results are appended.'''
+    def __init__(self, result_file_name, hash_mode, length=None):
+        if length is None:
+            self.result_file = open(result_file_name, 'w')
+            write_header(self.result_file, hash_mode)
+        else:
+            self.result_file = open(result_file_name, 'r+')
+            self.result_file.truncate(length)
+            self.result_file.seek(length)
+
+    def write(self, results):
+        '''Write a list of (release number, binary digest) tuples'''
+        self.result_file.write(''.join([f"{release_id}\t{digest.hex()}\n"
+                                        for release_id, digest in results]))
+
+    def length(self):
+        '''Length of the file with the results written so far'''
+        return self.result_file.tell()
+
+    def sync(self):
+        '''Write the results to disk'''
+        self.result_file.flush()
+        os.fsync(self.result_file.fileno())
+
+    def state(self):
+        '''State needed to continue writing after a restart (together
+           with length())'''
+        return {}
+
+    def close(self):
+        self.result_file.close()
+
+
+def read_records(record_file):
+    '''Generator yielding (release number, binary digest) tuples from
+       the current position of a file with binary records'''
+    while data := record_file.read(READ_RECORDS * BINARY_RECORD.size):
+        yield from BINARY_RECORD.iter_unpack(data)
+
+
+class BinaryResultWriter:
+    '''Write results in the binary format. Results are expected in order
+       of release number. If they are not, the records are sorted when
+       the file is closed, in runs of SORT_RECORDS records that are
+       written to temporary files (next to the result file) and merged.
+       If length is given the records in an existing file are kept up to
+       length (in bytes) and new records are appended, state is the
+       result of state() when the file had that length.'''
+    def __init__(self, result_file_name, hash_mode, length=None, state=None):
+        self.directory = pathlib.Path(result_file_name).resolve().parent
+        self.hash_mode = HASH_MODES.index(hash_mode)
+        self.count = 0
+        self.last_id = -1
+        self.is_sorted = True
+        if length is None:
+            self.result_file = open(result_file_name, 'w+b')
+            self._write_header()
+        else:
+            self.result_file = open(result_file_name, 'r+b')
+            self.result_file.truncate(length)
+            self.result_file.seek(length)
+            self.count = (length - BINARY_HEADER.size) // BINARY_RECORD.size
+            if state is not None:
+                self.last_id = state['last_id']
+                self.is_sorted = state['sorted']
+
+    def _write_header(self):
+        self.result_file.seek(0)
+        self.result_file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                                  self.hash_mode, self.count))
+
+    def write(self, results):
+        '''Write a list of (release number, binary digest) tuples'''
+        for release_id, digest in results:
+            if release_id <= self.last_id:
+                self.is_sorted = False
+            self.last_id = release_id
+            self.result_file.write(BINARY_RECORD.pack(release_id, digest))
+        self.count += len(results)
+
+    def length(self):
+        '''Length of the file with the records written so far'''
+        return self.result_file.tell()
+
+    def sync(self):
+        '''Write the records to disk'''
+        self.result_file.flush()
+        os.fsync(self.result_file.fileno())
+
+    def state(self):
+        '''State needed to continue writing after a restart (together
+           with length())'''
+        return {'last_id': self.last_id, 'sorted': self.is_sorted}
+
+    def _sort(self):
+        runs = []
+        try:
+            self.result_file.seek(BINARY_HEADER.size)
+            while data := self.result_file.read(SORT_RECORDS * BINARY_RECORD.size):
+                run = tempfile.TemporaryFile(dir=self.directory)
+                runs.append(run)
+                run.write(b''.join([BINARY_RECORD.pack(*record)
+                                    for record in sorted(BINARY_RECORD.iter_unpack(data))]))
+                run.seek(0)
+
+            # the records are all in the runs, so the
+            # result file can be overwritten in place
+            self.result_file.seek(BINARY_HEADER.size)
+            batch = []
+            for record in heapq.merge(*[read_records(run) for run in runs]):
+                batch.append(BINARY_RECORD.pack(*record))
+                if len(batch) == READ_RECORDS:
+                    self.result_file.write(b''.join(batch))
+                    batch = []
+            self.result_file.write(b''.join(batch))
+        finally:
+            for run in runs:
+                run.close()
+
+    def close(self):
+        try:
+            if not self.is_sorted:
+                self._sort()
+            self._write_header()
+        finally:
+            self.result_file.close()
+
+
+def open_writer(result_file_name, hash_mode, result_format='text', length=None, state=None):
+    '''Open a result file for writing in the given format. If length
+       is given writing continues in an existing file (see length() and
+       state() of the writers).'''
+    if result_format == 'binary':
+        return BinaryResultWriter(result_file_name, hash_mode, length, state)
+    return TextResultWriter(result_file_name, hash_mode, length)
+
+
+class BinaryResults:
+    '''Memory mapped binary result file, in which releases can be
+       found using a binary search'''
+    def __init__(self, result_file_name):
+        with open(result_file_name, 'rb') as result_file:
+            self.hash_mode, self.count = read_binary_header(result_file)
+            self.mmap = mmap.mmap(result_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        '''Return the release number of a record'''
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return BINARY_RECORD.unpack_from(self.mmap, BINARY_HEADER.size + idx * BINARY_RECORD.size)[0]
+
+    def get(self, release_id):
+        '''Return the digest for a release, or None if it is not found'''
+        idx = bisect.bisect_left(self, release_id)
+        if idx == self.count:
+            return None
+        found_id, digest = BINARY_RECORD.unpack_from(self.mmap,
+                                                     BINARY_HEADER.size + idx * BINARY_RECORD.size)
+        if found_id != release_id:
+            return None
+        return digest
+
+    def __contains__(self, result):
+        release_id, digest = result
+        return self.get(release_id) == digest
+
+    def close(self):
+        self.mmap.close()
+
+
+def check_sorted(results):
+    '''Generator passing through (release number, hash) tuples, raising
+       UnsortedResults if they are not sorted by release number'''
+    previous_id = -1
+    for release_id, release_hash in results:
+        if release_id <= previous_id:
+            raise UnsortedResults(f"release {release_id} after {previous_id}")
+        previous_id = release_id
+        yield release_id, release_hash
+
+
+def check_result_file(result_file_name):
+    '''Raise UnsortedResults if a result file is not sorted by release
+       number. Binary result files are always sorted.'''
+    if is_binary(result_file_name):
+        return
+    for _ in check_sorted(read_digests(result_file_name)):
+        pass
+
+
+def diff_sorted(new_results, old_results):
+    '''Generator yielding the release numbers from new_results that are
+       not in old_results, or that have a different hash. Both are
+       iterables of (release number, hash) sorted by release number,
+       which are read in lockstep. Raises UnsortedResults if either of
+       them turns out not to be sorted (possibly after release numbers
+       have been yielded).'''
+    old_results = check_sorted(old_results)
+    old_id, old_hash = next(old_results, (None, None))
+    for release_id, release_hash in check_sorted(new_results):
+        while old_id is not None and old_id < release_id:
+            old_id, old_hash = next(old_results, (None, None))
+
+        if old_id == release_id and old_hash == release_hash:
+            continue
+        yield release_id
+
+    # check the rest of the old results, as results
+    # that were yielded are only valid if it is sorted
+    for _ in old_results:
+        pass
+
+
+class SortedResults(BinaryResults):
+    '''Results that are not sorted, written to a temporary binary result
+       file in directory, which is sorted (see BinaryResultWriter) and
+       memory mapped, so releases can be found using a binary search
+       without keeping the results in memory'''
+    def __init__(self, results, directory=None):
+        fd, self.path = tempfile.mkstemp(suffix='.bin', dir=directory)
+        os.close(fd)
+        try:
+            writer = BinaryResultWriter(self.path, DEFAULT_HASH_MODE)
+            try:
+                batch = []
+                for result in results:
+                    batch.append(result)
+                    if len(batch) == READ_RECORDS:
+                        writer.write(batch)
+                        batch = []
+                writer.write(batch)
+            finally:
+                writer.close()
+            super().__init__(self.path)
+        except BaseException:
+            os.unlink(self.path)
+            raise
+
+    def close(self):
+        super().close()
+        os.unlink(self.path)
+
+
+@click.command(short_help='convert result files between the text and binary format')
+@click.option('--input', '-i', 'input_files', required=True, multiple=True,
+              help='result file to convert (several files are concatenated)',
+              type=click.Path(exists=True))
+@click.option('--output', '-o', 'output_file', required=True, help='converted result file',
+              type=click.Path())
+@click.option('--format', '-f', 'result_format', required=True, help='format of the output file',
+              type=click.Choice(FORMATS))
+def main(input_files, output_file, result_format):
+    try:
+        hash_modes = {read_hash_mode(input_file) for input_file in input_files}
+        if len(hash_modes) != 1:
+            print(f"Hash modes differ ({', '.join(sorted(hash_modes))}), exiting", file=sys.stderr)
+            sys.exit(1)
+        writer = open_writer(output_file, hash_modes.pop(), result_format)
+        try:
+            batch = []
+            for input_file in input_files:
+                for result in read_digests(input_file):
+                    batch.append(result)
+                    if len(batch) == READ_RECORDS:
+                        writer.write(batch)
+                        batch = []
+            writer.write(batch)
+        finally:
+            writer.close()
+    except Exception as e:
+        print("Cannot convert result file", e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
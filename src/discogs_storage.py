@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Storage of release data in a Git repository.
+#
+# Changes are collected in memory and committed either per release or
+# in batches. Commits are made by writing blobs, trees and commits
+# directly to the object store of the repository, instead of using
+# dulwich.porcelain, which rereads and rewrites the complete index and
+# walks the complete tree for every commit.
+#
+# Releases can be stored in different layouts:
+#
+# * flat: all releases of a block in a single directory:
+#   <block>/<release>.json
+# * nested: the releases of a block are spread over subdirectories based
+#   on the thousands in the release number, so no directory (and tree
+#   object) has more than 1000 entries: <block>/<NNN>/<release>.json
+#
+# Blocks can be stored in a single repository (with a directory per
+# block) or in a separate repository per block.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import os
+import pathlib
+import stat
+import sys
+import time
+
+import dulwich.index
+import dulwich.object_store
+from dulwich.file import FileLocked
+from dulwich.objects import Blob, Commit, Tree
+from dulwich.repo import Repo
+
+import discogs_metrics
+
+# number of times to retry updating HEAD or the index if another
+# process changed it at the same time
+MAX_RETRIES = 10
+
+# number of commits after which the Git index is updated. Writing the
+# index means rewriting the complete file, which is slow for a big
+# repository, so it is not done for every commit.
+INDEX_INTERVAL = 100
+
+LAYOUTS = ['flat', 'nested']
+
+# store all blocks in a single repository, or use a repository per block
+REPOSITORY_MODES = ['single', 'block']
+
+
+def release_path(directory, release_id, layout):
+    '''Path of the file for a release in the directory of a block'''
+    if layout == 'nested':
+        return directory / f"{release_id // 1000 % 1000:03d}" / f"{release_id}.json"
+    return directory / f"{release_id}.json"
+
+
+def open_block_repository(git, block, repository_mode):
+    '''Open the repository used for a block and return the repository
+       and the directory in which the releases of the block are stored.
+       A repository for a block is created if it does not exist yet.'''
+    if repository_mode == 'block':
+        block_directory = git / str(block)
+        if not (block_directory / '.git').exists():
+            block_directory.mkdir(exist_ok=True)
+            return Repo.init(block_directory), block_directory
+        return Repo(block_directory), block_directory
+
+    repo = Repo(git)
+    block_directory = git / str(block)
+    block_directory.mkdir(exist_ok=True)
+    return repo, block_directory
+
+
+class GitStore:
+    '''Store files in a Git repository. Changes are committed after
+       batch_size changes, or when the oldest uncommitted change is
+       older than batch_interval seconds (if set). With a batch_size
+       of 1 every change is committed separately. If a content index
+       is given it is updated after every commit. The Git index is
+       updated every index_interval commits and when the store is
+       closed. If on_commit is given it is called with the commit id
+       and the committed changes (see pending) after every commit.'''
+    def __init__(self, repo, author, batch_size=1, batch_interval=None, index=None,
+                 on_commit=None, index_interval=INDEX_INTERVAL):
+        self.repo = repo
+        self.index = index
+        self.on_commit = on_commit
+        self.index_interval = index_interval
+        self.author = author.encode()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.repo_path = pathlib.Path(repo.path).resolve()
+
+        # uncommitted changes: path relative to the repository ->
+        # (release number, 'Add'/'Update'/'Delete'/'Move', blob id or None)
+        self.pending = {}
+        self.pending_since = None
+
+        # release number -> blob id (None for a removal) of the
+        # uncommitted changes
+        self.pending_releases = {}
+
+        # blobs that have to be written to the object store
+        self.blobs = []
+
+        # committed changes that are not in the Git index yet:
+        # path relative to the repository -> blob id or None
+        self.index_changes = {}
+        self.index_commits = 0
+
+    def _relative_path(self, path):
+        return pathlib.Path(path).resolve().relative_to(self.repo_path).as_posix().encode()
+
+    def _queue(self, path, release_id, change_type, blob_id):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        relative_path = self._relative_path(path)
+        if relative_path in self.pending and self.pending[relative_path][1] == 'Add':
+            # a file that is added and then updated in the same batch is new
+            if change_type == 'Update':
+                change_type = 'Add'
+        self.pending[relative_path] = (release_id, change_type, blob_id)
+        self.pending_releases[release_id] = blob_id
+
+    def _flush_if_full(self):
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def add(self, path, data, release_id, new=True):
+        '''Write data (bytes) to a file in the working tree and queue it
+           for the next commit'''
+        with discogs_metrics.timer('write'):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as output_file:
+                output_file.write(data)
+            blob = Blob.from_string(data)
+        self.blobs.append(blob)
+        self._queue(path, release_id, 'Add' if new else 'Update', blob.id)
+        self._flush_if_full()
+
+    def remove(self, path, release_id):
+        '''Remove a file from the working tree and queue the removal
+           for the next commit'''
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._queue(path, release_id, 'Delete', None)
+        self._flush_if_full()
+
+    def rename(self, old_path, new_path, release_id, blob_id):
+        '''Move a file (already stored in Git as blob_id) in the working
+           tree and queue the move for the next commit'''
+        os.renames(old_path, new_path)
+        self._queue(old_path, release_id, 'Move', None)
+        self._queue(new_path, release_id, 'Move', blob_id)
+        self._flush_if_full()
+
+    def discard(self, release_ids):
+        '''Drop the pending changes for releases, so they are not
+           committed. The files in the working tree are not restored.'''
+        release_ids = set(release_ids)
+        self.pending = {relative_path: change for relative_path, change in self.pending.items()
+                        if change[0] not in release_ids}
+        for release_id in release_ids:
+            self.pending_releases.pop(release_id, None)
+        blob_ids = {change[2] for change in self.pending.values()}
+        self.blobs = [blob for blob in self.blobs if blob.id in blob_ids]
+        if not self.pending:
+            self.pending_since = None
+
+    def flush_if_due(self):
+        '''Commit pending changes if the oldest change is too old'''
+        if self.pending and self.batch_interval is not None:
+            if time.monotonic() - self.pending_since >= self.batch_interval:
+                self.flush()
+
+    def _message(self):
+        # a move is recorded for both the old and the new path,
+        # only count it once
+        changes = [change for change in self.pending.values()
+                   if change[1] != 'Move' or change[2] is not None]
+        if len(changes) == 1:
+            release_id, change_type, _ = changes[0]
+            return f"{change_type} {release_id}"
+
+        counts = {}
+        for release_id, change_type, _ in changes:
+            counts[change_type] = counts.get(change_type, 0) + 1
+        summary = ', '.join([f"{change_type} {count}" for change_type, count in counts.items()])
+        details = '\n'.join([f"{change_type} {release_id}" for release_id, change_type, _ in changes])
+        return f"{summary} releases\n\n{details}\n"
+
+    def _commit(self, message):
+        '''Write a commit with all pending changes and update HEAD. If
+           HEAD was changed by another process in the meantime the
+           changes are applied to the new HEAD.'''
+        object_store = self.repo.object_store
+        if self.blobs:
+            object_store.add_objects([(blob, None) for blob in self.blobs])
+
+        changes = []
+        for relative_path, (_, _, blob_id) in sorted(self.pending.items()):
+            if blob_id is None:
+                changes.append((relative_path, None, None))
+            else:
+                changes.append((relative_path, stat.S_IFREG | 0o644, blob_id))
+
+        for _ in range(MAX_RETRIES):
+            try:
+                head = self.repo.refs[b'HEAD']
+                tree = object_store[head].tree
+            except KeyError:
+                head = None
+                tree = Tree()
+            tree_id = dulwich.object_store.commit_tree_changes(object_store, tree, changes)
+
+            commit = Commit()
+            commit.tree = tree_id
+            commit.parents = [head] if head is not None else []
+            commit.author = commit.committer = self.author
+            commit.commit_time = commit.author_time = int(time.time())
+            commit.commit_timezone = commit.author_timezone = 0
+            commit.encoding = b'UTF-8'
+            commit.message = message.encode()
+            object_store.add_object(commit)
+
+            if head is None:
+                if self.repo.refs.add_if_new(b'HEAD', commit.id):
+                    return commit.id
+            elif self.repo.refs.set_if_equals(b'HEAD', head, commit.id):
+                return commit.id
+        raise RuntimeError("HEAD changed too often while committing")
+
+    def _update_index(self):
+        '''Update the index for the files changed since the last update,
+           so it matches HEAD and the working tree'''
+        for _ in range(MAX_RETRIES):
+            try:
+                index = self.repo.open_index()
+                for relative_path, blob_id in self.index_changes.items():
+                    if blob_id is None:
+                        try:
+                            del index[relative_path]
+                        except KeyError:
+                            pass
+                    else:
+                        stat_val = os.stat(self.repo_path / relative_path.decode())
+                        index[relative_path] = dulwich.index.index_entry_from_stat(stat_val, blob_id)
+                index.write()
+                self.index_changes = {}
+                self.index_commits = 0
+                return
+            except FileLocked:
+                time.sleep(0.1)
+        # the changes are kept and written with the next update
+        print("Cannot update Git index, index is locked", file=sys.stderr)
+
+    def flush(self):
+        '''Commit all pending changes. Returns the commit id, or None
+           if there was nothing to commit.'''
+        if not self.pending:
+            return None
+        with discogs_metrics.timer('commit'):
+            commit_id = self._commit(self._message())
+            for relative_path, (_, _, blob_id) in self.pending.items():
+                self.index_changes[relative_path] = blob_id
+            self.index_commits += 1
+            if self.index_commits >= self.index_interval:
+                self._update_index()
+            if self.index is not None:
+                index_changes = {}
+                for release_id, change_type, blob_id in self.pending.values():
+                    if change_type == 'Move' and blob_id is None:
+                        continue
+                    index_changes[release_id] = blob_id
+                self.index.update(index_changes.items())
+        if self.on_commit is not None:
+            self.on_commit(commit_id, self.pending)
+        self.pending = {}
+        self.pending_since = None
+        self.pending_releases = {}
+        self.blobs = []
+        return commit_id
+
+    def close(self):
+        '''Commit all pending changes and update the Git index'''
+        self.flush()
+        if self.index_changes:
+            self._update_index()
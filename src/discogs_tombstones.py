@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Tombstones: release numbers for which the Discogs API returned 404 (the
+# release was removed, or the number was never used), with the time they
+# were first seen as removed and the time they were last checked (the last
+# 404 response). Release numbers that are retired keep
+# appearing in the lists made from the data dumps, so without tombstones
+# every one of them would be downloaded again and again, using up requests
+# that are needed for releases that changed.
+#
+# Tombstones are recorded by the crawlers in SQLite (in WAL mode, so the
+# file can be shared by all crawlers on the same host). For filtering, for
+# example by discogs_queue_seeder.py, they are loaded into a bitmap with a
+# bit per release number, which needs 1 MiB per 8 million release numbers.
+# A crawler keeps such a bitmap of the tombstones as well, so it only has to
+# write to the database for a release that was downloaded if the release
+# was removed before.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Copyright - Armijn Hemel
+
+import sqlite3
+import threading
+import time
+
+
+class Bitmap:
+    '''Set of release numbers, stored as a bitmap'''
+    def __init__(self, release_ids=()):
+        self.bits = bytearray()
+        for release_id in release_ids:
+            self.add(release_id)
+
+    def add(self, release_id):
+        idx = release_id >> 3
+        if idx >= len(self.bits):
+            self.bits.extend(bytes(idx - len(self.bits) + 1))
+        self.bits[idx] |= 1 << (release_id & 7)
+
+    def discard(self, release_id):
+        idx = release_id >> 3
+        if idx < len(self.bits):
+            self.bits[idx] &= ~(1 << (release_id & 7))
+
+    def __contains__(self, release_id):
+        idx = release_id >> 3
+        return idx < len(self.bits) and bool(self.bits[idx] & (1 << (release_id & 7)))
+
+
+class TombstoneStore:
+    '''Persistent set of removed release numbers, with the time they
+       were first seen as removed and the time they were last checked.
+       Can be shared by several threads.'''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS tombstones
+                                   (id INTEGER PRIMARY KEY, first_seen REAL NOT NULL,
+                                    last_checked REAL NOT NULL)''')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(tombstones)')]
+        if 'last_checked' not in columns:
+            # tombstone files made before the last check was recorded
+            self.connection.execute('ALTER TABLE tombstones ADD COLUMN last_checked REAL NOT NULL DEFAULT 0')
+            self.connection.execute('UPDATE tombstones SET last_checked = first_seen')
+        self.connection.commit()
+
+        # the tombstones known to this store: the ones at the time it
+        # was opened and the ones added since then
+        self.known = self.bitmap()
+
+    def add(self, release_id, seen=None):
+        '''Record that a release was removed (the Discogs API returned
+           404). The time it was first seen as removed is kept if it is
+           already known, the time it was last checked is updated.'''
+        if seen is None:
+            seen = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('''INSERT INTO tombstones (id, first_seen, last_checked) VALUES (?, ?, ?)
+                                       ON CONFLICT (id) DO UPDATE SET last_checked = excluded.last_checked''',
+                                    (release_id, seen, seen))
+            self.known.add(release_id)
+
+    def discard(self, release_id):
+        '''Forget a release that turned out to be available again. Only
+           releases known to this store are removed from the database,
+           so for most releases nothing is written.'''
+        with self.lock:
+            if release_id not in self.known:
+                return
+            with self.connection:
+                self.connection.execute('DELETE FROM tombstones WHERE id = ?', (release_id,))
+            self.known.discard(release_id)
+
+    def first_seen(self, release_id):
+        '''Return the time a release was first seen as removed, or None'''
+        with self.lock:
+            row = self.connection.execute('SELECT first_seen FROM tombstones WHERE id = ?',
+                                          (release_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def last_checked(self, release_id):
+        '''Return the time a release was last seen as removed, or None'''
+        with self.lock:
+            row = self.connection.execute('SELECT last_checked FROM tombstones WHERE id = ?',
+                                          (release_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def bitmap(self, since=None):
+        '''Return a bitmap with the removed releases. If since is given
+           only releases that were checked (and found to be removed)
+           since then are included.'''
+        with self.lock:
+            if since is None:
+                cursor = self.connection.execute('SELECT id FROM tombstones')
+            else:
+                cursor = self.connection.execute('SELECT id FROM tombstones WHERE last_checked >= ?',
+                                                 (since,))
+            return Bitmap(release_id for release_id, in cursor)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM tombstones').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
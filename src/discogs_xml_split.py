@@ -2,36 +2,497 @@
 
 # Tool to split entries from the Discogs data dump and compute a hash
 #
+# Splitting a complete dump takes hours, so progress can be recorded in a
+# checkpoint file: the offset in the decompressed dump after the last
+# release that was written, the last release number and the length of the
+# result file. After a restart the result file is truncated to that length
+# and splitting continues at the offset. Python's zlib module cannot save
+# the state of a decompressor, so without an index the dump is decompressed
+# (but not parsed or hashed) up to the offset. If indexed_gzip is installed
+# a seek point index (like zran: the compressed offset and the last 32 KiB
+# of decompressed data for regularly spaced points in the dump) can be kept
+# as well, so the dump can be decompressed from the nearest seek point
+# instead.
+#
+# The same index can be used to split a dump into independent ranges of
+# the decompressed data, which can be processed in parallel, on different
+# hosts. A release belongs to the range in which it starts.
+#
 # SPDX-License-Identifier: Apache-2.0
 #
 # Copyright - Armijn Hemel
 
+import bisect
+import collections
 import gzip
 import hashlib
+import json
+import multiprocessing
+import os
+import pathlib
+import re
 import sys
+import time
 
 import click
 
 import defusedxml.ElementTree as et
 
+import discogs_results
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# markers used to cut the decompressed dump into releases. The
+# trailing space in the start marker makes sure that the
+# top level <releases> element is not matched.
+RELEASE_START = b'<release '
+RELEASE_END = b'</release>'
+
+# release number in the start tag of a release
+RELEASE_ID = re.compile(rb'<release [^>]*?\bid="(\d+)"')
+
+# amount of decompressed data to read from the dump in one go
+READ_SIZE = 16 * 1024 * 1024
+
+# amount of decompressed data between two seek points in the index
+INDEX_SPACING = 64 * 1024 * 1024
+
+# default time (in seconds) between two checkpoints
+CHECKPOINT_INTERVAL = 60
+
+# version of the checkpoints. Checkpoints without a version were made when
+# the chunks of the dump did not include the whitespace after a release, so
+# results in etree mode could not be continued from them.
+CHECKPOINT_VERSION = 2
+
+
+def split_release_offsets(dumpfile, start=0, end=None, read_size=READ_SIZE):
+    '''Cut a (decompressed) Discogs dump, positioned at offset start of
+       the decompressed data, into raw <release>...</release> byte chunks,
+       each followed by the whitespace up to the next tag (the tail of the
+       element, see hash_element()). Yields (chunk, offset of the end of
+       the chunk) tuples. If end is given only releases that start before
+       end are returned.'''
+    buf = b''
+
+    # offset of the start of buf in the decompressed data
+    buf_offset = start
+    eof = False
+    while not eof:
+        data = dumpfile.read(read_size)
+        eof = not data
+        buf += data
+        pos = 0
+        while True:
+            release_start = buf.find(RELEASE_START, pos)
+            if release_start == -1:
+                # keep enough data for a start marker that
+                # is split across two reads
+                pos = max(pos, len(buf) - len(RELEASE_START) + 1)
+                break
+            if end is not None and buf_offset + release_start >= end:
+                return
+            release_end = buf.find(RELEASE_END, release_start)
+            if release_end == -1:
+                pos = release_start
+                break
+            release_end += len(RELEASE_END)
+
+            # the tail of the release is only complete once the next
+            # tag has been read (or the end of the dump is reached)
+            tail_end = buf.find(b'<', release_end)
+            if tail_end == -1:
+                if not eof:
+                    pos = release_start
+                    break
+                tail_end = len(buf)
+            yield buf[release_start:tail_end], buf_offset + tail_end
+            pos = tail_end
+        buf = buf[pos:]
+        buf_offset += pos
+        if end is not None and buf_offset >= end:
+            return
+
+
+def split_releases(dumpfile, read_size=READ_SIZE):
+    '''Cut a (decompressed) Discogs dump into raw <release>...</release> byte
+       chunks (followed by the whitespace up to the next tag)'''
+    for chunk, _ in split_release_offsets(dumpfile, read_size=read_size):
+        yield chunk
+
+
+def hash_element(element):
+    '''Compute the release number and digest for a parsed release element.
+       The serialization includes the tail of the element (the whitespace
+       after the release), as it is set by iterparse().'''
+    release_id = int(element.attrib['id'])
+    release_hash = hashlib.sha1(et.tostring(element, encoding='unicode').encode()).digest()
+    return release_id, release_hash
+
+
+def hash_raw(chunk):
+    '''Compute the release number and digest for a raw release chunk,
+       without parsing the XML. The whitespace after the release is
+       not included.'''
+    release_id = int(RELEASE_ID.match(chunk).group(1))
+    release_hash = hashlib.sha1(chunk.rstrip()).digest()
+    return release_id, release_hash
+
+
+def parse_chunk(chunk):
+    '''Parse a raw release chunk, with the whitespace after the release
+       as the tail of the element, like in the complete dump'''
+    release = chunk.rstrip()
+    element = et.fromstring(release)
+    if len(release) < len(chunk):
+        element.tail = chunk[len(release):].decode()
+    return element
+
+
+def hash_releases(chunks, hash_mode):
+    '''Hash a batch of raw release chunks (run in a worker process)'''
+    if hash_mode == 'raw':
+        return [hash_raw(chunk) for chunk in chunks]
+    return [hash_element(parse_chunk(chunk)) for chunk in chunks]
+
+
+def batch_releases(releases, batch_size):
+    '''Group raw release chunks into batches for the worker processes'''
+    batch = []
+    for release in releases:
+        batch.append(release)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_serial(dumpfile, res, hash_mode, batch_size, start=0, end=None, progress=None):
+    '''Hash all releases in a single process. If progress is given it is
+       called with the offset after the last release of every batch and
+       the results of the batch, after the results have been written.'''
+    if hash_mode == 'raw' or start or end is not None or progress is not None:
+        for batch in batch_releases(split_release_offsets(dumpfile, start, end), batch_size):
+            results = hash_releases([chunk for chunk, _ in batch], hash_mode)
+            res.write(results)
+            if progress is not None:
+                progress(batch[-1][1], results)
+        return
+
+    # a release is hashed at the next event, as the tail of the
+    # element is only complete once the parser has moved past it
+    results = []
+    release = None
+    for event, element in et.iterparse(dumpfile):
+        if release is not None:
+            results.append(hash_element(release))
+            release.clear()
+            release = None
+            if len(results) == batch_size:
+                res.write(results)
+                results = []
+        if element.tag == 'release':
+            release = element
+    if release is not None:
+        results.append(hash_element(release))
+    res.write(results)
+
+
+def process_parallel(dumpfile, res, hash_mode, jobs, batch_size, queue_depth, start=0, end=None,
+                     progress=None):
+    '''Hash all releases using a pool of worker processes. This process
+       reads and cuts the dump, the workers parse and hash the releases.
+       Results are written in dump order, so the output is identical to
+       the output of process_serial(). At most queue_depth batches are
+       in flight at any time, which bounds memory usage.'''
+    pending = collections.deque()
+
+    def write_batch():
+        result, offset = pending.popleft()
+        results = result.get()
+        res.write(results)
+        if progress is not None:
+            progress(offset, results)
+
+    with multiprocessing.Pool(jobs) as pool:
+        for batch in batch_releases(split_release_offsets(dumpfile, start, end), batch_size):
+            if len(pending) >= queue_depth:
+                write_batch()
+            pending.append((pool.apply_async(hash_releases, ([chunk for chunk, _ in batch], hash_mode)),
+                            batch[-1][1]))
+        while pending:
+            write_batch()
+
+
+def open_dump(datadump, index_file=None):
+    '''Open a gzip compressed dump. If an index file is given the dump is
+       opened with indexed_gzip, using the index if it exists.'''
+    if index_file is None:
+        return gzip.open(datadump, 'rb')
+    if indexed_gzip is None:
+        raise ValueError("an index needs the indexed_gzip module")
+    if pathlib.Path(index_file).exists():
+        return indexed_gzip.IndexedGzipFile(str(datadump), index_file=str(index_file),
+                                            drop_handles=False, buffer_size=READ_SIZE)
+    return indexed_gzip.IndexedGzipFile(str(datadump), spacing=INDEX_SPACING,
+                                        drop_handles=False, buffer_size=READ_SIZE)
+
+
+def seek_dump(dumpfile, offset):
+    '''Move to an offset in the decompressed dump. Without an index the
+       dump is decompressed up to the offset.'''
+    if indexed_gzip is not None and isinstance(dumpfile, indexed_gzip.IndexedGzipFile):
+        dumpfile.seek(offset)
+        return
+    while offset > 0:
+        data = dumpfile.read(min(offset, READ_SIZE))
+        if not data:
+            raise ValueError("offset is beyond the end of the dump")
+        offset -= len(data)
+
+
+def export_index(dumpfile, index_file):
+    '''Write the seek points of a dump opened with an index to the index file'''
+    temporary_file = pathlib.Path(f"{index_file}.tmp")
+    dumpfile.raw.export_index(str(temporary_file))
+    os.replace(temporary_file, index_file)
+
+
+def compressed_offset(dumpfile, offset):
+    '''Offset in the compressed dump for an offset in the decompressed
+       dump: the last seek point before the offset. Returns None if there
+       is no index, as the position in the compressed file is ahead of
+       the offset by the amount of data that was read ahead.'''
+    if indexed_gzip is None or not isinstance(dumpfile, indexed_gzip.IndexedGzipFile):
+        return None
+    seek_point = 0
+    for uncompressed, compressed in dumpfile.raw.seek_points():
+        if uncompressed > offset:
+            break
+        seek_point = compressed
+    return seek_point
+
+
+def dump_identity(datadump):
+    '''Name, size and modification time of a dump, to check that a
+       checkpoint belongs to the dump'''
+    stat_result = os.stat(datadump)
+    return {'dump': str(pathlib.Path(datadump).resolve()), 'dump_size': stat_result.st_size,
+            'dump_mtime': stat_result.st_mtime}
+
+
+def read_checkpoint(checkpoint_file):
+    '''Read a checkpoint, returns None if there is no checkpoint'''
+    try:
+        with open(checkpoint_file, 'r') as checkpoint:
+            return json.load(checkpoint)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    '''Write a checkpoint, replacing the previous checkpoint atomically'''
+    temporary_file = pathlib.Path(f"{checkpoint_file}.tmp")
+    with open(temporary_file, 'w') as checkpoint_tmp:
+        json.dump(checkpoint, checkpoint_tmp, indent=4)
+        checkpoint_tmp.flush()
+        os.fsync(checkpoint_tmp.fileno())
+    os.replace(temporary_file, checkpoint_file)
+
+
+class Checkpointer:
+    '''Keep track of the progress of splitting a dump and write it to a
+       checkpoint file (and the seek points to the index file, if any)
+       every interval seconds. The writer should be positioned at the
+       start offset of the checkpoint.'''
+    def __init__(self, checkpoint_file, checkpoint, dumpfile, res, index_file=None,
+                 interval=CHECKPOINT_INTERVAL):
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint = checkpoint
+        self.dumpfile = dumpfile
+        self.res = res
+        self.index_file = index_file
+        self.interval = interval
+        self.index_points = None
+        self.saved = time.monotonic()
+        self._record_writer()
+
+    def _record_writer(self):
+        # the length and state of the writer are recorded after every
+        # complete batch: a batch that was interrupted while it was
+        # written is cut off when splitting continues
+        self.checkpoint['result_length'] = self.res.length()
+        self.checkpoint['writer'] = self.res.state()
+
+    def progress(self, offset, results):
+        '''Record the offset after a batch of written results'''
+        self.checkpoint['offset'] = offset
+        if results:
+            self.checkpoint['last_id'] = results[-1][0]
+        self._record_writer()
+        if time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        '''Write the checkpoint. The index and the result file are
+           written to disk first, so they match the checkpoint.'''
+        if self.index_file is not None and self.dumpfile.raw.npoints != self.index_points:
+            export_index(self.dumpfile, self.index_file)
+            self.index_points = self.dumpfile.raw.npoints
+        self.res.sync()
+        self.checkpoint['compressed_offset'] = compressed_offset(self.dumpfile, self.checkpoint['offset'])
+        write_checkpoint(self.checkpoint_file, self.checkpoint)
+        self.saved = time.monotonic()
+
+
+def print_ranges(datadump, index_file, parts):
+    '''Print the offsets of ranges of the decompressed dump of roughly
+       the same size. With an index the ranges start at seek points.'''
+    seek_points = []
+    with open_dump(datadump, index_file) as dumpfile:
+        if index_file is not None:
+            dumpfile.raw.build_full_index()
+            export_index(dumpfile, index_file)
+            seek_points = [uncompressed for uncompressed, _ in dumpfile.raw.seek_points()]
+            size = dumpfile.seek(0, os.SEEK_END)
+        else:
+            size = 0
+            while data := dumpfile.read(READ_SIZE):
+                size += len(data)
+
+    offsets = [0]
+    for part in range(1, parts):
+        offset = size * part // parts
+        if seek_points:
+            # start at the last seek point before an equal share,
+            # so seeking to the start of the range is cheap
+            offset = seek_points[max(bisect.bisect_right(seek_points, offset) - 1, 0)]
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    offsets.append(size)
+    for range_start, range_end in zip(offsets, offsets[1:]):
+        print(f"{range_start}\t{range_end}")
+
 
 @click.command(short_help='process Discogs XML file and compute SHA1 hashes for each release')
 @click.option('--datadump', '-d', 'datadump', required=True, help='discogs data dump file',
               type=click.Path(exists=True))
-@click.option('--result-file', '-r', 'result_file', required=True, help='file to write results to',
+@click.option('--result-file', '-r', 'result_file', help='file to write results to',
               type=click.Path())
-def main(datadump, result_file):
+@click.option('--jobs', '-j', 'jobs', default=1, help='number of worker processes (default: 1)',
+              type=click.IntRange(min=1))
+@click.option('--batch-size', 'batch_size', default=1000,
+              help='releases per worker batch (default: 1000)', type=click.IntRange(min=1))
+@click.option('--queue-depth', 'queue_depth', help='maximum batches in flight (default: 4 * jobs)',
+              type=click.IntRange(min=1))
+@click.option('--hash-mode', 'hash_mode', default=discogs_results.DEFAULT_HASH_MODE,
+              help='hash ElementTree serialized XML (etree) or original bytes (raw)',
+              type=click.Choice(discogs_results.HASH_MODES))
+@click.option('--format', '-f', 'result_format', default='text',
+              help='format of the result file (default: text)',
+              type=click.Choice(discogs_results.FORMATS))
+@click.option('--checkpoint', 'checkpoint_file', type=click.Path(path_type=pathlib.Path),
+              help='file to record progress in, splitting continues from it if it exists')
+@click.option('--checkpoint-interval', default=CHECKPOINT_INTERVAL, type=click.FloatRange(min=0),
+              help=f'seconds between checkpoints (default: {CHECKPOINT_INTERVAL})')
+@click.option('--index', 'index_file', type=click.Path(path_type=pathlib.Path),
+              help='seek point index of the dump, created if it does not exist (needs indexed_gzip)')
+@click.option('--start-offset', default=0, type=click.IntRange(min=0),
+              help='process releases starting at or after this offset in the decompressed dump')
+@click.option('--end-offset', type=click.IntRange(min=0),
+              help='process releases starting before this offset in the decompressed dump')
+@click.option('--print-ranges', 'parts', type=click.IntRange(min=1),
+              help='print the offsets of this number of ranges of the dump and exit')
+def main(datadump, result_file, jobs, batch_size, queue_depth, hash_mode, result_format,
+         checkpoint_file, checkpoint_interval, index_file, start_offset, end_offset, parts):
+    if queue_depth is None:
+        queue_depth = 4 * jobs
+
+    if index_file is not None and indexed_gzip is None:
+        print("An index needs the indexed_gzip module, exiting", file=sys.stderr)
+        sys.exit(1)
+
+    if parts is not None:
+        try:
+            print_ranges(datadump, index_file, parts)
+        except Exception as e:
+            print("Cannot process dump file", e, file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if result_file is None:
+        print("Result file not supplied, exiting", file=sys.stderr)
+        sys.exit(1)
+
+    # a checkpoint can only be used to continue splitting
+    # the same dump with the same settings
+    checkpoint = dict(dump_identity(datadump), version=CHECKPOINT_VERSION, hash_mode=hash_mode,
+                      format=result_format, start=start_offset, end=end_offset,
+                      offset=start_offset, last_id=None)
+    result_length = None
+    writer_state = None
+    if checkpoint_file is not None:
+        try:
+            previous = read_checkpoint(checkpoint_file)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read checkpoint {checkpoint_file}, exiting", e, file=sys.stderr)
+            sys.exit(1)
+        if previous is not None:
+            for key in ['version', 'dump', 'dump_size', 'dump_mtime', 'hash_mode', 'format', 'start',
+                        'end']:
+                if previous.get(key) != checkpoint[key]:
+                    print(f"Checkpoint {checkpoint_file} was made with a different {key}, exiting",
+                          file=sys.stderr)
+                    sys.exit(1)
+            checkpoint = previous
+            result_length = checkpoint['result_length']
+            writer_state = checkpoint['writer']
+            if checkpoint['compressed_offset'] is None:
+                print(f"Continuing at offset {checkpoint['offset']} after release "
+                      f"{checkpoint['last_id']}", file=sys.stderr)
+            else:
+                print(f"Continuing at offset {checkpoint['offset']} (seek point: "
+                      f"{checkpoint['compressed_offset']}) after release {checkpoint['last_id']}",
+                      file=sys.stderr)
 
     try:
-        with gzip.open(datadump, 'rb') as dumpfile:
-            with open(result_file, 'w') as res:
-                for event, element in et.iterparse(dumpfile):
-                    if element.tag == 'release':
-                        release_id = element.attrib['id']
-                        release_hash = hashlib.sha1(et.tostring(element, encoding='unicode').encode()).hexdigest()
-                        res.write(f"{release_id}\t{release_hash}\n")
-                        element.clear()
+        with open_dump(datadump, index_file) as dumpfile:
+            seek_dump(dumpfile, checkpoint['offset'])
+            res = discogs_results.open_writer(result_file, hash_mode, result_format,
+                                              length=result_length, state=writer_state)
+            progress = None
+            checkpointer = None
+            if checkpoint_file is not None:
+                checkpointer = Checkpointer(checkpoint_file, checkpoint, dumpfile, res, index_file,
+                                            checkpoint_interval)
+                progress = checkpointer.progress
+            try:
+                if jobs == 1:
+                    process_serial(dumpfile, res, hash_mode, batch_size, checkpoint['offset'],
+                                   end_offset, progress)
+                else:
+                    process_parallel(dumpfile, res, hash_mode, jobs, batch_size, queue_depth,
+                                     checkpoint['offset'], end_offset, progress)
+            except BaseException:
+                # everything up to the last batch that was completely
+                # written is kept, so splitting can continue from there
+                if checkpointer is not None:
+                    checkpointer.save()
+                raise
+            if index_file is not None:
+                export_index(dumpfile, index_file)
+            res.close()
 
+        if checkpoint_file is not None:
+            checkpoint_file.unlink(missing_ok=True)
+
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        sys.exit(1)
     except Exception as e:
         print("Cannot process dump file", e, file=sys.stderr)
         sys.exit(1)